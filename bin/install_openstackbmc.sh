@@ -5,7 +5,7 @@ set -x
 # install python2-crypto from EPEL
 # python-[nova|neutron]client are in a similar situation.  They were renamed
 # in RDO to python2-*
-required_packages="python-pip os-net-config git jq python2-os-client-config python2-openstackclient"
+required_packages="python-pip os-net-config git jq python2-os-client-config python2-openstackclient python2-heatclient"
 
 function have_packages() {
     for i in $required_packages; do
@@ -37,11 +37,6 @@ if ! have_packages; then
     pip install pyghmi
 fi
 
-cat <<EOF >/usr/local/bin/openstackbmc
-$openstackbmc_script
-EOF
-chmod +x /usr/local/bin/openstackbmc
-
 # Configure clouds.yaml so we can authenticate to the host cloud
 mkdir -p ~/.config/openstack
 # Passing this as an argument is problematic because it has quotes inline that
@@ -59,6 +54,17 @@ print(yaml.safe_dump(clouds, default_flow_style=False))' > ~/.config/openstack/c
 rm -f /tmp/bmc-cloud-data
 export OS_CLOUD=host_cloud
 
+# The BMC script is far too big to paste into the user data of this server,
+# which Nova limits to 64 KB, so it is kept in a Heat software config and
+# downloaded from there.
+if ! openstack software config show --config-only $openstackbmc_config > /usr/local/bin/openstackbmc
+then
+    $signal_command --data-binary '{"status": "FAILURE"}'
+    echo "********** Failed to download openstackbmc **********"
+    exit 1
+fi
+chmod +x /usr/local/bin/openstackbmc
+
 private_subnet=$(openstack network show -f value -c subnets $private_net)
 default_gw=$(openstack subnet show -f value -c gateway_ip $private_subnet)
 prefix_len=$(openstack subnet show -f value -c cidr $private_subnet | awk -F / '{print $2}')
@@ -97,23 +103,71 @@ StandardError=inherit
 WantedBy=multi-user.target
 EOF
 
+mkdir -p /var/lib/openstack-bmc
+bmc_units=
+# The BMC units are Type=notify: openstackbmc tells systemd it is ready once
+# it has found its instances and bound its sockets, then keeps the watchdog
+# fed from its event loop.  Each unit also has a control socket in /run, so
+# that "openstackbmc --control-socket SOCKET --control dump" can show what
+# its BMCs have cached, and flush it, without a restart.
+bmc_start_timeout=120
+instances_file=/etc/openstack-bmc-instances.json
+instances_json=
+
+# With one process per node, bmc_status_table has a single updater process
+# poll Nova for the status of every instance and share the results with the
+# per-node processes through a table on a tmpfs.
+status_table_args=
+if [ "$bmc_single_process" == "False" ] && [ "$bmc_status_table" != "False" ]; then
+    status_table_args="--status-table /run/openstack-bmc-status"
+    unit="openstack-bmc-status.service"
+    bmc_units="$bmc_units $unit"
+
+    cat <<EOF >/usr/lib/systemd/system/$unit
+[Unit]
+Description=openstack-bmc status updater Service
+
+[Service]
+Type=notify
+ExecStart=/usr/local/bin/openstackbmc  --os-cloud host_cloud --status-updater --poll-interval 5 $status_table_args
+Restart=always
+TimeoutStartSec=$bmc_start_timeout
+WatchdogSec=60
+
+User=root
+StandardOutput=kmsg+console
+StandardError=inherit
+
+[Install]
+WantedBy=multi-user.target
+EOF
+fi
+
 for i in $(seq 1 $bm_node_count)
 do
     bm_port="$bm_prefix_$(($i-1))"
     bm_instance=$(openstack port show -c device_id -f value $bm_port)
     bmc_port="$bmc_prefix_$(($i-1))"
     bmc_ip=$(openstack port show -c fixed_ips -f value $bmc_port | awk -F \' '{print $2}')
-    unit="openstack-bmc-$bm_port.service"
 
-    cat <<EOF >/usr/lib/systemd/system/$unit
+    if [ "$bmc_single_process" != "False" ]; then
+        instances_json="$instances_json${instances_json:+,}\"$bmc_ip\": \"$bm_instance\""
+    else
+        unit="openstack-bmc-$bm_port.service"
+        bmc_units="$bmc_units $unit"
+
+        cat <<EOF >/usr/lib/systemd/system/$unit
 [Unit]
 Description=openstack-bmc $bm_port Service
 Requires=config-bmc-ips.service
 After=config-bmc-ips.service
 
 [Service]
-ExecStart=/usr/local/bin/openstackbmc  --os-cloud host_cloud --instance $bm_instance --address $bmc_ip $cache_status
+Type=notify
+ExecStart=/usr/local/bin/openstackbmc  --os-cloud host_cloud --instance $bm_instance --address $bmc_ip --state-file /var/lib/openstack-bmc/$bm_port.json --control-socket /run/openstack-bmc-$bm_port.sock $cache_status $status_table_args
 Restart=always
+TimeoutStartSec=$bmc_start_timeout
+WatchdogSec=60
 
 User=root
 StandardOutput=kmsg+console
@@ -122,30 +176,63 @@ StandardError=inherit
 [Install]
 WantedBy=multi-user.target
 EOF
+    fi
 
     echo "    - ip_netmask: $bmc_ip/$prefix_len" >> /etc/os-net-config/config.yaml
 done
 
+# In single process mode one unit serves every BMC address from a shared
+# mapping of address to instance.  Changes to the mapping are picked up
+# without restarting the unit, so BMCs can be added or removed by rewriting
+# the file and running systemctl reload.  The BMCs are sharded across one
+# worker process per CPU.
+if [ "$bmc_single_process" != "False" ]; then
+    echo "{$instances_json}" > $instances_file
+    unit="openstack-bmc.service"
+    bmc_units=$unit
+
+    cat <<EOF >/usr/lib/systemd/system/$unit
+[Unit]
+Description=openstack-bmc Service
+Requires=config-bmc-ips.service
+After=config-bmc-ips.service
+
+[Service]
+Type=notify
+ExecStart=/usr/local/bin/openstackbmc  --os-cloud host_cloud --instances-file $instances_file --reload-interval 10 --processes 0 --state-file /var/lib/openstack-bmc/state.json --control-socket /run/openstack-bmc.sock $cache_status
+ExecReload=/bin/kill -HUP \$MAINPID
+Restart=always
+TimeoutStartSec=$bmc_start_timeout
+WatchdogSec=60
+
+User=root
+StandardOutput=kmsg+console
+StandardError=inherit
+
+[Install]
+WantedBy=multi-user.target
+EOF
+fi
+
 # It will be automatically started because the bmc services depend on it,
 # but to avoid confusion also explicitly enable it.
 systemctl enable config-bmc-ips
 
-for i in $(seq 1 $bm_node_count)
+for unit in $bmc_units
 do
-    bm_port="$bm_prefix_$(($i-1))"
-    unit="openstack-bmc-$bm_port.service"
     systemctl enable $unit
-    systemctl start $unit
 done
 
-sleep 5
+# Start every unit at once.  systemctl waits until all of them are ready, or
+# have failed or timed out, so the check below only runs once each BMC is
+# actually answering.
+systemctl start $bmc_units
 
-for i in $(seq 1 $bm_node_count)
+for unit in $bmc_units
 do
-    bm_port="$bm_prefix_$(($i-1))"
-    unit="openstack-bmc-$bm_port.service"
-    if ! systemctl status $unit
+    if ! systemctl is-active $unit
     then
+        systemctl status $unit
         $signal_command --data-binary '{"status": "FAILURE"}'
         echo "********** $unit failed to start **********"
         exit 1
@@ -153,4 +240,3 @@ do
 done
 
 $signal_command --data-binary '{"status": "SUCCESS"}'
-
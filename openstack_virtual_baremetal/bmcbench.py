@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+# Copyright 2026 Red Hat Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Benchmark openstackbmc against a fake compute API.
+#
+# The BMCs run in a child process, one per node on consecutive localhost
+# ports, backed by a FakeCompute with the requested latency.  This process
+# drives them with pyghmi the same way Ironic would and reports the
+# throughput, the latency of each IPMI command and the number of compute API
+# calls each command cost.
+
+import argparse
+import collections
+import json
+import math
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+from openstack_virtual_baremetal import fakecloud
+from openstack_virtual_baremetal import openstackbmc
+
+USERNAME = 'admin'
+PASSWORD = 'password'
+
+# The raw IPMI requests sent for each command, as (netfn, command, data).
+# Using raw requests means each command is exactly one round-trip to the BMC.
+COMMANDS = {
+    'power_status': (0, 1, ()),
+    'power_off': (0, 2, (0,)),
+    'power_on': (0, 2, (1,)),
+    'power_reset': (0, 2, (3,)),
+    'bootdev_get': (0, 9, (5, 0, 0)),
+    'bootdev_set_network': (0, 8, (5, 0x80, 4, 0, 0, 0)),
+    'bootdev_set_disk': (0, 8, (5, 0x80, 8, 0, 0, 0)),
+}
+
+# The commands sent to each node in one iteration of each workload
+WORKLOADS = {
+    # Ironic's periodic power state sync
+    'power-sync': ['power_status'],
+    # A deploy: power off, boot from the network, then from disk
+    'deploy': ['power_off', 'power_status', 'bootdev_set_network',
+               'power_on', 'power_status', 'bootdev_set_disk',
+               'power_reset', 'power_status'],
+}
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='bmc-bench',
+        description='Benchmark openstackbmc against a fake compute API',
+    )
+    parser.add_argument('--nodes',
+                        type=int,
+                        default=10,
+                        help='Number of BMCs to run; defaults to 10')
+    parser.add_argument('--workload',
+                        choices=sorted(WORKLOADS),
+                        default='power-sync',
+                        help='The commands to send to each node; defaults '
+                             'to power-sync')
+    parser.add_argument('--iterations',
+                        type=int,
+                        default=10,
+                        help='Number of times to run the workload against '
+                             'every node; defaults to 10')
+    parser.add_argument('--concurrency',
+                        type=int,
+                        default=4,
+                        help='Number of nodes to send commands to at once; '
+                             'defaults to 4')
+    parser.add_argument('--base-port',
+                        type=int,
+                        default=16230,
+                        help='Port of the first BMC.  Each further BMC uses '
+                             'the next port.  Defaults to 16230.')
+    parser.add_argument('--shared-socket',
+                        action='store_true',
+                        help='Serve the BMCs from one socket with '
+                             '--shared-socket.  Each BMC then listens on '
+                             '--base-port on its own loopback address.')
+    parser.add_argument('--latency',
+                        type=float,
+                        default=0.05,
+                        help='Seconds each compute API call takes; defaults '
+                             'to 0.05')
+    parser.add_argument('--jitter',
+                        type=float,
+                        default=0.02,
+                        help='Up to this many extra seconds are added at '
+                             'random to each compute API call; defaults to '
+                             '0.02')
+    parser.add_argument('--transition-time',
+                        type=float,
+                        default=0,
+                        help='Seconds a power operation takes to complete in '
+                             'the fake compute API; defaults to 0')
+    parser.add_argument('--cache-status',
+                        action='store_true',
+                        help='Run the BMCs with --cache-status')
+    parser.add_argument('--cache-ttl',
+                        type=float,
+                        default=30,
+                        help='--cache-ttl for the BMCs; defaults to 30')
+    parser.add_argument('--boot-device-ttl',
+                        type=float,
+                        default=300,
+                        help='--boot-device-ttl for the BMCs; defaults to '
+                             '300')
+    parser.add_argument('--poll-interval',
+                        type=float,
+                        default=0,
+                        help='--poll-interval for the BMCs; defaults to 0')
+    parser.add_argument('--transition-interval',
+                        type=float,
+                        default=1,
+                        help='--transition-interval for the BMCs; defaults '
+                             'to 1')
+    parser.add_argument('--power-workers',
+                        type=int,
+                        default=0,
+                        help='--power-workers for the BMCs; defaults to 0')
+    parser.add_argument('--api-rate',
+                        type=float,
+                        default=0,
+                        help='--api-rate for the BMCs; defaults to 0')
+    parser.add_argument('--json',
+                        action='store_true',
+                        help='Write the results as JSON')
+    return parser.parse_args(argv)
+
+
+def percentile(values, pct):
+    """Return the pct percentile of values using the nearest rank method"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[min(max(rank, 1), len(ordered)) - 1]
+
+
+def node_address(args, i):
+    """Return the address and port of the BMC for node i"""
+    if args.shared_socket:
+        # The whole of 127.0.0.0/8 reaches the loopback interface
+        return '127.0.%d.%d' % (i // 250 + 1, i % 250 + 1), args.base_port
+    return '127.0.0.1', args.base_port + i
+
+
+def serve(args, conn):
+    """Run one BMC per node until asked to stop
+
+    Sends 'ready' on conn once every BMC is listening, then waits for a
+    message on conn and replies with the compute API calls made since.
+    """
+    # The BMCs log every command, which would swamp the results
+    openstackbmc.log_writer.stream = open(os.devnull, 'w')
+    openstackbmc.rate_limiter.configure(args.api_rate)
+    compute = fakecloud.FakeCompute(latency=args.latency, jitter=args.jitter,
+                                    transition_time=args.transition_time)
+    status_table = openstackbmc.StatusTable()
+    poller = None
+    if args.poll_interval > 0:
+        poller = openstackbmc.StatusPoller(compute, args.poll_interval,
+                                           status_table)
+    dispatcher = None
+    if args.power_workers > 0:
+        dispatcher = openstackbmc.CommandDispatcher(args.power_workers)
+    tracker = None
+    if args.transition_interval > 0:
+        tracker = openstackbmc.TransitionTracker(compute, status_table,
+                                                 args.transition_interval)
+    listener = None
+    if args.shared_socket:
+        listener = openstackbmc.SharedListener(args.base_port)
+        listener.bind()
+    for i in range(args.nodes):
+        server = compute.add_server('baremetal-%d' % i)
+        address, port = node_address(args, i)
+        openstackbmc.OpenStackBmc({USERNAME: PASSWORD},
+                                  port=port,
+                                  address='::ffff:%s' % address,
+                                  instance=server.id,
+                                  cache_status=args.cache_status,
+                                  os_cloud=None,
+                                  novaclient=compute,
+                                  poller=poller,
+                                  cache_ttl=args.cache_ttl,
+                                  status_table=status_table,
+                                  dispatcher=dispatcher,
+                                  boot_device_ttl=args.boot_device_ttl,
+                                  tracker=tracker,
+                                  listener=listener)
+    if poller is not None:
+        poller.start()
+    if listener is not None:
+        loop = threading.Thread(target=listener.listen)
+    else:
+        loop = threading.Thread(target=openstackbmc.OpenStackBmc.listen)
+    loop.daemon = True
+    loop.start()
+    # Startup lookups are not part of the benchmark
+    compute.reset_calls()
+    conn.send('ready')
+    conn.recv()
+    conn.send(dict(compute.calls))
+
+
+class Results(object):
+    """Latencies of the commands sent during a run"""
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self._lock = threading.Lock()
+
+    def record(self, command, latency, error=False):
+        with self._lock:
+            self.latencies[command].append(latency)
+            if error:
+                self.errors[command] += 1
+
+    @property
+    def commands(self):
+        return sum(len(v) for v in self.latencies.values())
+
+    def summary(self, elapsed, nova_calls):
+        """Return the results as a dict"""
+        commands = self.commands
+        everything = []
+        per_command = {}
+        for command, latencies in sorted(self.latencies.items()):
+            everything.extend(latencies)
+            per_command[command] = self._stats(latencies)
+            per_command[command]['errors'] = self.errors[command]
+        total_nova_calls = sum(nova_calls.values())
+        return {
+            'commands': commands,
+            'errors': sum(self.errors.values()),
+            'elapsed': elapsed,
+            'commands_per_second': commands / elapsed if elapsed else 0,
+            'latency': self._stats(everything),
+            'per_command': per_command,
+            'nova_calls': nova_calls,
+            'nova_calls_per_command': (float(total_nova_calls) / commands
+                                       if commands else 0),
+        }
+
+    @staticmethod
+    def _stats(latencies):
+        return {'count': len(latencies),
+                'p50': percentile(latencies, 50),
+                'p95': percentile(latencies, 95),
+                'p99': percentile(latencies, 99)}
+
+
+def _send(ipmicmd, command, results):
+    netfn, cmd, data = COMMANDS[command]
+    start = time.time()
+    try:
+        response = ipmicmd.raw_command(netfn=netfn, command=cmd, data=data)
+        error = 'error' in response
+    except Exception:
+        error = True
+    results.record(command, time.time() - start, error)
+
+
+def _request_cipher_suite_3(session):
+    """Make pyghmi clients ask for cipher suite 3 like ipmitool does
+
+    pyghmi's BMC always answers with cipher suite 3, but newer pyghmi
+    clients first ask for cipher suite 17 and fail the login when they get
+    a different one.
+    """
+    open_request = session.Session._open_rmcpplus_request
+
+    def _open_rmcpplus_request(self):
+        self.attemptedhash = 1
+        return open_request(self)
+    session.Session._open_rmcpplus_request = _open_rmcpplus_request
+
+
+def run(args, results):
+    """Send the workload to every node and return the elapsed time"""
+    # Imported here so that pyghmi's client threads are only started in
+    # this process, after the BMC process has been forked.
+    from pyghmi.ipmi import command as ipmi_command
+    from pyghmi.ipmi.private import session
+
+    _request_cipher_suite_3(session)
+    commands = WORKLOADS[args.workload]
+    nodes = collections.deque()
+    for i in range(args.nodes):
+        address, port = node_address(args, i)
+        nodes.append(ipmi_command.Command(bmc=address, userid=USERNAME,
+                                          password=PASSWORD, port=port))
+    lock = threading.Lock()
+
+    def worker(pending):
+        while True:
+            with lock:
+                if not pending:
+                    return
+                ipmicmd = pending.popleft()
+            for command in commands:
+                _send(ipmicmd, command, results)
+
+    start = time.time()
+    for _ in range(args.iterations):
+        pending = collections.deque(nodes)
+        threads = [threading.Thread(target=worker, args=(pending,))
+                   for _ in range(min(args.concurrency, args.nodes))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    return time.time() - start
+
+
+def format_summary(summary):
+    lines = ['Commands:          %d (%d errors)' %
+             (summary['commands'], summary['errors']),
+             'Elapsed:           %.2fs' % summary['elapsed'],
+             'Commands/sec:      %.1f' % summary['commands_per_second'],
+             'Nova calls/cmd:    %.2f' % summary['nova_calls_per_command'],
+             '',
+             '%-20s %8s %10s %10s %10s' % ('command', 'count', 'p50 ms',
+                                           'p95 ms', 'p99 ms')]
+    rows = sorted(summary['per_command'].items())
+    rows.append(('all', summary['latency']))
+    for command, stats in rows:
+        lines.append('%-20s %8d %10.1f %10.1f %10.1f' % (
+            command, stats['count'], (stats['p50'] or 0) * 1000,
+            (stats['p95'] or 0) * 1000, (stats['p99'] or 0) * 1000))
+    lines.append('')
+    lines.append('Nova calls: %s' % ', '.join(
+        '%s=%d' % i for i in sorted(summary['nova_calls'].items())))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    parent_conn, child_conn = multiprocessing.Pipe()
+    bmc_process = multiprocessing.Process(target=serve,
+                                          args=(args, child_conn))
+    bmc_process.daemon = True
+    bmc_process.start()
+    if not parent_conn.poll(60):
+        sys.exit('Timed out waiting for the BMCs to start')
+    parent_conn.recv()
+    results = Results()
+    try:
+        elapsed = run(args, results)
+        parent_conn.send('stop')
+        nova_calls = parent_conn.recv()
+    finally:
+        bmc_process.terminate()
+    summary = results.summary(elapsed, nova_calls)
+    if args.json:
+        print(json.dumps(summary, indent=2, sort_keys=True))
+    else:
+        print(format_summary(summary))
+
+
+if __name__ == '__main__':
+    main()
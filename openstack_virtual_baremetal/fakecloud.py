@@ -0,0 +1,842 @@
+# Copyright 2026 Red Hat Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Fakes of the host cloud APIs used by the tools in this repo, for
+# benchmarking and scale testing them without a real cloud.
+#
+# FakeCompute is an in-process stand-in for a novaclient Client.  FakeCloud
+# holds a whole fake cloud, and FakeCloudServer serves it over HTTP so the
+# real clients can be pointed at it through clouds.yaml:
+#
+#     python -m openstack_virtual_baremetal.fakecloud --nodes 1000 \
+#         --clouds-yaml clouds.yaml
+#     OS_CLOUD=fakecloud bin/build-nodes-json
+
+import argparse
+import collections
+import copy
+import json
+import random
+import re
+import threading
+import time
+import uuid
+
+from novaclient import exceptions
+import yaml
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qsl
+    from urlparse import urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl
+    from urllib.parse import urlparse
+
+
+class FakeServer(object):
+    """A server as returned by novaclient"""
+    def __init__(self, id, name, status='ACTIVE', metadata=None, flavor=None,
+                 image=None, addresses=None, volumes=None):
+        self.id = id
+        self.name = name
+        self.status = status
+        self.metadata = metadata if metadata is not None else {}
+        self.flavor = flavor if flavor is not None else {}
+        # Nova reports an empty image for servers booted from a volume
+        self.image = image if image is not None else ''
+        self.addresses = addresses if addresses is not None else {}
+        self.volumes = volumes if volumes is not None else []
+        self.task_state = None
+        # Set when a power operation is in progress, as a (status, time)
+        # tuple of the status to move to and when to move to it.
+        self.transition = None
+
+    def __getattr__(self, name):
+        # novaclient exposes extended attributes under their API names
+        if name == 'OS-EXT-STS:task_state':
+            return self.task_state
+        raise AttributeError(name)
+
+    def settle(self, now):
+        """Complete the power operation in progress if it is due"""
+        if self.transition is not None and now >= self.transition[1]:
+            self.status = self.transition[0]
+            self.task_state = None
+            self.transition = None
+
+    def to_dict(self):
+        """Return the server as the compute API represents it"""
+        return {'id': self.id,
+                'name': self.name,
+                'status': self.status,
+                'metadata': dict(self.metadata),
+                'flavor': self.flavor,
+                'image': self.image,
+                'addresses': self.addresses,
+                'OS-EXT-STS:task_state': self.task_state,
+                'os-extended-volumes:volumes_attached': [
+                    {'id': v} for v in self.volumes]}
+
+    def snapshot(self):
+        """Return a copy that is not affected by later changes"""
+        server = copy.copy(self)
+        server.metadata = dict(self.metadata)
+        return server
+
+
+class FakeServerManager(object):
+    """The servers attribute of a FakeCompute"""
+    # Nova's default osapi_max_limit
+    MAX_LIMIT = 1000
+
+    def __init__(self, compute):
+        self.compute = compute
+        self._lock = threading.Lock()
+        self._servers = collections.OrderedDict()
+
+    def add(self, name, status='ACTIVE', metadata=None, **kwargs):
+        """Create a server without going through the API and return it"""
+        server = FakeServer(str(uuid.uuid4()), name, status, metadata,
+                            **kwargs)
+        with self._lock:
+            self._servers[server.id] = server
+        return server
+
+    def _find(self, server):
+        """Return the server with the uuid server.  Call with _lock held."""
+        server = getattr(server, 'id', server)
+        if server not in self._servers:
+            raise exceptions.NotFound(
+                404, message='Instance %s could not be found.' % server)
+        found = self._servers[server]
+        found.settle(time.time())
+        return found
+
+    def _transition(self, server, action, from_statuses, task_state, status,
+                    target):
+        """Start a power operation.  Call with _lock held."""
+        server = self._find(server)
+        if server.task_state is not None or server.status not in from_statuses:
+            raise exceptions.Conflict(
+                409, message="Cannot '%s' instance %s while it is in "
+                             "vm_state %s" % (action, server.id,
+                                              server.status.lower()))
+        delay = self.compute.transition_delay(target)
+        if self.compute.power_failure():
+            # The operation is accepted, but the server ends up back where
+            # it started
+            target = server.status
+        server.status = status
+        server.task_state = task_state
+        server.transition = (target, time.time() + delay)
+        server.settle(time.time())
+
+    def get(self, server):
+        self.compute.request('get')
+        with self._lock:
+            return self._find(server).snapshot()
+
+    def list(self, detailed=True, search_opts=None, marker=None, limit=None):
+        """Return a page of servers after marker, like Nova
+
+        At most MAX_LIMIT servers are returned, unless limit is -1, which
+        returns every server the way novaclient does by following markers.
+        """
+        self.compute.request('list')
+        name = (search_opts or {}).get('name')
+        now = time.time()
+        with self._lock:
+            matching = [server for server in self._servers.values()
+                        if name is None or re.search(name, server.name)]
+            if marker is not None:
+                ids = [server.id for server in matching]
+                if marker not in ids:
+                    raise exceptions.BadRequest(
+                        400, message='marker [%s] not found' % marker)
+                matching = matching[ids.index(marker) + 1:]
+            if limit != -1:
+                matching = matching[:min(limit or self.MAX_LIMIT,
+                                         self.MAX_LIMIT)]
+            servers = []
+            for server in matching:
+                server.settle(now)
+                servers.append(server.snapshot())
+        return servers
+
+    def set_meta_item(self, server, key, value):
+        self.compute.request('set_meta_item')
+        with self._lock:
+            self._find(server).metadata[key] = value
+
+    def start(self, server):
+        self.compute.request('start')
+        with self._lock:
+            self._transition(server, 'start', ('SHUTOFF',), 'powering-on',
+                             'SHUTOFF', 'ACTIVE')
+
+    def stop(self, server):
+        self.compute.request('stop')
+        with self._lock:
+            self._transition(server, 'stop', ('ACTIVE',), 'powering-off',
+                             'ACTIVE', 'SHUTOFF')
+
+    def reboot(self, server, reboot_type='SOFT'):
+        self.compute.request('reboot')
+        with self._lock:
+            if reboot_type == 'HARD':
+                self._transition(server, 'reboot', ('ACTIVE', 'SHUTOFF'),
+                                 'rebooting_hard', 'HARD_REBOOT', 'ACTIVE')
+            else:
+                self._transition(server, 'reboot', ('ACTIVE',), 'rebooting',
+                                 'REBOOT', 'ACTIVE')
+
+
+class FakeCompute(object):
+    """A stand-in for a novaclient Client
+
+    Every call sleeps for latency seconds plus a random amount up to jitter
+    seconds, is counted by operation in calls, and fails with a 503
+    ClientException at random error_rate of the time.  Power operations
+    leave the server in a transitional state for transition_time seconds,
+    during which further power operations fail with a Conflict like they
+    would in Nova.  boot_time and shutdown_time override transition_time for
+    the operations that end with the server ACTIVE and SHUTOFF respectively.
+    At random power_failure_rate of the time a power operation is accepted
+    but leaves the server in the status it started in.
+    """
+    def __init__(self, latency=0, jitter=0, transition_time=0, seed=None,
+                 boot_time=None, shutdown_time=None, error_rate=0,
+                 power_failure_rate=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.transition_time = transition_time
+        self.boot_time = boot_time
+        self.shutdown_time = shutdown_time
+        self.error_rate = error_rate
+        self.power_failure_rate = power_failure_rate
+        self.calls = collections.Counter()
+        self.servers = FakeServerManager(self)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def add_server(self, name, status='ACTIVE', metadata=None, **kwargs):
+        return self.servers.add(name, status, metadata, **kwargs)
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls.clear()
+
+    @property
+    def total_calls(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+    def request(self, operation):
+        """Count a call to operation and simulate the API latency and errors"""
+        with self._lock:
+            self.calls[operation] += 1
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            fail = (self.error_rate > 0 and
+                    self._random.random() < self.error_rate)
+        if delay > 0:
+            time.sleep(delay)
+        if fail:
+            raise exceptions.ClientException(
+                503, message='Injected failure of %s' % operation)
+
+    def transition_delay(self, status):
+        """Return how long a power operation ending in status takes"""
+        if status == 'ACTIVE' and self.boot_time is not None:
+            return self.boot_time
+        if status == 'SHUTOFF' and self.shutdown_time is not None:
+            return self.shutdown_time
+        return self.transition_time
+
+    def power_failure(self):
+        """Return whether the power operation being started should fail"""
+        if self.power_failure_rate <= 0:
+            return False
+        with self._lock:
+            return self._random.random() < self.power_failure_rate
+
+
+class FakeCloud(object):
+    """A fake host cloud
+
+    Holds the resources of a cloud and answers requests for the subset of
+    the Keystone, Nova, Neutron, Glance, Cinder and Heat APIs used by the
+    tools in this repo.  Serve it over HTTP with FakeCloudServer.
+
+    Every API request takes latency seconds plus a random amount up to
+    jitter seconds, and fails with error_code at random error_rate of the
+    time.  Requests are counted by operation in calls.
+    """
+    # (method, path, handler, whether to inject latency and errors).  Paths
+    # are matched in order against the whole request path.
+    ROUTES = [
+        ('GET', '/identity/?', '_identity_versions', False),
+        ('GET', '/identity/v3/?', '_identity_version', False),
+        ('POST', '/identity/v3/auth/tokens', '_create_token', False),
+        ('GET', '/compute/?', '_compute_versions', False),
+        ('GET', '/compute/v2.1/?', '_compute_version', False),
+        ('GET', '/compute/v2.1/servers(/detail)?', '_list_servers', True),
+        ('GET', '/compute/v2.1/servers/(?P<server>[^/]+)', '_get_server',
+         True),
+        ('GET', '/compute/v2.1/servers/(?P<server>[^/]+)/ips', '_server_ips',
+         True),
+        ('POST', '/compute/v2.1/servers/(?P<server>[^/]+)/action',
+         '_server_action', True),
+        ('PUT', '/compute/v2.1/servers/(?P<server>[^/]+)/metadata/'
+         '(?P<key>[^/]+)', '_set_metadata', True),
+        ('GET', '/compute/v2.1/flavors/(?P<flavor>[^/]+)', '_get_flavor',
+         True),
+        ('GET', '/network/?', '_network_versions', False),
+        ('GET', '/network/v2.0/ports(.json)?', '_list_ports', True),
+        ('GET', '/network/v2.0/subnets(.json)?', '_list_subnets', True),
+        ('GET', '/image/?', '_image_versions', False),
+        ('GET', '/image/v2/schemas/image', '_image_schema', False),
+        ('GET', '/image/v2/images/(?P<image>[^/]+)', '_get_image', True),
+        ('GET', '/volume/v3/[^/]+/volumes/(?P<volume>[^/]+)', '_get_volume',
+         True),
+        ('POST', '/orchestration/v1/[^/]+/stacks', '_create_stack', True),
+        ('GET', '/orchestration/v1/[^/]+/stacks/(?P<stack>[^/]+)'
+         '(/[^/]+)?/events', '_list_events', True),
+        ('GET', '/orchestration/v1/[^/]+/stacks/(?P<stack>[^/]+)(/[^/]+)?',
+         '_get_stack', True),
+    ]
+
+    def __init__(self, latency=0, jitter=0, error_rate=0, error_code=503,
+                 transition_time=0, stack_create_time=0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.stack_create_time = stack_create_time
+        # Latency is added per HTTP request, so not by the compute fake too
+        self.compute = FakeCompute(transition_time=transition_time)
+        self.project_id = uuid.uuid4().hex
+        self.base_url = 'http://127.0.0.1'
+        self.flavors = collections.OrderedDict()
+        self.images = collections.OrderedDict()
+        self.networks = collections.OrderedDict()
+        self.subnets = collections.OrderedDict()
+        self.ports = collections.OrderedDict()
+        self.volumes = collections.OrderedDict()
+        self.stacks = collections.OrderedDict()
+        self.calls = collections.Counter()
+        self._addresses = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._routes = [(method, re.compile(path + '$'), getattr(self, name),
+                         inject)
+                        for method, path, name, inject in self.ROUTES]
+
+    def add_flavor(self, name, vcpus, ram, disk):
+        flavor = {'id': uuid.uuid4().hex, 'name': name, 'vcpus': vcpus,
+                  'ram': ram, 'disk': disk}
+        self.flavors[flavor['id']] = flavor
+        return flavor
+
+    def add_image(self, name, **properties):
+        image = {'id': str(uuid.uuid4()), 'name': name, 'status': 'active'}
+        image.update(properties)
+        self.images[image['id']] = image
+        return image
+
+    def add_volume(self, size):
+        volume = {'id': str(uuid.uuid4()), 'size': size, 'status': 'in-use'}
+        self.volumes[volume['id']] = volume
+        return volume
+
+    def add_network(self, name, prefix):
+        """Add a network with a /16 subnet
+
+        :param prefix: The first two octets of the subnet, e.g. '10.0'.
+        """
+        network = {'id': str(uuid.uuid4()), 'name': name,
+                   'status': 'ACTIVE'}
+        subnet = {'id': str(uuid.uuid4()), 'name': name,
+                  'network_id': network['id'], 'ip_version': 4,
+                  'cidr': '%s.0.0/16' % prefix, '_prefix': prefix,
+                  '_next': 0}
+        network['subnets'] = [subnet['id']]
+        self.networks[network['id']] = network
+        self.subnets[subnet['id']] = subnet
+        return network
+
+    def add_port(self, name, network, server=None):
+        """Add a port on network, attached to server if one is given"""
+        subnet = self.subnets[network['subnets'][0]]
+        host = subnet['_next']
+        subnet['_next'] += 1
+        self._addresses += 1
+        port = {'id': str(uuid.uuid4()), 'name': name,
+                'network_id': network['id'],
+                'device_id': server.id if server is not None else '',
+                'mac_address': 'fa:16:3e:%02x:%02x:%02x' % (
+                    (self._addresses >> 16) & 0xff,
+                    (self._addresses >> 8) & 0xff, self._addresses & 0xff),
+                'fixed_ips': [{'subnet_id': subnet['id'],
+                               'ip_address': '%s.%d.%d' % (
+                                   subnet['_prefix'], host // 254 + 1,
+                                   host % 254 + 1)}],
+                'status': 'ACTIVE'}
+        self.ports[port['id']] = port
+        if server is not None:
+            server.addresses.setdefault(network['name'], []).append(
+                {'addr': port['fixed_ips'][0]['ip_address'],
+                 'version': 4,
+                 'OS-EXT-IPS:type': 'fixed',
+                 'OS-EXT-IPS-MAC:mac_addr': port['mac_address']})
+        return port
+
+    def populate(self, nodes, bmc_prefix='bmc', baremetal_prefix='baremetal',
+                 undercloud_name='undercloud', boot_from_volume=False):
+        """Create the resources of an OVB environment with nodes nodes
+
+        Names follow the templates in this repo, so the result can be used
+        with build-nodes-json.
+        """
+        flavor = {'id': self.add_flavor('baremetal', 1, 4096, 40)['id']}
+        image = {'id': self.add_image('ipxe-boot')['id']}
+        private = self.add_network('private', '10.0')
+        provision = self.add_network('provision', '10.1')
+        bmc = self.compute.add_server(bmc_prefix, flavor=flavor, image=image)
+        # The utility port of the bmc is unnamed, so it is not mistaken for
+        # the port of a node
+        self.add_port('', private, bmc)
+        for i in range(nodes):
+            name = '%s_%d' % (baremetal_prefix, i)
+            if boot_from_volume:
+                server = self.compute.add_server(
+                    name, status='SHUTOFF', flavor=flavor,
+                    volumes=[self.add_volume(40)['id']])
+            else:
+                server = self.compute.add_server(name, status='SHUTOFF',
+                                                 flavor=flavor, image=image)
+            self.add_port('%s_%d' % (bmc_prefix, i), private, bmc)
+            self.add_port(name, provision, server)
+        if undercloud_name:
+            undercloud = self.compute.add_server(undercloud_name,
+                                                 flavor=flavor, image=image)
+            self.add_port(undercloud_name, private, undercloud)
+            self.add_port(undercloud_name + '_provision', provision,
+                          undercloud)
+
+    def clouds_yaml(self, name='fakecloud'):
+        """Return a clouds.yaml entry for this cloud as a dict"""
+        return {'clouds': {name: {
+            'auth': {'auth_url': self.base_url + '/identity/v3',
+                     'username': 'admin',
+                     'password': 'password',
+                     'project_name': 'admin',
+                     'user_domain_name': 'Default',
+                     'project_domain_name': 'Default'},
+            'identity_api_version': 3,
+            'region_name': 'RegionOne'}}}
+
+    def request(self, operation, inject=True):
+        """Count a request and simulate the latency and errors of the cloud
+
+        Returns an error status code to fail the request with, or None.
+        """
+        with self._lock:
+            self.calls[operation] += 1
+            if not inject:
+                return None
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            fail = self._random.random() < self.error_rate
+        if delay > 0:
+            time.sleep(delay)
+        if fail:
+            return self.error_code
+        return None
+
+    def handle(self, method, path, query=None, body=None):
+        """Handle an API request
+
+        :param query: A dict of the query parameters.
+        :param body: The decoded JSON body of the request, if any.
+        :returns: A (status, body, headers) tuple.
+        """
+        for route_method, pattern, handler, inject in self._routes:
+            match = pattern.match(path)
+            if route_method != method or match is None:
+                continue
+            operation = handler.__name__.lstrip('_')
+            error = self.request(operation, inject)
+            if error is not None:
+                return self._error(error, 'Injected failure of %s' %
+                                   operation)
+            try:
+                result = handler(query or {}, body, **match.groupdict())
+            except exceptions.ClientException as e:
+                return self._error(e.code, e.message)
+            if len(result) == 2:
+                result += ({},)
+            return result
+        return self._error(404, 'No fake for %s %s' % (method, path))
+
+    @staticmethod
+    def _error(code, message):
+        return code, {'error': {'code': code, 'message': message}}, {}
+
+    @staticmethod
+    def _not_found(kind, id):
+        return exceptions.NotFound(404, message='%s %s could not be found.' %
+                                   (kind, id))
+
+    @staticmethod
+    def _public(resource):
+        """Strip the fake's bookkeeping from a resource"""
+        return dict((k, v) for k, v in resource.items()
+                    if not k.startswith('_'))
+
+    def _filter(self, resources, query):
+        """Return the resources matching every query parameter"""
+        matched = []
+        for resource in resources:
+            if all(str(resource.get(k)) == v for k, v in query.items()
+                   if k in resource):
+                matched.append(self._public(resource))
+        return matched
+
+    def _version(self, id, path, status='CURRENT'):
+        return {'id': id, 'status': status,
+                'links': [{'rel': 'self',
+                           'href': '%s/%s/' % (self.base_url, path)}]}
+
+    # Keystone
+
+    def _identity_versions(self, query, body):
+        return 300, {'versions': {'values': [
+            self._version('v3.14', 'identity/v3', 'stable')]}}
+
+    def _identity_version(self, query, body):
+        return 200, {'version': self._version('v3.14', 'identity/v3',
+                                              'stable')}
+
+    def _create_token(self, query, body):
+        project = {'id': self.project_id, 'name': 'admin',
+                   'domain': {'id': 'default', 'name': 'Default'}}
+        catalog = []
+        for service_type, path in [
+                ('identity', 'identity/v3'),
+                ('compute', 'compute/v2.1'),
+                ('network', 'network'),
+                ('image', 'image'),
+                ('volumev3', 'volume/v3/%s' % self.project_id),
+                ('block-storage', 'volume/v3/%s' % self.project_id),
+                ('orchestration', 'orchestration/v1/%s' % self.project_id)]:
+            catalog.append({
+                'id': uuid.uuid4().hex,
+                'type': service_type,
+                'name': service_type,
+                'endpoints': [{'id': uuid.uuid4().hex,
+                               'interface': interface,
+                               'region': 'RegionOne',
+                               'region_id': 'RegionOne',
+                               'url': '%s/%s' % (self.base_url, path)}
+                              for interface in ('public', 'internal',
+                                                'admin')]})
+        token = {'methods': ['password'],
+                 'expires_at': '2099-01-01T00:00:00.000000Z',
+                 'issued_at': '2000-01-01T00:00:00.000000Z',
+                 'user': {'id': 'admin', 'name': 'admin',
+                          'domain': {'id': 'default', 'name': 'Default'}},
+                 'project': project,
+                 'roles': [{'id': 'admin', 'name': 'admin'}],
+                 'catalog': catalog}
+        return 201, {'token': token}, {'X-Subject-Token': uuid.uuid4().hex}
+
+    # Nova
+
+    def _compute_versions(self, query, body):
+        return 300, {'versions': [self._version('v2.1', 'compute/v2.1')]}
+
+    def _compute_version(self, query, body):
+        version = self._version('v2.1', 'compute/v2.1')
+        version.update({'version': '2.1', 'min_version': '2.1'})
+        return 200, {'version': version}
+
+    def _list_servers(self, query, body):
+        search_opts = {}
+        if 'name' in query:
+            search_opts['name'] = query['name']
+        limit = query.get('limit')
+        servers = self.compute.servers.list(
+            search_opts=search_opts, marker=query.get('marker'),
+            limit=int(limit) if limit else None)
+        return 200, {'servers': [s.to_dict() for s in servers]}
+
+    def _get_server(self, query, body, server):
+        return 200, {'server': self.compute.servers.get(server).to_dict()}
+
+    def _server_ips(self, query, body, server):
+        server = self.compute.servers.get(server)
+        return 200, {'addresses': server.addresses}
+
+    def _server_action(self, query, body, server):
+        if 'os-start' in body:
+            self.compute.servers.start(server)
+        elif 'os-stop' in body:
+            self.compute.servers.stop(server)
+        elif 'reboot' in body:
+            self.compute.servers.reboot(server, body['reboot']['type'])
+        else:
+            return self._error(400, 'Unsupported action %s' % list(body))
+        return 202, None
+
+    def _set_metadata(self, query, body, server, key):
+        self.compute.servers.set_meta_item(server, key, body['meta'][key])
+        return 200, {'meta': {key: body['meta'][key]}}
+
+    def _get_flavor(self, query, body, flavor):
+        if flavor not in self.flavors:
+            raise self._not_found('Flavor', flavor)
+        return 200, {'flavor': self.flavors[flavor]}
+
+    # Neutron
+
+    def _network_versions(self, query, body):
+        return 200, {'versions': [self._version('v2.0', 'network/v2.0')]}
+
+    def _list_ports(self, query, body):
+        return 200, {'ports': self._filter(self.ports.values(), query)}
+
+    def _list_subnets(self, query, body):
+        return 200, {'subnets': self._filter(self.subnets.values(), query)}
+
+    # Glance
+
+    def _image_versions(self, query, body):
+        return 300, {'versions': [self._version('v2.6', 'image/v2')]}
+
+    def _image_schema(self, query, body):
+        return 200, {'name': 'image',
+                     'properties': {'id': {'type': 'string'},
+                                    'name': {'type': ['null', 'string']},
+                                    'status': {'type': 'string'}},
+                     'additionalProperties': {'type': 'string'},
+                     'links': []}
+
+    def _get_image(self, query, body, image):
+        if image not in self.images:
+            raise self._not_found('Image', image)
+        return 200, self.images[image]
+
+    # Cinder
+
+    def _get_volume(self, query, body, volume):
+        if volume not in self.volumes:
+            raise self._not_found('Volume', volume)
+        return 200, {'volume': self.volumes[volume]}
+
+    # Heat
+
+    def _find_stack(self, stack):
+        for s in self.stacks.values():
+            if stack in (s['id'], s['stack_name']):
+                return s
+        raise self._not_found('Stack', stack)
+
+    def _settle_stack(self, stack):
+        if (stack['stack_status'] == 'CREATE_IN_PROGRESS' and
+                time.time() >= stack['_complete_time']):
+            stack['stack_status'] = 'CREATE_COMPLETE'
+            stack['stack_status_reason'] = ('Stack CREATE completed '
+                                            'successfully')
+            stack['_events'].append(self._event(stack, 'CREATE_COMPLETE'))
+
+    def _event(self, stack, status):
+        return {'id': str(uuid.uuid4()),
+                'resource_name': stack['stack_name'],
+                'logical_resource_id': stack['stack_name'],
+                'physical_resource_id': stack['id'],
+                'resource_status': status,
+                'resource_status_reason': 'Stack %s' % status,
+                'event_time': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                            time.gmtime()),
+                'links': []}
+
+    def _create_stack(self, query, body):
+        stack = {'id': str(uuid.uuid4()),
+                 'stack_name': body['stack_name'],
+                 'stack_status': 'CREATE_IN_PROGRESS',
+                 'stack_status_reason': 'Stack CREATE started',
+                 'creation_time': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                                time.gmtime()),
+                 'parameters': body.get('parameters', {}),
+                 'outputs': [],
+                 'links': [],
+                 '_complete_time': time.time() + self.stack_create_time,
+                 '_events': []}
+        with self._lock:
+            if any(s['stack_name'] == stack['stack_name']
+                   for s in self.stacks.values()):
+                raise exceptions.Conflict(
+                    409, message='The Stack (%s) already exists.' %
+                    stack['stack_name'])
+            stack['_events'].append(self._event(stack, 'CREATE_IN_PROGRESS'))
+            self.stacks[stack['id']] = stack
+            self._settle_stack(stack)
+        return 201, {'stack': {'id': stack['id'], 'links': []}}
+
+    def _get_stack(self, query, body, stack):
+        with self._lock:
+            stack = self._find_stack(stack)
+            self._settle_stack(stack)
+            return 200, {'stack': self._public(stack)}
+
+    def _list_events(self, query, body, stack):
+        with self._lock:
+            stack = self._find_stack(stack)
+            self._settle_stack(stack)
+            return 200, {'events': list(stack['_events'])}
+
+
+class _FakeCloudHandler(BaseHTTPRequestHandler):
+    def _handle(self):
+        url = urlparse(self.path)
+        body = None
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = json.loads(self.rfile.read(length).decode('utf-8'))
+        status, body, headers = self.server.cloud.handle(
+            self.command, url.path.rstrip('/') or '/',
+            dict(parse_qsl(url.query)), body)
+        data = b''
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class FakeCloudServer(ThreadingMixIn, HTTPServer):
+    """Serve a FakeCloud over HTTP
+
+    Use port 0 to listen on any free port.  The cloud's base_url is set to
+    the address actually listened on.
+    """
+    daemon_threads = True
+
+    def __init__(self, cloud, address='127.0.0.1', port=0, verbose=False):
+        HTTPServer.__init__(self, (address, port), _FakeCloudHandler)
+        self.cloud = cloud
+        self.verbose = verbose
+        cloud.base_url = 'http://%s:%d' % (address, self.server_address[1])
+
+    def start(self):
+        """Serve requests from a background thread"""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='fakecloud',
+        description='Serve a fake host cloud for offline testing',
+    )
+    parser.add_argument('--address',
+                        default='127.0.0.1',
+                        help='Address to listen on; defaults to 127.0.0.1')
+    parser.add_argument('--port',
+                        type=int,
+                        default=5050,
+                        help='Port to listen on; defaults to 5050')
+    parser.add_argument('--nodes',
+                        type=int,
+                        default=0,
+                        help='Create an OVB environment with this many '
+                             'baremetal nodes; defaults to 0')
+    parser.add_argument('--boot-from-volume',
+                        action='store_true',
+                        help='Boot the baremetal nodes from volumes')
+    parser.add_argument('--latency',
+                        type=float,
+                        default=0,
+                        help='Seconds each API request takes; defaults to 0')
+    parser.add_argument('--jitter',
+                        type=float,
+                        default=0,
+                        help='Up to this many extra seconds are added at '
+                             'random to each API request; defaults to 0')
+    parser.add_argument('--error-rate',
+                        type=float,
+                        default=0,
+                        help='Fraction of API requests to fail at random; '
+                             'defaults to 0')
+    parser.add_argument('--error-code',
+                        type=int,
+                        default=503,
+                        help='HTTP status of the failed requests; defaults '
+                             'to 503')
+    parser.add_argument('--transition-time',
+                        type=float,
+                        default=0,
+                        help='Seconds a server power operation takes; '
+                             'defaults to 0')
+    parser.add_argument('--stack-create-time',
+                        type=float,
+                        default=0,
+                        help='Seconds a stack create takes; defaults to 0')
+    parser.add_argument('--clouds-yaml',
+                        help='Write a clouds.yaml for the fake cloud, named '
+                             'fakecloud, to this file')
+    parser.add_argument('--verbose',
+                        action='store_true',
+                        help='Log every request')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    cloud = FakeCloud(latency=args.latency, jitter=args.jitter,
+                      error_rate=args.error_rate, error_code=args.error_code,
+                      transition_time=args.transition_time,
+                      stack_create_time=args.stack_create_time)
+    server = FakeCloudServer(cloud, args.address, args.port, args.verbose)
+    if args.nodes:
+        cloud.populate(args.nodes, boot_from_volume=args.boot_from_volume)
+    clouds = yaml.safe_dump(cloud.clouds_yaml(), default_flow_style=False)
+    if args.clouds_yaml:
+        with open(args.clouds_yaml, 'w') as f:
+            f.write(clouds)
+        print('Wrote clouds.yaml to %s' % args.clouds_yaml)
+    else:
+        print(clouds)
+    print('Serving fake cloud on %s' % cloud.base_url)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
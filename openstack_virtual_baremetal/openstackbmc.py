@@ -24,66 +24,1769 @@
 # ipmitool -I lanplus -U admin -P password -H 127.0.0.1 mc reset cold
 
 import argparse
+import atexit
+import collections
+import contextlib
+import copy
+import cProfile
+import fcntl
+import importlib
+import json
+import mmap
+import multiprocessing
 import os
+import random
+import select
+import signal
+import socket
+import struct
+import subprocess
 import sys
+import threading
 import time
+import zlib
 
-from novaclient import exceptions
-import os_client_config
 import pyghmi.ipmi.bmc as bmc
+from pyghmi.ipmi.private import session as ipmisession
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class LazyProxy(object):
+    """Create an object the first time one of its attributes is used
+
+    Importing the OpenStack client libraries, and loading clouds.yaml, takes
+    longer than everything else the BMC does at startup.  Deferring them
+    lets the BMC start answering without waiting for them.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._target = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if self._target is None:
+            with self._lock:
+                if self._target is None:
+                    self._target = self._factory()
+        return getattr(self._target, name)
+
+
+# Only imported when they are first used.  See --measure-imports.
+DEFERRED_IMPORTS = ['novaclient.exceptions', 'os_client_config']
+exceptions = LazyProxy(
+    lambda: importlib.import_module('novaclient.exceptions'))
+os_client_config = LazyProxy(
+    lambda: importlib.import_module('os_client_config'))
+
+
+def _now():
+    """Return a monotonic timestamp where the platform provides one"""
+    return getattr(time, 'monotonic', time.time)()
+
+
+class LogWriter(object):
+    """Write log records to stdout
+
+    By default each record is written as plain text and flushed
+    immediately.  Records can instead be written as JSON objects, and can be
+    buffered and written by a background thread so logging never blocks the
+    IPMI handlers.  Repeated power state reports can also be rate limited so
+    that power sync storms do not flood the console.
+    """
+    QUEUE_SIZE = 10000
+    LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+
+    def __init__(self, stream=None):
+        self.stream = stream
+        self.json_format = False
+        self.status_interval = 0
+        self.level = 'info'
+        self._queue = None
+        self._dropped = 0
+        self._lock = threading.Lock()
+        # instance -> [last state, repeats since last record, window start]
+        self._status = {}
+
+    def configure(self, json_format=False, buffered=False,
+                  status_interval=0, level='info'):
+        """Change how records are written
+
+        :param json_format: Write each record as a JSON object.
+        :param buffered: Queue records and write them from a background
+                         thread.  If the queue is full records are dropped
+                         and a count of dropped records is logged later.
+        :param status_interval: If greater than 0, only log a power state
+                                report when the state changes, plus a
+                                summary of the repeated reports every
+                                status_interval seconds.
+        :param level: The lowest level of record to write.
+        """
+        self.json_format = json_format
+        self.status_interval = status_interval
+        self.level = level
+        if buffered and self._queue is None:
+            self._queue = queue.Queue(self.QUEUE_SIZE)
+            writer = threading.Thread(target=self._write_queued)
+            writer.daemon = True
+            writer.start()
+            atexit.register(self.flush)
+
+    def _format(self, message, level, fields):
+        if not self.json_format:
+            return message + '\n'
+        record = {'time': time.strftime('%Y-%m-%dT%H:%M:%S',
+                                        time.gmtime()),
+                  'level': level,
+                  'message': message}
+        record.update(fields)
+        return json.dumps(record, sort_keys=True) + '\n'
+
+    def _write(self, lines):
+        stream = self.stream or sys.stdout
+        stream.write(''.join(lines))
+        stream.flush()
+
+    def _write_queued(self):
+        while True:
+            lines = [self._queue.get()]
+            # Write everything that has accumulated with a single flush
+            try:
+                while len(lines) < 1000:
+                    lines.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            self._write(lines)
+            for line in lines:
+                self._queue.task_done()
+
+    def write(self, message, level='info', **fields):
+        if self.LEVELS[level] < self.LEVELS[self.level]:
+            return
+        line = self._format(message, level, fields)
+        if self._queue is None:
+            self._write([line])
+            return
+        with self._lock:
+            dropped, self._dropped = self._dropped, 0
+        if dropped:
+            self._put(self._format('Dropped %d log records' % dropped,
+                                   'warning', {'dropped': dropped}))
+        self._put(line)
+
+    def _put(self, line):
+        try:
+            self._queue.put_nowait(line)
+        except queue.Full:
+            with self._lock:
+                self._dropped += 1
+
+    def flush(self):
+        """Wait for any buffered records to be written"""
+        if self._queue is not None:
+            self._queue.join()
+
+    def status(self, instance, state):
+        """Log a power state report for instance, subject to rate limiting"""
+        message = 'Reporting power state "%s" for instance %s' % (state,
+                                                                  instance)
+        if self.status_interval <= 0:
+            self.write(message, instance=instance, power_state=state)
+            return
+        now = _now()
+        summary = None
+        with self._lock:
+            last = self._status.get(instance)
+            changed = last is None or last[0] != state
+            if not changed:
+                last[1] += 1
+            if last is not None and last[1] and (
+                    changed or now - last[2] >= self.status_interval):
+                summary = (last[0], last[1], now - last[2])
+            if changed or summary:
+                self._status[instance] = [state, 0, now]
+        if summary:
+            self.write('Reported power state "%s" for instance %s %d times '
+                       'in the last %d seconds' %
+                       (summary[0], instance, summary[1], summary[2]),
+                       instance=instance, power_state=summary[0],
+                       count=summary[1])
+        if changed:
+            self.write(message, instance=instance, power_state=state)
+
+
+log_writer = LogWriter()
+
+
+def log(*msg, **fields):
+    """Helper function that logs msg
+
+    :param level: The severity of the message.  Defaults to info.
+    Any other keyword arguments are included in JSON formatted records.
+    """
+    log_writer.write(' '.join(msg), **fields)
+
+
+class Metrics(object):
+    """Counters, gauges and histograms exposed in Prometheus text format"""
+    LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+                       2.5, 5, 10)
+    DEFINITIONS = {
+        'openstackbmc_ipmi_commands_total':
+            ('counter', 'IPMI commands handled, by command'),
+        'openstackbmc_ipmi_command_duration_seconds':
+            ('histogram', 'Time taken to handle IPMI commands, by command'),
+        'openstackbmc_nova_calls_total':
+            ('counter', 'Nova API calls made, by operation'),
+        'openstackbmc_nova_errors_total':
+            ('counter', 'Nova API calls that raised an exception, by '
+                        'operation'),
+        'openstackbmc_nova_call_duration_seconds':
+            ('histogram', 'Latency of Nova API calls, by operation'),
+        'openstackbmc_cache_hits_total':
+            ('counter', 'Lookups answered from the cache, by cache'),
+        'openstackbmc_cache_misses_total':
+            ('counter', 'Lookups that had to query Nova, by cache'),
+        'openstackbmc_power_conflicts_total':
+            ('counter', 'Conflict errors from Nova ignored by power commands, '
+                        'by command'),
+        'openstackbmc_rate_limited_total':
+            ('counter', 'Nova API calls delayed by the rate limit, by '
+                        'priority'),
+        'openstackbmc_notifications_total':
+            ('counter', 'Nova notifications applied to the status table, by '
+                        'event type'),
+        'openstackbmc_power_state':
+            ('gauge', 'Last reported power state of each instance, 1 for on '
+                      'and 0 for off'),
+        'openstackbmc_worker_restarts_total':
+            ('counter', 'Worker processes restarted by the supervisor, by '
+                        'worker'),
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._values.get(key)
+            if histogram is None:
+                # One count per bucket, then the sum and count
+                histogram = [0] * (len(self.LATENCY_BUCKETS) + 2)
+                self._values[key] = histogram
+            for i, bound in enumerate(self.LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def snapshot(self):
+        """Return a copy of every value, to be merged into other Metrics"""
+        with self._lock:
+            return dict((k, list(v) if isinstance(v, list) else v)
+                        for k, v in self._values.items())
+
+    def merge(self, values, gauges=True):
+        """Add the values from another snapshot() to these
+
+        Counters and histograms are summed.  Gauges are copied, unless gauges
+        is False.
+        """
+        with self._lock:
+            for key, value in values.items():
+                if self.DEFINITIONS[key[0]][0] == 'gauge':
+                    if gauges:
+                        self._values[key] = value
+                elif isinstance(value, list):
+                    current = self._values.get(key) or [0] * len(value)
+                    self._values[key] = [a + b for a, b in zip(current, value)]
+                else:
+                    self._values[key] = self._values.get(key, 0) + value
+
+    def counters(self):
+        """Return the value of every counter, keyed by name and labels"""
+        return dict((name + self._format_labels(labels), value)
+                    for (name, labels), value in self.snapshot().items()
+                    if self.DEFINITIONS[name][0] == 'counter')
+
+    def get(self, name, **labels):
+        """Return the current value of a counter or gauge, or 0"""
+        with self._lock:
+            return self._values.get(self._key(name, labels), 0)
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % label for label in labels)
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format"""
+        with self._lock:
+            values = sorted((k, list(v) if isinstance(v, list) else v)
+                            for k, v in self._values.items())
+        lines = []
+        for name in sorted(self.DEFINITIONS):
+            metric_type, description = self.DEFINITIONS[name]
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for (key_name, labels), value in values:
+                if key_name != name:
+                    continue
+                if metric_type != 'histogram':
+                    lines.append('%s%s %s' %
+                                 (name, self._format_labels(labels), value))
+                    continue
+                bounds = [repr(float(b)) for b in self.LATENCY_BUCKETS]
+                for bound, count in zip(bounds + ['+Inf'],
+                                        value[:-2] + [value[-1]]):
+                    lines.append('%s_bucket%s %s' % (
+                        name, self._format_labels(labels, [('le', bound)]),
+                        count))
+                lines.append('%s_sum%s %s' %
+                             (name, self._format_labels(labels), value[-2]))
+                lines.append('%s_count%s %s' %
+                             (name, self._format_labels(labels), value[-1]))
+        return '\n'.join(lines) + '\n'
+
+
+# Collected by every BMC in the process, and served by the metrics endpoint
+# when one is enabled.
+metrics = Metrics()
+
+
+class RateLimiter(object):
+    """Token bucket shared by every Nova call made by the process
+
+    Tokens are added at rate per second, up to burst.  Calls that change an
+    instance are served before any waiting reads and may use every token,
+    while reads leave reserve tokens for them.  A rate of 0 disables the
+    limit.
+    """
+    WRITE = 'write'
+    READ = 'read'
+    WRITE_OPERATIONS = frozenset(['start', 'stop', 'reboot',
+                                  'set_meta_item'])
+
+    def __init__(self):
+        self.rate = 0
+        self.burst = 0
+        self.reserve = 0
+        self._tokens = 0
+        self._updated = _now()
+        self._waiting_writes = 0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+    def configure(self, rate, burst=None, reserve=None):
+        """Change the limit
+
+        :param rate: Calls per second.
+        :param burst: Most calls that can be made at once.  Defaults to rate.
+                      Never less than 1, or no call could ever be made.
+        :param reserve: Tokens that reads leave for writes.  Defaults to a
+                        quarter of burst.  Never more than burst - 1, or the
+                        bucket could never hold enough tokens for a read.
+        """
+        with self._cond:
+            self.rate = rate
+            self.burst = max(burst or rate, 1)
+            if reserve is None:
+                reserve = self.burst / 4.0
+            self.reserve = min(reserve, self.burst - 1)
+            self._tokens = self.burst
+            self._updated = _now()
+
+    def priority(self, operation):
+        """Return the priority of a call to operation from this thread"""
+        if (operation in self.WRITE_OPERATIONS or
+                getattr(self._local, 'urgent', False)):
+            return self.WRITE
+        return self.READ
+
+    @contextlib.contextmanager
+    def urgent(self):
+        """Give write priority to the calls made by this thread in the block
+
+        Power commands read the instance status before changing it, and
+        those reads should not wait behind status queries.
+        """
+        previous = getattr(self._local, 'urgent', False)
+        self._local.urgent = True
+        try:
+            yield
+        finally:
+            self._local.urgent = previous
+
+    def _shortfall(self, priority):
+        """Return the tokens missing before a call of priority can be made
+
+        Call with _cond held.
+        """
+        now = _now()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if priority == self.WRITE:
+            return max(1 - self._tokens, 0)
+        shortfall = max(self.reserve + 1 - self._tokens, 0)
+        if self._waiting_writes:
+            # Let the writes go first
+            shortfall = max(shortfall, 1)
+        return shortfall
+
+    def ready(self, priority):
+        """Return True if a call of priority could be made without waiting"""
+        if self.rate <= 0:
+            return True
+        with self._cond:
+            return not self._shortfall(priority)
+
+    def acquire(self, priority):
+        """Wait until a call of priority may be made, and take its token"""
+        if self.rate <= 0:
+            return
+        with self._cond:
+            if priority == self.WRITE:
+                self._waiting_writes += 1
+            try:
+                shortfall = self._shortfall(priority)
+                if shortfall:
+                    metrics.inc('openstackbmc_rate_limited_total',
+                                priority=priority)
+                while shortfall:
+                    self._cond.wait(max(shortfall / self.rate, 0.001))
+                    shortfall = self._shortfall(priority)
+                self._tokens -= 1
+            finally:
+                if priority == self.WRITE:
+                    self._waiting_writes -= 1
+
+
+# Limits the rate of Nova calls made by every BMC in the process.  Unlimited
+# unless configured.
+rate_limiter = RateLimiter()
+
+
+# The power, boot device and status operations of the BMCs all go through a
+# compute backend, which is a novaclient Client by default.  Any object can
+# be used as the backend if its servers attribute provides get, list, start,
+# stop, reboot and set_meta_item like novaclient's, returns servers with
+# id, name, status, metadata and OS-EXT-STS:task_state attributes, and
+# raises novaclient's NotFound and Conflict exceptions where Nova would.
+# fakecloud.FakeCompute is such a backend that simulates the instances in
+# memory.  See --backend.
+def _nova_call(operation, func, *args, **kwargs):
+    """Call func, recording it in the Nova API metrics as operation
+
+    Waits first if the call would exceed the rate limit.
+    """
+    rate_limiter.acquire(rate_limiter.priority(operation))
+    start = _now()
+    metrics.inc('openstackbmc_nova_calls_total', operation=operation)
+    try:
+        return func(*args, **kwargs)
+    except Exception:
+        metrics.inc('openstackbmc_nova_errors_total', operation=operation)
+        raise
+    finally:
+        metrics.observe('openstackbmc_nova_call_duration_seconds',
+                        _now() - start, operation=operation)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type',
+                         'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would otherwise be printed to the console
+        pass
+
+
+def start_metrics_server(address, port, render=None):
+    """Serve the metrics over HTTP from a background thread
+
+    :param render: Called for the text of each scrape.  Defaults to
+                   rendering the metrics of this process.
+    """
+    class MetricsServer(HTTPServer):
+        address_family = (socket.AF_INET6 if ':' in address
+                          else socket.AF_INET)
+
+    server = MetricsServer((address, port), _MetricsHandler)
+    server.render = render or metrics.render
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class CommandProfiler(object):
+    """cProfile data collected separately for each kind of IPMI command
+
+    The profiles are written to DIRECTORY/COMMAND.pstats, which can be read
+    with the pstats module, every interval seconds and whenever a dump is
+    requested.  Profiles are only enabled and written from the thread
+    handling IPMI requests, between commands, so a dump never interrupts a
+    profile that is being collected.  Disabled unless configured.
+    """
+    def __init__(self):
+        self.directory = None
+        self.interval = 0
+        self._profiles = {}
+        self._next_dump = None
+        self._dump_requested = False
+
+    def configure(self, directory, interval=0):
+        """Profile commands into directory, dumping every interval seconds
+
+        An interval of 0 only dumps when requested.
+        """
+        self.directory = directory
+        self.interval = interval
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if interval > 0:
+            self._next_dump = _now() + interval
+
+    def request_dump(self):
+        """Dump the profiles once the current command has been handled
+
+        Safe to call from a signal handler.
+        """
+        self._dump_requested = True
+
+    @contextlib.contextmanager
+    def profile(self, name):
+        """Add the time spent in the block to the profile for name"""
+        if self.directory is None:
+            yield
+            return
+        profile = self._profiles.get(name)
+        if profile is None:
+            profile = self._profiles[name] = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            if self._dump_requested or (self._next_dump is not None and
+                                        _now() >= self._next_dump):
+                self.dump()
+
+    def dump(self):
+        """Write every profile collected so far"""
+        self._dump_requested = False
+        if self.interval > 0:
+            self._next_dump = _now() + self.interval
+        for name, profile in list(self._profiles.items()):
+            path = os.path.join(self.directory, '%s.pstats' % name)
+            tmp_path = '%s.tmp' % path
+            profile.dump_stats(tmp_path)
+            os.rename(tmp_path, path)
+        log('Wrote profiles of %d commands to %s' %
+            (len(self._profiles), self.directory))
+
+
+# Profiles the IPMI commands handled by every BMC in the process
+profiler = CommandProfiler()
+
+
+def sd_notify(state):
+    """Send a notification to systemd, if it is listening for them
+
+    Returns True if the notification was sent.  The protocol is simple
+    enough that it is not worth a dependency on python-systemd.
+    """
+    path = os.environ.get('NOTIFY_SOCKET')
+    if not path:
+        return False
+    if path.startswith('@'):
+        # An abstract socket
+        path = '\0' + path[1:]
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.connect(path)
+        sock.sendall(state.encode('utf-8'))
+    except socket.error as e:
+        log('Failed to notify systemd: %s' % e, level='warning')
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+class Watchdog(object):
+    """Keep systemd's watchdog fed while the IPMI event loop is running
+
+    The event loop calls feed() every time it runs, so a BMC that stops
+    handling packets stops feeding the watchdog and is restarted.
+    """
+
+    def __init__(self):
+        # Seconds between notifications, or 0 if there is no watchdog
+        self.interval = 0
+        self._next_feed = 0
+
+    def configure(self):
+        """Enable the watchdog if systemd asked this process for one"""
+        usec = os.environ.get('WATCHDOG_USEC')
+        pid = os.environ.get('WATCHDOG_PID')
+        if not usec or (pid and int(pid) != os.getpid()):
+            return
+        # Notify twice per timeout, as sd_watchdog_enabled(3) recommends
+        self.interval = int(usec) / 2000000.0
+
+    def feed(self):
+        if self.interval and _now() >= self._next_feed:
+            self._next_feed = _now() + self.interval
+            sd_notify('WATCHDOG=1')
+
+
+# Feeds systemd's watchdog from the event loop of every BMC in the process
+watchdog = Watchdog()
+
+
+# Names for the IPMI requests the BMC implements, keyed by netfn and command
+IPMI_COMMANDS = {
+    (6, 1): 'get_device_id',
+    (6, 2): 'cold_reset',
+    (6, 0x37): 'get_system_guid',
+    (0, 1): 'power_status',
+    (0, 2): 'chassis_control',
+    (0, 8): 'bootdev_set',
+    (0, 9): 'bootdev_get',
+}
+# Nova statuses in which the instance is powered on.  From the point of view
+# of its BMC, an instance that is being rebooted is still on.
+POWERED_ON_STATUSES = ('ACTIVE', 'REBOOT', 'HARD_REBOOT')
+CHASSIS_CONTROL_COMMANDS = ['power_off', 'power_on', 'power_cycle',
+                            'power_reset', 'pulse_diag', 'power_shutdown']
+
+
+def _ipmi_command_name(request):
+    """Return a short name describing an IPMI request"""
+    netfn, command = request['netfn'], request['command']
+    name = IPMI_COMMANDS.get((netfn, command))
+    if name == 'chassis_control' and request.get('data'):
+        directive = request['data'][0]
+        if directive < len(CHASSIS_CONTROL_COMMANDS):
+            name = CHASSIS_CONTROL_COMMANDS[directive]
+    if name is None:
+        name = 'netfn_%d_command_%d' % (netfn, command)
+    return name
+
+
+def _backoff(attempt, base=0.5, cap=30):
+    """Return an exponential retry delay with jitter for attempt
+
+    The jitter keeps many BMCs that started at the same time from retrying
+    against the host cloud in lockstep.
+    """
+    delay = min(cap, base * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+
+def _retry(func, description, timeout=None, logger=log, giveup=()):
+    """Call func until it succeeds or timeout seconds have passed
+
+    Failures are retried with an exponential backoff, and the process exits
+    if timeout expires.  A timeout of None or 0 retries indefinitely.
+
+    :param giveup: Exception types that are raised straight away rather than
+                   retried, because retrying would not help.
+    """
+    deadline = None
+    if timeout:
+        deadline = _now() + timeout
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except giveup:
+            raise
+        except Exception as e:
+            logger('Exception %s: %s' % (description, e), level='error')
+        if deadline is not None and _now() >= deadline:
+            logger('Timed out %s' % description, level='error')
+            sys.exit(1)
+        time.sleep(_backoff(attempt))
+        attempt += 1
+
+
+def load_state(path):
+    """Load the state saved by a previous run, or {} if there is none"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        log('Not using saved state from %s: %s' % (path, e), level='warning')
+        return {}
+
+
+def save_state(path, state):
+    """Atomically replace the saved state in path"""
+    tmp_path = '%s.tmp' % path
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.rename(tmp_path, path)
+
+
+def snapshot_state(bmcs, status_table):
+    """Return what bmcs know about their instances for saving
+
+    A BMC restarted from the result can answer straight away, and the values
+    are then refreshed like any other cached value.
+    """
+    boot_devices = {}
+    for mybmc in bmcs:
+        if mybmc.boot_device is not None:
+            boot_devices[mybmc.instance] = [mybmc.boot_device,
+                                            _now() - mybmc.boot_device_time]
+    managed = set(mybmc.instance for mybmc in bmcs)
+    statuses = dict((instance, entry) for instance, entry
+                    in status_table.snapshot().items() if instance in managed)
+    return {'saved': time.time(),
+            'statuses': statuses,
+            'boot_devices': boot_devices}
+
+
+def restore_state(state, bmcs, status_table):
+    """Load the statuses and boot devices saved by snapshot_state"""
+    elapsed = max(time.time() - state.get('saved', time.time()), 0)
+    managed = set(mybmc.instance for mybmc in bmcs)
+    status_table.restore(dict((instance, entry) for instance, entry
+                              in state.get('statuses', {}).items()
+                              if instance in managed), elapsed)
+    boot_devices = state.get('boot_devices', {})
+    for mybmc in bmcs:
+        if mybmc.boot_device is None and mybmc.instance in boot_devices:
+            bootdevice, age = boot_devices[mybmc.instance]
+            mybmc._cache_boot_device(bootdevice, age + elapsed)
+
+
+def _repeat(func, interval, description):
+    """Call func every interval seconds, logging any exceptions"""
+    while True:
+        time.sleep(interval)
+        try:
+            func()
+        except Exception as e:
+            log('Exception %s: %s' % (description, e), level='error')
+
+
+def resolve_instances(novaclient, instances):
+    """Resolve the uuids and names of instances with one servers.list call
+
+    :param instances: An iterable of instance uuids or names.
+    :returns: A dict mapping each entry of instances that matched exactly
+              one server to a (uuid, name) tuple.
+    """
+    by_id = {}
+    by_name = collections.defaultdict(list)
+    for server in _nova_call('list', novaclient.servers.list, limit=-1):
+        by_id[server.id] = server
+        by_name[server.name].append(server)
+    resolved = {}
+    for instance in instances:
+        server = by_id.get(instance)
+        if server is None and len(by_name.get(instance, ())) == 1:
+            server = by_name[instance][0]
+        if server is not None:
+            resolved[instance] = (server.id, server.name)
+    return resolved
+
+
+class StatusTable(object):
+    """Last known status of each managed instance
+
+    Shared by every BMC in the process and safe to update from background
+    threads.  Each entry records when it was last refreshed so callers can
+    decide whether it is still fresh enough to use.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._statuses = {}
+        self._refreshing = set()
+
+    def get(self, instance):
+        """Return the last known status of instance, or None"""
+        return self.lookup(instance)[0]
+
+    def lookup(self, instance):
+        """Return a (status, age in seconds) tuple for instance
+
+        Both values are None if the status of instance is not known.
+        """
+        with self._lock:
+            entry = self._statuses.get(instance)
+        if entry is None:
+            return None, None
+        return entry[0], _now() - entry[1]
+
+    def update(self, instance, status, timestamp=None):
+        if timestamp is None:
+            timestamp = _now()
+        with self._lock:
+            self._statuses[instance] = (status, timestamp)
+
+    def snapshot(self):
+        """Return {instance: [status, age in seconds]} for saving"""
+        now = _now()
+        with self._lock:
+            return dict((instance, [status, now - timestamp])
+                        for instance, (status, timestamp)
+                        in self._statuses.items())
+
+    def restore(self, snapshot, elapsed=0):
+        """Load the statuses returned by snapshot()
+
+        Statuses already in the table are newer, so they are kept.
+
+        :param elapsed: Seconds since the snapshot was taken, which are added
+                        to the age of every status.
+        """
+        now = _now()
+        with self._lock:
+            for instance, (status, age) in snapshot.items():
+                if instance not in self._statuses:
+                    self._statuses[instance] = (status, now - age - elapsed)
+
+    def invalidate(self, instance):
+        """Forget the status of instance so the next lookup misses"""
+        with self._lock:
+            self._statuses.pop(instance, None)
+
+    def start_refresh(self, instance):
+        """Claim the background refresh of instance
+
+        Returns False if a refresh of instance is already in progress.
+        """
+        with self._lock:
+            if instance in self._refreshing:
+                return False
+            self._refreshing.add(instance)
+            return True
+
+    def finish_refresh(self, instance):
+        with self._lock:
+            self._refreshing.discard(instance)
+
+
+class StatusPoller(threading.Thread):
+    """Fetch the status of all managed instances with one API call
+
+    Rather than each BMC asking Nova about its own instance, a single
+    servers.list call per interval refreshes the shared StatusTable for all
+    of them.
+    """
+    def __init__(self, novaclient, interval, table=None):
+        super(StatusPoller, self).__init__()
+        self.daemon = True
+        self.novaclient = novaclient
+        self.interval = interval
+        self.table = table if table is not None else StatusTable()
+        self.instances = set()
+
+    def add(self, instance):
+        """Include instance in subsequent polls"""
+        self.instances.add(instance)
+
+    def remove(self, instance):
+        """Leave instance out of subsequent polls"""
+        self.instances.discard(instance)
+
+    def poll(self):
+        """Refresh the status table from a single servers.list call"""
+        managed = frozenset(self.instances)
+        for server in _nova_call('list', self.novaclient.servers.list,
+                                 limit=-1):
+            if server.id in managed:
+                self.table.update(server.id, server.status)
+
+    def run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                log('Exception polling instance status: %s' % e,
+                    level='error')
+            time.sleep(self.interval)
+
+
+class SharedStatusFile(object):
+    """Instance statuses in a file mapped into memory by several processes
+
+    The file holds a fixed size record for each instance.  Every BMC process
+    claims a record for each instance it manages, and a single updater
+    process writes the status of every claimed instance into it.  Writers
+    take an flock on the file, while readers take no lock at all and instead
+    retry a record whose sequence number changed while they read it.
+
+    Timestamps are from time.time(), since the file can outlive the
+    processes and the monotonic clock.
+    """
+    MAGIC = b'OVBS'
+    VERSION = 1
+    CAPACITY = 4096
+    # Magic, version and capacity, padded to HEADER_SIZE
+    HEADER = struct.Struct('<4sII')
+    HEADER_SIZE = 16
+    # Sequence number, instance uuid, status and time of the last update.
+    # The sequence number is odd while the record is being written.
+    RECORD = struct.Struct('<I36s16sd')
+    SEQUENCE = struct.Struct('<I')
+    INSTANCE_LENGTH = 36
+    # A record still changing after this many reads was left half written
+    # by a writer that died, and is treated as free until it is rewritten
+    READ_ATTEMPTS = 100
+
+    def __init__(self, path, capacity=CAPACITY):
+        self.path = path
+        self.capacity = capacity
+        self.size = self.HEADER_SIZE + self.RECORD.size * capacity
+        self._lock = threading.Lock()
+        self._slots = {}
+        self._fd = None
+        self._map = None
+
+    def open(self):
+        """Map the file, creating it if it does not exist yet"""
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        header = self.HEADER.pack(self.MAGIC, self.VERSION, self.capacity)
+        with self._locked():
+            size = os.fstat(self._fd).st_size
+            if size < self.size:
+                # Only ever grow the file, since shrinking it under another
+                # process that has it mapped would crash that process
+                os.ftruncate(self._fd, self.size)
+            self._map = mmap.mmap(self._fd, self.size)
+            if self._map[:self.HEADER.size] != header:
+                if size:
+                    log('Reinitializing status table %s' % self.path,
+                        level='warning')
+                self._map[:self.size] = b'\0' * self.size
+                self._map[:self.HEADER.size] = header
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # flock does not exclude threads sharing the file descriptor
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _offset(self, slot):
+        return self.HEADER_SIZE + slot * self.RECORD.size
+
+    def _read(self, slot):
+        """Return the (instance, status, updated) tuple in slot"""
+        offset = self._offset(slot)
+        for attempt in range(self.READ_ATTEMPTS):
+            sequence = self.SEQUENCE.unpack_from(self._map, offset)[0]
+            record = self.RECORD.unpack_from(self._map, offset)
+            if (sequence % 2 == 0 and sequence ==
+                    self.SEQUENCE.unpack_from(self._map, offset)[0]):
+                break
+        else:
+            return '', '', 0
+        instance, status = [field.rstrip(b'\0').decode('ascii')
+                            for field in record[1:3]]
+        return instance, status, record[3]
+
+    def _write(self, slot, instance, status, updated):
+        """Replace the record in slot.  Call with the file locked."""
+        offset = self._offset(slot)
+        # Already odd if a previous writer died half way through
+        sequence = self.SEQUENCE.unpack_from(self._map, offset)[0] | 1
+        self.SEQUENCE.pack_into(self._map, offset, sequence)
+        self.RECORD.pack_into(self._map, offset, sequence,
+                              instance.encode('ascii'),
+                              status.encode('ascii'), updated)
+        self.SEQUENCE.pack_into(self._map, offset,
+                                (sequence + 1) & 0xffffffff)
+
+    def claim(self, instance):
+        """Ask the updater to keep the status of instance up to date
+
+        A record already claimed for instance, by this process before it was
+        restarted for example, is reused along with the status in it.
+        Returns False if instance could not be given a record.
+        """
+        if len(instance) > self.INSTANCE_LENGTH:
+            log('Instance %s is too long for the status table' % instance,
+                level='warning')
+            return False
+        with self._locked():
+            free = None
+            for slot in range(self.capacity):
+                claimed = self._read(slot)[0]
+                if claimed == instance:
+                    self._slots[instance] = slot
+                    return True
+                if not claimed and free is None:
+                    free = slot
+            if free is None:
+                log('Status table %s is full' % self.path, level='warning')
+                return False
+            self._write(free, instance, '', 0)
+            self._slots[instance] = free
+            return True
+
+    def release(self, instance):
+        """Free the record claimed for instance"""
+        with self._locked():
+            slot = self._slots.pop(instance, None)
+            if slot is not None and self._read(slot)[0] == instance:
+                self._write(slot, '', '', 0)
+
+    def read(self, instance):
+        """Return a (status, time.time() of the update) tuple for instance
+
+        Both values are None if instance has no record or the updater has
+        not written its status yet.
+        """
+        slot = self._slots.get(instance)
+        if slot is None:
+            return None, None
+        claimed, status, updated = self._read(slot)
+        if claimed != instance or not status:
+            return None, None
+        return status, updated
+
+    def instances(self):
+        """Return every claimed instance"""
+        return [instance for instance in
+                (self._read(slot)[0] for slot in range(self.capacity))
+                if instance]
+
+    def write(self, statuses):
+        """Record statuses, a dict of instances and their current status"""
+        now = time.time()
+        with self._locked():
+            for slot in range(self.capacity):
+                instance = self._read(slot)[0]
+                if instance in statuses:
+                    self._write(slot, instance, statuses[instance], now)
+
+
+class SharedStatusPoller(StatusPoller):
+    """Read the statuses an updater process writes to a SharedStatusFile
+
+    Takes the place of a StatusPoller in BMC processes that leave the Nova
+    calls to the updater, so that every BMC on the host benefits from the
+    same servers.list call.  Reading the file is cheap, so it is read much
+    more often than Nova would be polled.
+    """
+    INTERVAL = 1
+
+    def __init__(self, shared, interval, table=None):
+        super(SharedStatusPoller, self).__init__(None, interval, table)
+        self.shared = shared
+
+    def add(self, instance):
+        super(SharedStatusPoller, self).add(instance)
+        self.shared.claim(instance)
+
+    def remove(self, instance):
+        super(SharedStatusPoller, self).remove(instance)
+        self.shared.release(instance)
+
+    def poll(self):
+        """Copy any statuses newer than the ones in the table"""
+        now = _now()
+        wall = time.time()
+        for instance in list(self.instances):
+            status, updated = self.shared.read(instance)
+            if status is None:
+                continue
+            age = max(wall - updated, 0)
+            known_age = self.table.lookup(instance)[1]
+            if known_age is None or age < known_age:
+                self.table.update(instance, status, now - age)
+
+
+class StatusUpdater(StatusPoller):
+    """Write the status of every instance claimed in a SharedStatusFile
+
+    Makes one servers.list call per interval on behalf of all of the BMC
+    processes reading the file.
+    """
+    def __init__(self, novaclient, interval, shared):
+        super(StatusUpdater, self).__init__(novaclient, interval)
+        self.shared = shared
+
+    def poll(self):
+        managed = frozenset(self.shared.instances())
+        if not managed:
+            return
+        self.shared.write(dict(
+            (server.id, server.status) for server
+            in _nova_call('list', self.novaclient.servers.list, limit=-1)
+            if server.id in managed))
+
+
+class TransitionTracker(object):
+    """Follow instances through power transitions in Nova
+
+    After a power command an instance spends a while in a task state such
+    as powering-on.  Rather than each status query asking Nova whether the
+    transition has finished, a background thread polls the instance,
+    starting after interval seconds and backing off to MAX_INTERVAL, and
+    keeps the status table up to date until the task state clears.  The
+    number of Nova calls per transition therefore does not depend on how
+    often clients ask for the power state.
+    """
+    MAX_INTERVAL = 10
+    # Stop following an instance that has been transitioning for this long
+    TIMEOUT = 600
+
+    def __init__(self, novaclient, table, interval=1):
+        self.novaclient = novaclient
+        self.table = table
+        self.interval = interval
+        self._lock = threading.Condition()
+        # instance -> [next poll time, poll interval, give up time]
+        self._tracked = {}
+        self._thread = None
+
+    def track(self, instance):
+        """Follow instance until its current power transition completes"""
+        now = _now()
+        with self._lock:
+            self._tracked[instance] = [now + self.interval, self.interval,
+                                       now + self.TIMEOUT]
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._lock.notify()
+
+    def tracking(self, instance):
+        """Return True if instance is in a power transition"""
+        with self._lock:
+            return instance in self._tracked
+
+    def finish(self, instance):
+        """Stop following instance, whose transition is known to be over"""
+        self._advance(instance, True, _now())
+
+    def _advance(self, instance, done, now):
+        """Schedule the next poll of instance, or stop following it"""
+        with self._lock:
+            entry = self._tracked.get(instance)
+            if entry is None:
+                return
+            if done or now >= entry[2]:
+                del self._tracked[instance]
+            else:
+                entry[1] = min(entry[1] * 2, self.MAX_INTERVAL)
+                entry[0] = now + entry[1]
+
+    def _due(self):
+        """Wait for and return the instances that are due to be polled"""
+        with self._lock:
+            while True:
+                now = _now()
+                due = [i for i, e in self._tracked.items() if e[0] <= now]
+                if due:
+                    return due
+                timeout = None
+                if self._tracked:
+                    timeout = min(e[0] for e in self._tracked.values()) - now
+                self._lock.wait(timeout)
+
+    def poll(self, instances):
+        """Refresh the status of instances and schedule their next polls"""
+        if len(instances) == 1:
+            try:
+                servers = [_nova_call('get', self.novaclient.servers.get,
+                                      instances[0])]
+            except exceptions.NotFound:
+                servers = []
+        else:
+            wanted = frozenset(instances)
+            servers = [server for server in
+                       _nova_call('list', self.novaclient.servers.list,
+                                  limit=-1)
+                       if server.id in wanted]
+        now = _now()
+        seen = set()
+        for server in servers:
+            self.table.update(server.id, server.status)
+            task_state = getattr(server, 'OS-EXT-STS:task_state', None)
+            self._advance(server.id, task_state is None, now)
+            seen.add(server.id)
+        for instance in set(instances) - seen:
+            # No longer exists, so there is nothing left to follow
+            self._advance(instance, True, now)
+
+    def _run(self):
+        while True:
+            due = self._due()
+            try:
+                self.poll(due)
+            except Exception as e:
+                log('Exception tracking power transitions: %s' % e,
+                    level='error')
+                now = _now()
+                for instance in due:
+                    self._advance(instance, False, now)
+
+
+# The API status of an instance with each vm_state in Nova notifications
+VM_STATE_STATUSES = {
+    'active': 'ACTIVE',
+    'building': 'BUILD',
+    'deleted': 'DELETED',
+    'error': 'ERROR',
+    'paused': 'PAUSED',
+    'rescued': 'RESCUE',
+    'resized': 'VERIFY_RESIZE',
+    'shelved': 'SHELVED',
+    'shelved_offloaded': 'SHELVED_OFFLOADED',
+    'soft-delete': 'SOFT_DELETED',
+    'stopped': 'SHUTOFF',
+    'suspended': 'SUSPENDED',
+}
+# Task states that the API reports as a status of their own
+TASK_STATE_STATUSES = {
+    'rebooting': 'REBOOT',
+    'reboot_pending': 'REBOOT',
+    'reboot_started': 'REBOOT',
+    'rebooting_hard': 'HARD_REBOOT',
+    'reboot_pending_hard': 'HARD_REBOOT',
+    'reboot_started_hard': 'HARD_REBOOT',
+    'rebuilding': 'REBUILD',
+}
+
+
+class NotificationListener(threading.Thread):
+    """Update the status table from Nova versioned notifications
+
+    Notifications are read from a UNIX datagram socket, one JSON document
+    per datagram.  Both bare notifications and the envelope oslo.messaging
+    wraps them in are accepted, so a relay can forward messages from the
+    notification bus unchanged.  Every instance.* notification carries the
+    vm_state and task_state of the instance, which are translated into the
+    status the API would report.
+
+    Instances are not filtered, as an update for an instance no BMC manages
+    is harmless.  A notification that an instance is no longer in a task
+    state also ends any transition the tracker is following for it.
+    """
+    def __init__(self, path, table, tracker=None):
+        super(NotificationListener, self).__init__()
+        self.daemon = True
+        self.path = path
+        self.table = table
+        self.tracker = tracker
+        self.socket = None
+
+    def bind(self):
+        """Create the socket, replacing one left behind by a previous run"""
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(self.path)
+        # Notifications set the statuses reported to IPMI clients, so only
+        # the owner may send them
+        os.chmod(self.path, 0o600)
+
+    @staticmethod
+    def parse(message):
+        """Return (event type, instance, status, task state) from message
+
+        Returns None if message is not an instance notification.
+        """
+        notification = json.loads(message)
+        if 'oslo.message' in notification:
+            notification = json.loads(notification['oslo.message'])
+        event_type = notification.get('event_type', '')
+        payload = notification.get('payload') or {}
+        data = payload.get('nova_object.data', payload)
+        if (not event_type.startswith('instance.') or
+                not isinstance(data, dict) or 'uuid' not in data):
+            return None
+        task_state = data.get('task_state')
+        status = TASK_STATE_STATUSES.get(task_state)
+        if status is None or data.get('state') != 'active':
+            status = VM_STATE_STATUSES.get(data.get('state'))
+        if status is None:
+            return None
+        return event_type, data['uuid'], status, task_state
+
+    def handle(self, message):
+        """Apply one notification, returning True if it was used"""
+        parsed = self.parse(message)
+        if parsed is None:
+            return False
+        event_type, instance, status, task_state = parsed
+        self.table.update(instance, status)
+        if task_state is None and self.tracker is not None:
+            self.tracker.finish(instance)
+        metrics.inc('openstackbmc_notifications_total',
+                    event_type=event_type)
+        return True
+
+    def run(self):
+        while True:
+            message = self.socket.recv(65536)
+            try:
+                self.handle(message.decode('utf-8'))
+            except Exception as e:
+                log('Exception handling notification: %s' % e,
+                    level='error')
+
+
+class ControlServer(threading.Thread):
+    """Inspect and adjust the BMCs of this process while they run
+
+    Each connection to the UNIX stream socket sends a single command line
+    and gets back a JSON object, with an "error" key if the command failed.
+    The commands are:
+
+    dump [BMC]
+        The cached state of every BMC, or of one, and the counters of this
+        process.
+    flush BMC
+        Forget the cached status and boot device of BMC.
+    refresh BMC
+        Read the status and boot device of BMC from Nova.
+    ttl status|boot-device SECONDS
+        Change --cache-ttl or --boot-device-ttl for every BMC.
+    log-level debug|info|warning|error
+        Change the lowest level of message that is logged.
+
+    A BMC is named by its address or by the uuid or name of its instance.
+    """
+    TIMEOUT = 10
+    MAX_COMMAND = 4096
+    COMMANDS = {'dump': 'dump',
+                'flush': 'flush',
+                'refresh': 'refresh',
+                'ttl': 'ttl',
+                'log-level': 'log_level'}
+    TTLS = {'status': 'cache_ttl', 'boot-device': 'boot_device_ttl'}
+
+    def __init__(self, path, bmcs, args):
+        """
+        :param bmcs: The dict of addresses and running BMCs, which may change
+                     while the server runs.
+        :param args: The parsed options.  A changed TTL is stored in them so
+                     that BMCs started later use it too.
+        """
+        super(ControlServer, self).__init__()
+        self.daemon = True
+        self.path = path
+        self.bmcs = bmcs
+        self.args = args
+        self.socket = None
+
+    def bind(self):
+        """Create the socket, replacing one left behind by a previous run"""
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(self.path)
+        # Commands can make Nova calls, so only the owner may send them
+        os.chmod(self.path, 0o600)
+        self.socket.listen(5)
+
+    def _find(self, name):
+        for address, mybmc in list(self.bmcs.items()):
+            if name in (address, mybmc.instance, mybmc.instance_name):
+                return address, mybmc
+        raise ValueError('No BMC for %s' % name)
+
+    def dump(self, name=None):
+        if name is None:
+            running = sorted(list(self.bmcs.items()), key=lambda b: b[0])
+        else:
+            running = [self._find(name)]
+        bmcs = []
+        for address, mybmc in running:
+            state = mybmc.describe()
+            state['address'] = address
+            bmcs.append(state)
+        return {'bmcs': bmcs,
+                'counters': metrics.counters(),
+                'log_level': log_writer.level}
+
+    def flush(self, name):
+        address, mybmc = self._find(name)
+        mybmc.flush_cache()
+        return self.dump(address)
+
+    def refresh(self, name):
+        address, mybmc = self._find(name)
+        mybmc._fetch_status()
+        return self.dump(address)
+
+    def ttl(self, name, seconds):
+        if name not in self.TTLS:
+            raise ValueError('Unknown TTL %s' % name)
+        attribute = self.TTLS[name]
+        seconds = float(seconds)
+        setattr(self.args, attribute, seconds)
+        for mybmc in list(self.bmcs.values()):
+            setattr(mybmc, attribute, seconds)
+        return {attribute: seconds}
+
+    def log_level(self, level):
+        if level not in LogWriter.LEVELS:
+            raise ValueError('Unknown log level %s' % level)
+        log_writer.level = level
+        return {'log_level': level}
+
+    def handle(self, line):
+        """Run one command line and return the reply"""
+        words = line.split()
+        if not words or words[0] not in self.COMMANDS:
+            return {'error': 'Unknown command: %s' % line.strip()}
+        log('Control command: %s' % ' '.join(words))
+        try:
+            return getattr(self, self.COMMANDS[words[0]])(*words[1:])
+        except Exception as e:
+            return {'error': '%s: %s' % (words[0], e)}
+
+    def run(self):
+        while True:
+            conn = self.socket.accept()[0]
+            try:
+                conn.settimeout(self.TIMEOUT)
+                data = b''
+                while b'\n' not in data and len(data) < self.MAX_COMMAND:
+                    chunk = conn.recv(self.MAX_COMMAND)
+                    if not chunk:
+                        break
+                    data += chunk
+                reply = self.handle(data.decode('utf-8'))
+                conn.sendall((json.dumps(reply, sort_keys=True) +
+                              '\n').encode('utf-8'))
+            except Exception as e:
+                log('Exception handling control command: %s' % e,
+                    level='error')
+            finally:
+                conn.close()
+
+
+def send_control(path, command, timeout=60):
+    """Send command to the ControlServer at path and return its reply"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall((command + '\n').encode('utf-8'))
+        data = b''
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        sock.close()
+    return json.loads(data.decode('utf-8'))
+
+
+def _control_paths(path):
+    """Return path, or the socket of each worker if there is none at path"""
+    if os.path.exists(path):
+        return [path]
+    paths = []
+    while os.path.exists('%s.%d' % (path, len(paths))):
+        paths.append('%s.%d' % (path, len(paths)))
+    return paths
+
+
+class CommandDispatcher(object):
+    """Run commands on a pool of worker threads
+
+    Commands submitted with the same key run one at a time in the order
+    they were submitted, while commands for different keys run in parallel.
+    """
+    def __init__(self, workers):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._ready = queue.Queue()
+        for i in range(workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, key, command):
+        """Queue command to run after any pending commands for key"""
+        with self._lock:
+            if key in self._pending:
+                self._pending[key].append(command)
+                return
+            self._pending[key] = collections.deque([command])
+        self._ready.put(key)
+
+    def pending(self, key):
+        """Return True if commands for key are queued or running"""
+        with self._lock:
+            return key in self._pending
+
+    def _run(self, key):
+        while True:
+            with self._lock:
+                command = self._pending[key][0]
+            try:
+                command()
+            except Exception as e:
+                log('Exception running command for %s: %s' % (key, e),
+                    level='error')
+            with self._lock:
+                commands = self._pending[key]
+                commands.popleft()
+                if not commands:
+                    del self._pending[key]
+                    return
+
+    def _work(self):
+        while True:
+            self._run(self._ready.get())
+
+
+class SingleFlight(object):
+    """Share one in-flight call among concurrent callers
+
+    If a call for a key is already running, later callers with the same key
+    wait for it and receive its result (or exception) instead of making the
+    same call again.
+    """
+    class _Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class InstanceNotFound(Exception):
+    """No single instance matches the uuid or name a BMC was given"""
 
 
 class OpenStackBmc(bmc.Bmc):
     def __init__(self, authdata, port, address, instance, cache_status,
-                 os_cloud):
-        super(OpenStackBmc, self).__init__(authdata,
-                                           port=port,
-                                           address=address)
-        self.novaclient = os_client_config.make_client('compute',
-                                                       cloud=os_cloud)
+                 os_cloud, novaclient=None, poller=None, cache_ttl=None,
+                 status_table=None, dispatcher=None, boot_device_ttl=None,
+                 instance_map=None, startup_timeout=None, tracker=None,
+                 listener=None, notifications=False):
+        # pyghmi always opens a socket for the BMC.  When it is going to be
+        # served by a shared listener, open one on any free port and swap
+        # it out straight away.
+        super(OpenStackBmc, self).__init__(
+            authdata, port=port if listener is None else 0, address=address)
+        if listener is not None:
+            listener.attach(self, address)
+        # When several BMCs are served from one process they share a single
+        # client, and therefore a single keystone session.
+        if novaclient is None:
+            novaclient = os_client_config.make_client('compute',
+                                                      cloud=os_cloud)
+        self.novaclient = novaclient
         self.instance = None
+        self.instance_name = None
         self.cache_status = cache_status
-        self.cached_status = None
+        self.cache_ttl = cache_ttl
         self.target_status = None
-        # At times the bmc service is started before important things like
-        # networking have fully initialized.  Keep trying to find the
-        # instance indefinitely, since there's no point in continuing if
-        # we don't have an instance.
-        while True:
+        self.poller = poller
+        self.dispatcher = dispatcher
+        self.tracker = tracker
+        # Whether a NotificationListener keeps status_table up to date
+        self.notifications = notifications
+        self.single_flight = SingleFlight()
+        self.boot_device = None
+        self.boot_device_time = None
+        self.boot_device_ttl = boot_device_ttl
+        if status_table is None:
+            if poller is not None:
+                status_table = poller.table
+            else:
+                status_table = StatusTable()
+        self.status_table = status_table
+        # The uuid or name the BMC was configured with
+        self.query = instance
+        # Whether Nova has confirmed that self.instance exists
+        self.verified = False
+        if instance_map and instance in instance_map:
+            # Already resolved by a bulk lookup or a previous run
+            self.instance, self.instance_name = instance_map[instance]
+        else:
+            # At times the bmc service is started before important things
+            # like networking have fully initialized.  Keep trying to find
+            # the instance, since there's no point in continuing if we don't
+            # have an instance.
             try:
-                self.instance = self._find_instance(instance)
-                if self.instance is not None:
-                    name = self.novaclient.servers.get(self.instance).name
-                    self.log('Managing instance: %s UUID: %s' %
-                             (name, self.instance))
-                    break
-            except Exception as e:
-                self.log('Exception finding instance "%s": %s' % (instance, e))
-                time.sleep(1)
+                server = _retry(lambda: self._find_instance(instance),
+                                'finding instance "%s"' % instance,
+                                startup_timeout, self.log,
+                                giveup=InstanceNotFound)
+            except InstanceNotFound:
+                # Leave the address free for when the instance turns up
+                self._close_socket()
+                raise
+            self.instance, self.instance_name = server.id, server.name
+            self.verified = True
+        self.log('Managing instance: %s UUID: %s' %
+                 (self.instance_name, self.instance))
+        if self.poller is not None:
+            self.poller.add(self.instance)
 
     def _find_instance(self, instance):
         try:
-            self.novaclient.servers.get(instance)
-            return instance
+            return _nova_call('get', self.novaclient.servers.get, instance)
         except exceptions.NotFound:
             name_regex = '^%s$' % instance
-            i = self.novaclient.servers.list(search_opts={'name': name_regex})
+            i = _nova_call('list', self.novaclient.servers.list,
+                           search_opts={'name': name_regex})
             if len(i) > 1:
-                self.log('Ambiguous instance name %s' % instance)
-                sys.exit(1)
+                raise InstanceNotFound('Ambiguous instance name %s' %
+                                       instance)
             try:
-                return i[0].id
+                return i[0]
             except IndexError:
-                self.log('Could not find specified instance %s' % instance)
-                sys.exit(1)
+                raise InstanceNotFound('Could not find specified instance '
+                                       '%s' % instance)
 
-    def get_boot_device(self):
-        """Return the currently configured boot device"""
-        server = self.novaclient.servers.get(self.instance)
+    def _instance_call(self, operation, func, *args, **kwargs):
+        """Call func with the uuid of the managed instance and args
+
+        A uuid that has not been confirmed by Nova, such as one loaded from
+        the state file, may belong to an instance that has since been
+        deleted and created again.  The first time it is not found the
+        instance is looked up again and the call repeated.
+        """
+        try:
+            result = _nova_call(operation, func, self.instance, *args,
+                                **kwargs)
+        except exceptions.NotFound:
+            if self.verified:
+                raise
+            self.verified = True
+            self._find_again()
+            result = _nova_call(operation, func, self.instance, *args,
+                                **kwargs)
+        self.verified = True
+        return result
+
+    def _find_again(self):
+        """Manage the instance now found for the configured uuid or name"""
+        old = self.instance
+        server = self._find_instance(self.query)
+        self.log('Instance %s UUID %s not found, now managing UUID %s' %
+                 (self.instance_name, old, server.id), level='warning')
+        if self.poller is not None:
+            self.poller.remove(old)
+            self.poller.add(server.id)
+        self.flush_cache()
+        self.instance, self.instance_name = server.id, server.name
+
+    def _get_server(self):
+        """Get the managed instance, sharing any lookup already running"""
+        return self.single_flight.do(
+            self.instance,
+            lambda: self._instance_call('get', self.novaclient.servers.get))
+
+    @staticmethod
+    def _server_boot_device(server):
         if server.metadata.get('libvirt:pxe-first'):
-            retval = 'network'
+            return 'network'
+        return 'hd'
+
+    def _cache_boot_device(self, bootdevice, age=0):
+        self.boot_device = bootdevice
+        self.boot_device_time = _now() - age
+
+    def get_boot_device(self):
+        """Return the currently configured boot device
+
+        With caching enabled the BMC is assumed to be the only writer of the
+        boot device, so the value it last set or read is used until it is
+        older than boot_device_ttl.
+        """
+        if (self.cache_status and self.boot_device is not None and
+                _now() - self.boot_device_time < self.boot_device_ttl):
+            retval = self.boot_device
+            metrics.inc('openstackbmc_cache_hits_total', cache='boot_device')
+        elif self.boot_device is not None and not rate_limiter.ready(
+                rate_limiter.priority('get')):
+            # Over the API budget, so make do with the last known value
+            retval = self.boot_device
+            metrics.inc('openstackbmc_cache_hits_total', cache='rate_limited')
         else:
-            retval = 'hd'
+            if self.cache_status:
+                metrics.inc('openstackbmc_cache_misses_total',
+                            cache='boot_device')
+            retval = self._server_boot_device(self._get_server())
+            self._cache_boot_device(retval)
         self.log('Reporting boot device', retval)
         return retval
 
@@ -93,82 +1796,923 @@ class OpenStackBmc(bmc.Bmc):
         :param bootdevice: One of ['network', 'hd] to set the boot device to
                            network or hard disk respectively.
         """
-        server = self.novaclient.servers.get(self.instance)
         if bootdevice == 'network':
-            self.novaclient.servers.set_meta_item(
-                server, 'libvirt:pxe-first', '1'
-            )
+            self._instance_call('set_meta_item',
+                                self.novaclient.servers.set_meta_item,
+                                'libvirt:pxe-first', '1')
         else:
-            self.novaclient.servers.set_meta_item(
-                server, 'libvirt:pxe-first', ''
-            )
+            self._instance_call('set_meta_item',
+                                self.novaclient.servers.set_meta_item,
+                                'libvirt:pxe-first', '')
+            bootdevice = 'hd'
+        self._cache_boot_device(bootdevice)
         self.log('Set boot device to', bootdevice)
 
+    def handle_raw_request(self, request, session):
+        command = _ipmi_command_name(request)
+        start = _now()
+        try:
+            with profiler.profile(command):
+                return super(OpenStackBmc, self).handle_raw_request(request,
+                                                                    session)
+        finally:
+            metrics.inc('openstackbmc_ipmi_commands_total', command=command)
+            metrics.observe('openstackbmc_ipmi_command_duration_seconds',
+                            _now() - start, command=command)
+
+    def process_pktqueue(self):
+        # Packets outside a session, which are the start of a new session
+        with profiler.profile('session_setup'):
+            super(OpenStackBmc, self).process_pktqueue()
+
+    @classmethod
+    def listen(cls, timeout=30):
+        """Run pyghmi's event loop forever, feeding the watchdog"""
+        if watchdog.interval:
+            timeout = min(timeout, watchdog.interval)
+        while True:
+            ipmisession.Session.wait_for_rsp(timeout)
+            watchdog.feed()
+
     def cold_reset(self):
-        # Reset of the BMC, not managed system, here we will exit the demo
-        self.log('Shutting down in response to BMC cold reset request')
-        sys.exit(0)
+        """Reset the BMC, rather than the managed system
+
+        Only this BMC is reset, since the process may be serving others: its
+        sessions are dropped and it forgets what it knew about the instance,
+        as though it had been restarted.
+        """
+        self.log('Resetting in response to BMC cold reset request')
+        self._close_sessions()
+        self.target_status = None
+        self.flush_cache()
+        return 0
+
+    def _close_sessions(self):
+        """Unregister any sessions open to the BMC from pyghmi"""
+        handlers = ipmisession.Session.bmc_handlers
+        for sockaddr, sessions in list(handlers.items()):
+            for port, session in list(sessions.items()):
+                if getattr(session, 'bmc', None) is self:
+                    del sessions[port]
+            if not sessions:
+                del handlers[sockaddr]
+
+    def _close_socket(self):
+        """Unregister the BMC's socket from pyghmi and close it
+
+        pyghmi's IO thread reads from its sockets without any locking, so
+        the socket is only closed once the thread has been round its loop
+        without it.
+        """
+        sock = self.serversocket
+        if sock in ipmisession.iosockets[1:]:
+            ipmisession.iosockets.remove(sock)
+            _wait_for_event_loop()
+        ipmisession.Session.bmc_handlers.pop(sock, None)
+        if sock not in ipmisession.iosockets:
+            # Either served by a SharedListener or removed above.  The first
+            # socket is also used to wake pyghmi's IO thread, so it has to
+            # stay open even if nothing else is listening on it.
+            sock.close()
+
+    def close(self):
+        """Stop serving this BMC without disturbing the rest of the process
+
+        Unregisters the BMC and any sessions open to it from pyghmi's event
+        loop and closes its socket.
+        """
+        self._close_socket()
+        self._close_sessions()
+        if self.poller is not None:
+            self.poller.remove(self.instance)
+        self.status_table.invalidate(self.instance)
+        self.log('Stopped managing instance: %s UUID: %s' %
+                 (self.instance_name, self.instance))
+
+    def _fetch_status(self):
+        """Get the status of the managed instance from Nova"""
+        server = self._get_server()
+        status = server.status
+        self.status_table.update(self.instance, status)
+        # The boot device comes along for free, so keep it fresh as well
+        self._cache_boot_device(self._server_boot_device(server))
+        return status
+
+    def _refresh_status(self):
+        try:
+            self._fetch_status()
+        except Exception as e:
+            self.log('Exception refreshing status of %s: %s' %
+                     (self.instance, e), level='error')
+        finally:
+            self.status_table.finish_refresh(self.instance)
+
+    def flush_cache(self):
+        """Forget the status and boot device of the managed instance"""
+        self.status_table.invalidate(self.instance)
+        self.boot_device = None
+        self.boot_device_time = None
+
+    def describe(self):
+        """Return what the BMC knows about its instance, for debugging"""
+        status, status_age = self.status_table.lookup(self.instance)
+        boot_device_age = None
+        if self.boot_device_time is not None:
+            boot_device_age = _now() - self.boot_device_time
+        return {'instance': self.instance,
+                'name': self.instance_name,
+                'status': status,
+                'status_age': status_age,
+                'target_status': self.target_status,
+                'boot_device': self.boot_device,
+                'boot_device_age': boot_device_age,
+                'cache_ttl': self.cache_ttl,
+                'boot_device_ttl': self.boot_device_ttl,
+                'in_transition': (self.tracker is not None and
+                                  self.tracker.tracking(self.instance)),
+                'command_pending': (self.dispatcher is not None and
+                                    self.dispatcher.pending(self.instance))}
+
+    def _get_status(self):
+        """Return the status of the managed instance
+
+        With caching enabled, a cached status is returned immediately.  If it
+        is older than cache_ttl it is still returned, but a background
+        refresh is started so a later query will see the new value.  Nova is
+        queried synchronously if the status is unknown or does not match
+        the status requested by the last power command.
+
+        While the instance is in a power transition started by this BMC, the
+        status kept up to date by the tracker is returned.  Statuses kept up
+        to date by a poller or by notifications are treated like cached ones.
+        """
+        if self.tracker is not None and self.tracker.tracking(self.instance):
+            status = self.status_table.get(self.instance)
+            if status is not None:
+                metrics.inc('openstackbmc_cache_hits_total',
+                            cache='transition')
+                return status
+        if (self.cache_status or self.poller is not None or
+                self.notifications):
+            status, age = self.status_table.lookup(self.instance)
+            if status is not None and (
+                    self.target_status is None or
+                    ((status in POWERED_ON_STATUSES) ==
+                     (self.target_status == 'ACTIVE'))):
+                if (self.cache_ttl is not None and age > self.cache_ttl and
+                        self.status_table.start_refresh(self.instance)):
+                    self.log('Refreshing status %s from %.1f seconds ago' %
+                             (status, age), level='debug')
+                    refresh = threading.Thread(target=self._refresh_status)
+                    refresh.daemon = True
+                    refresh.start()
+                metrics.inc('openstackbmc_cache_hits_total', cache='status')
+                return status
+            metrics.inc('openstackbmc_cache_misses_total', cache='status')
+        status = self.status_table.get(self.instance)
+        if status is not None and not rate_limiter.ready(
+                rate_limiter.priority('get')):
+            # Over the API budget, so make do with the last known status
+            self.log('Over the API rate limit, reporting last known status '
+                     '%s' % status, level='debug')
+            metrics.inc('openstackbmc_cache_hits_total', cache='rate_limited')
+            return status
+        return self._fetch_status()
 
     def _instance_active(self):
-        if (self.cached_status is None or
-                self.cached_status != self.target_status or
-                not self.cache_status):
-            self.cached_status = self.novaclient.servers.get(self.instance).status  # noqa: E501
-        return self.cached_status == 'ACTIVE'
+        return self._get_status() in POWERED_ON_STATUSES
 
     def get_power_state(self):
         """Returns the current power state of the managed instance"""
-        state = self._instance_active()
-        self.log('Reporting power state "%s" for instance %s' %
-                 (state, self.instance))
+        if (self.dispatcher is not None and
+                self.dispatcher.pending(self.instance)):
+            # Report the requested state until the Nova call has been made
+            state = self.target_status == 'ACTIVE'
+        else:
+            state = self._instance_active()
+        metrics.set('openstackbmc_power_state', int(state),
+                    instance=self.instance)
+        log_writer.status(self.instance, state)
         return state
 
+    def _track(self):
+        """Follow the power transition just started in Nova"""
+        if self.tracker is not None:
+            self.tracker.track(self.instance)
+
+    def _dispatch(self, command):
+        """Run command, on the dispatcher's workers if there is one
+
+        The Nova calls made by the command take precedence over status reads
+        when the rate limit is reached.
+        """
+        def urgent_command():
+            with rate_limiter.urgent():
+                command()
+        if self.dispatcher is None:
+            urgent_command()
+        else:
+            self.dispatcher.submit(self.instance, urgent_command)
+
     def power_off(self):
         """Stop the managed instance"""
         # this should be power down without waiting for clean shutdown
         self.target_status = 'SHUTOFF'
+        self._dispatch(self._power_off)
+
+    def _power_off(self):
+        self.status_table.invalidate(self.instance)
         if self._instance_active():
             try:
-                self.novaclient.servers.stop(self.instance)
+                self._instance_call('stop', self.novaclient.servers.stop)
+                self._track()
                 self.log('Powered off %s' % self.instance)
             except exceptions.Conflict as e:
+                metrics.inc('openstackbmc_power_conflicts_total',
+                            command='power_off')
                 # This can happen if we get two requests to start a server in
                 # short succession.  The instance may then be in a powering-on
                 # state, which means it is invalid to start it again.
-                self.log('Ignoring exception: "%s"' % e)
+                self.log('Ignoring exception: "%s"' % e, level='warning')
         else:
             self.log('%s is already off.' % self.instance)
 
     def power_on(self):
         """Start the managed instance"""
         self.target_status = 'ACTIVE'
+        self._dispatch(self._power_on)
+
+    def _power_on(self):
+        self.status_table.invalidate(self.instance)
         if not self._instance_active():
             try:
-                self.novaclient.servers.start(self.instance)
+                self._instance_call('start', self.novaclient.servers.start)
+                self._track()
                 self.log('Powered on %s' % self.instance)
             except exceptions.Conflict as e:
+                metrics.inc('openstackbmc_power_conflicts_total',
+                            command='power_on')
                 # This can happen if we get two requests to start a server in
                 # short succession.  The instance may then be in a powering-on
                 # state, which means it is invalid to start it again.
-                self.log('Ignoring exception: "%s"' % e)
+                self.log('Ignoring exception: "%s"' % e, level='warning')
         else:
             self.log('%s is already on.' % self.instance)
 
     def power_reset(self):
-        """Not implemented"""
-        print('WARNING: Received request for unimplemented action power_reset')
+        """Hard reboot the managed instance"""
+        self.target_status = 'ACTIVE'
+        self._dispatch(self._power_reset)
+
+    def _power_reset(self):
+        try:
+            self._instance_call('reboot', self.novaclient.servers.reboot,
+                                reboot_type='HARD')
+            # The instance is on for the whole reboot, so there is no need to
+            # ask Nova about it until the cached status expires.
+            self.status_table.update(self.instance, 'ACTIVE')
+            self._track()
+            self.log('Reset %s' % self.instance)
+        except exceptions.Conflict as e:
+            # The instance is in the middle of another state change
+            self.status_table.invalidate(self.instance)
+            metrics.inc('openstackbmc_power_conflicts_total',
+                        command='power_reset')
+            self.log('Ignoring exception: "%s"' % e, level='warning')
+
+    def power_cycle(self):
+        """Power cycle the managed instance
+
+        Nova has no separate power cycle, and a hard reboot has the same
+        effect, so this is the same as power_reset.
+        """
+        self.power_reset()
 
     def power_shutdown(self):
         """Stop the managed instance"""
         # should attempt a clean shutdown
         self.target_status = 'SHUTOFF'
-        self.novaclient.servers.stop(self.instance)
+        self._dispatch(self._power_shutdown)
+
+    def _power_shutdown(self):
+        self.status_table.invalidate(self.instance)
+        self._instance_call('stop', self.novaclient.servers.stop)
         self.log('Politely shut down %s' % self.instance)
 
-    def log(self, *msg):
-        """Helper function that prints msg and flushes stdout"""
-        print(' '.join(msg))
-        sys.stdout.flush()
+    def log(self, *msg, **fields):
+        """Helper function that logs msg for the managed instance"""
+        fields.setdefault('instance', getattr(self, 'instance', None))
+        log(*msg, **fields)
+
+
+class _VirtualSocket(object):
+    """The socket of one BMC served by a SharedListener
+
+    pyghmi sends the BMC's packets through this as if it were the BMC's own
+    socket, and they leave the shared socket from the BMC's address.
+    """
+    def __init__(self, listener, address):
+        self.listener = listener
+        self.address = address
+        self.packed = socket.inet_pton(socket.AF_INET6, address)
+        self._pktinfo = [(socket.IPPROTO_IPV6, socket.IPV6_PKTINFO,
+                          self.packed + struct.pack('@I', 0))]
+
+    def setblocking(self, flag):
+        pass
+
+    def getsockname(self):
+        # pyghmi files the sessions of a BMC under the port of its socket,
+        # so use the address to keep BMCs on the same port apart.
+        return self.address, self.address
+
+    def sendto(self, data, sockaddr):
+        return self.listener.socket.sendmsg([data], self._pktinfo, 0,
+                                            sockaddr)
+
+    def close(self):
+        self.listener.detach(self)
+
+
+class SharedListener(object):
+    """Serve every BMC in the process from one UDP socket
+
+    The socket is bound to all addresses, and the destination address of
+    each datagram, which the kernel reports with IPV6_PKTINFO, selects the
+    BMC it is for.  Replies are sent from the same address.  Unlike a socket
+    per BMC, this costs nothing extra per address, and sessions from one
+    client to several BMCs cannot be confused with each other.
+
+    Requires Python 3 for recvmsg and sendmsg.
+    """
+    def __init__(self, port):
+        self.port = port
+        self.socket = None
+        # Packed IPv6 address -> _VirtualSocket
+        self.sockets = {}
+
+    def bind(self):
+        if not hasattr(socket.socket, 'recvmsg'):
+            raise RuntimeError('A shared socket requires Python 3')
+        sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_RECVPKTINFO, 1)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16777216)
+        except socket.error:
+            pass
+        sock.bind(('::', self.port))
+        sock.setblocking(0)
+        self.socket = sock
+        # pyghmi's IO thread still needs a socket of its own, which it also
+        # uses to wake itself up.
+        ipmisession.Session._assignsocket()
+
+    def attach(self, mybmc, address):
+        """Serve mybmc on address from the shared socket"""
+        mybmc._close_socket()
+        vsock = _VirtualSocket(self, address)
+        mybmc.serversocket = vsock
+        mybmc.port = address
+        ipmisession.Session.bmc_handlers[vsock] = {0: mybmc}
+        self.sockets[vsock.packed] = vsock
+
+    def detach(self, vsock):
+        if self.sockets.get(vsock.packed) is vsock:
+            del self.sockets[vsock.packed]
+
+    def dispatch(self, data, clientaddr, destination):
+        """Queue a datagram for the BMC on the packed destination address
+
+        Mirrors how pyghmi routes the datagrams it receives itself: to the
+        client's session with the BMC if there is one, otherwise to the BMC.
+        """
+        vsock = self.sockets.get(destination)
+        # Shorter datagrams cannot be IPMI
+        if vsock is None or len(data) < 4:
+            return False
+        # BMCs are stopped from other threads, so look each entry up once
+        handlers = ipmisession.Session.bmc_handlers
+        handler = handlers.get(clientaddr, {}).get(vsock.address)
+        packet = (data, clientaddr, vsock, True)
+        if handler is None:
+            handler = handlers.get(vsock, {}).get(0)
+            packet = (data, clientaddr, vsock, False)
+        if handler is None:
+            return False
+        handler.pktqueue.append(packet)
+        ipmisession.sessionqueue.append(handler)
+        return True
+
+    def receive(self):
+        """Dispatch every datagram waiting on the socket"""
+        while True:
+            try:
+                data, ancdata, flags, clientaddr = self.socket.recvmsg(
+                    3000, socket.CMSG_SPACE(20))
+            except socket.error:
+                return
+            for level, kind, value in ancdata:
+                if (level == socket.IPPROTO_IPV6 and
+                        kind == socket.IPV6_PKTINFO):
+                    self.dispatch(data, clientaddr, value[:16])
+
+    def listen(self, timeout=1):
+        """Serve the BMCs from the calling thread forever
+
+        Takes the place of Bmc.listen.  pyghmi's event loop still runs
+        after each batch of datagrams, and at least every timeout seconds,
+        to handle them and to expire idle sessions.
+        """
+        if watchdog.interval:
+            timeout = min(timeout, watchdog.interval)
+        while True:
+            select.select([self.socket], (), (), timeout)
+            self.receive()
+            ipmisession.Session.wait_for_rsp(0)
+            watchdog.feed()
+
+
+# Run in a new interpreter to time an import.  Prints the time taken and
+# which of the modules named by the remaining arguments were loaded by it.
+_IMPORT_TIMER = (
+    'import json, os, runpy, sys, time\n'
+    'start = time.time()\n'
+    'if os.path.isfile(sys.argv[1]):\n'
+    '    runpy.run_path(sys.argv[1], run_name="openstackbmc_import")\n'
+    'else:\n'
+    '    __import__(sys.argv[1])\n'
+    'seconds = time.time() - start\n'
+    'print(json.dumps([seconds, [m for m in sys.argv[2:] '
+    'if m in sys.modules]]))\n')
+
+
+def simulated_compute(args, instances):
+    """Return an in-memory compute backend with a server for each instance
+
+    Every server starts powered off.  The simulator is fakecloud.FakeCompute,
+    so it is only available when the BMC is run from the
+    openstack_virtual_baremetal package rather than installed standalone.
+    """
+    fakecloud = importlib.import_module(
+        'openstack_virtual_baremetal.fakecloud')
+    compute = fakecloud.FakeCompute(
+        latency=args.simulator_latency,
+        boot_time=args.simulator_boot_time,
+        shutdown_time=args.simulator_shutdown_time,
+        error_rate=args.simulator_error_rate,
+        power_failure_rate=args.simulator_power_failure_rate)
+    for instance in sorted(set(instances)):
+        compute.add_server(instance, status='SHUTOFF')
+    return compute
+
+
+def measure_imports():
+    """Time importing the BMC and each of its heavy dependencies
+
+    Each import is timed in a new interpreter so nothing is already cached.
+    Returns a list of (name, seconds, loaded) tuples, where loaded lists the
+    modules in DEFERRED_IMPORTS that the import pulled in.
+    """
+    path = os.path.abspath(__file__)
+    results = []
+    for name in [path, 'pyghmi.ipmi.bmc'] + DEFERRED_IMPORTS:
+        output = subprocess.check_output(
+            [sys.executable, '-c', _IMPORT_TIMER, name] + DEFERRED_IMPORTS)
+        seconds, loaded = json.loads(output.decode('utf-8'))
+        if name == path:
+            name = 'openstackbmc'
+        results.append((name, seconds, loaded))
+    return results
+
+
+def _bmc_address(address):
+    """Return address in the format pyghmi needs to listen on it"""
+    # Default to ipv6 format, but if we get an ipv4 address passed in use the
+    # appropriate format for pyghmi to listen on it.
+    if ':' not in address:
+        return '::ffff:%s' % address
+    return address
+
+
+def _parse_bmc_arg(value):
+    """Parse an ADDRESS=INSTANCE pair from the command line"""
+    address, sep, instance = value.partition('=')
+    if not sep or not address or not instance:
+        raise argparse.ArgumentTypeError(
+            'Expected ADDRESS=INSTANCE, got "%s"' % value)
+    return address, instance
+
+
+def load_instances_file(path):
+    """Load a mapping of BMC address to instance from a JSON file
+
+    :param path: Path to a file containing a JSON object whose keys are the
+                 addresses to listen on and whose values are the uuid or name
+                 of the instance to manage on that address.
+    """
+    with open(path) as f:
+        instances = json.load(f)
+    if not isinstance(instances, dict):
+        raise ValueError('%s must contain a JSON object mapping addresses '
+                         'to instances' % path)
+    return instances
+
+
+def _wake_event_loop():
+    """Make pyghmi's IO thread notice sockets that were added or removed"""
+    if ipmisession.iosockets and ipmisession.myself:
+        wakeup = ipmisession.iosockets[0]
+        try:
+            wakeup.sendto(b'\x01', (ipmisession.myself,
+                                    wakeup.getsockname()[1]))
+        except socket.error:
+            pass
+
+
+def _wait_for_event_loop():
+    """Wait for pyghmi's IO thread to go round its loop
+
+    Any socket removed from ipmisession.iosockets beforehand is no longer
+    being read by the thread once this returns.  Must not be called from
+    the IO thread itself.
+    """
+    if ipmisession.iothread is not None and ipmisession.myself:
+        # Queues a wait that the IO thread only ends after its next pass
+        ipmisession._io_wait(0)
+
+
+class InstancesWatcher(threading.Thread):
+    """Start and stop BMCs as the instances file changes
+
+    The modification time of the file is checked every interval seconds, or
+    as soon as wake() is called.  When it changes a BMC is started for each
+    new address, and the BMC of each address that was removed or now maps
+    to a different instance is stopped.  The other BMCs keep running along
+    with their caches and sessions.
+
+    :param bmcs: The running BMCs keyed by address, updated in place.
+    :param instances: The instance each address in bmcs manages, as given in
+                      the file, updated in place.
+    :param start_bmc: Called with an address, instance and instance map to
+                      create the BMC for a new address.
+    :param fixed: Addresses from the command line, which are served whatever
+                  the file contains.
+    :param on_change: Called after BMCs have been started or stopped, and
+                      once every address is served again after a reload
+                      that left some out.
+    :param shard: An (index, count) tuple to only serve the addresses of one
+                  worker of a supervisor.
+
+    With no path only the fixed addresses are served, which retries the BMCs
+    whose instances could not be found at startup until they are running.
+    complete is False while any address is waiting for its instance.
+    """
+    # How often to retry BMCs that could not be started when no file is
+    # being watched
+    RETRY_INTERVAL = 30
+
+    def __init__(self, path, interval, novaclient, bmcs, instances,
+                 start_bmc, fixed=None, on_change=None, shard=None):
+        super(InstancesWatcher, self).__init__()
+        self.daemon = True
+        self.path = path
+        self.interval = interval
+        self.novaclient = novaclient
+        self.bmcs = bmcs
+        self.instances = instances
+        self.start_bmc = start_bmc
+        self.fixed = fixed or {}
+        self.on_change = on_change
+        self.shard = shard
+        self.mtime = self._mtime()
+        self.complete = True
+        self._wakeup = threading.Event()
+
+    def _mtime(self):
+        if self.path is None:
+            return 0
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def wake(self):
+        """Check the file now rather than at the end of the interval"""
+        self._wakeup.set()
+
+    def reset(self):
+        """Reload at the next check even if the file has not changed"""
+        self.mtime = None
+        self.complete = False
+
+    def reload(self):
+        """Start and stop BMCs to match the file if it has changed
+
+        Returns True if any BMC was started or stopped.  Entries whose
+        instance cannot be found yet are retried at the next check.
+        """
+        mtime = self._mtime()
+        if mtime is None or mtime == self.mtime:
+            return False
+        try:
+            wanted = {}
+            if self.path is not None:
+                wanted = load_instances_file(self.path)
+        except (IOError, OSError, ValueError) as e:
+            log('Not reloading %s: %s' % (self.path, e), level='warning')
+            return False
+        wanted.update(self.fixed)
+        wanted = in_shard(wanted, self.shard)
+        changed = False
+        for address in sorted(self.bmcs):
+            if wanted.get(address) != self.instances.get(address):
+                self.bmcs.pop(address).close()
+                self.instances.pop(address, None)
+                changed = True
+        added = dict((address, instance)
+                     for address, instance in wanted.items()
+                     if address not in self.bmcs)
+        complete = True
+        if added:
+            instance_map = resolve_instances(self.novaclient,
+                                             set(added.values()))
+            for address in sorted(added):
+                instance = added[address]
+                if instance not in instance_map:
+                    log('Could not find instance %s for %s' %
+                        (instance, address), level='error')
+                    complete = False
+                    continue
+                try:
+                    self.bmcs[address] = self.start_bmc(address, instance,
+                                                        instance_map)
+                except Exception as e:
+                    log('Exception starting BMC on %s: %s' % (address, e),
+                        level='error')
+                    complete = False
+                    continue
+                self.instances[address] = instance
+                changed = True
+        if complete:
+            self.mtime = mtime
+        completed = complete and not self.complete
+        self.complete = complete
+        if changed:
+            _wake_event_loop()
+        if (changed or completed) and self.on_change is not None:
+            self.on_change()
+        return changed
+
+    def run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.reload()
+            except Exception as e:
+                log('Exception reloading %s: %s' % (self.path, e),
+                    level='error')
+
+
+def shard_of(address, count):
+    """Return which of count workers serves the BMC on address
+
+    The address is hashed so that adding or removing BMCs does not move the
+    others to a different worker.
+    """
+    return (zlib.crc32(address.encode('utf-8')) & 0xffffffff) % count
+
+
+def in_shard(instances, shard):
+    """Return the entries of instances for the addresses in shard
+
+    :param instances: A dict mapping BMC addresses to instances.
+    :param shard: An (index, count) tuple, or None for every address.
+    """
+    if shard is None:
+        return dict(instances)
+    index, count = shard
+    return dict((address, instance)
+                for address, instance in instances.items()
+                if shard_of(address, count) == index)
+
+
+try:
+    # Workers import the BMC afresh rather than inheriting the supervisor's
+    # threads and locks
+    _multiprocessing = multiprocessing.get_context('spawn')
+except AttributeError:
+    # Python 2 can only fork, so workers inherit the supervisor's state
+    _multiprocessing = multiprocessing
+
+
+class _NotificationRelay(NotificationListener):
+    """Forward every notification unchanged to the socket of each worker"""
+    def __init__(self, path, destinations):
+        super(_NotificationRelay, self).__init__(path, None)
+        self.destinations = destinations
+        self.sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    def run(self):
+        while True:
+            message = self.socket.recv(65536)
+            for destination in self.destinations:
+                try:
+                    self.sender.sendto(message, destination)
+                except socket.error:
+                    # The worker is restarting
+                    pass
+
+
+def _run_worker(args, instances, shard, conn):
+    """Serve one shard of the BMCs in a worker process of a Supervisor"""
+    # Only the supervisor talks to systemd
+    for name in ('NOTIFY_SOCKET', 'WATCHDOG_USEC', 'WATCHDOG_PID'):
+        os.environ.pop(name, None)
+    _configure_logging(args)
+    lock = threading.Lock()
+
+    def send(message):
+        with lock:
+            conn.send(message)
+
+    def report():
+        while True:
+            time.sleep(Supervisor.REPORT_INTERVAL)
+            try:
+                send(('metrics', metrics.snapshot()))
+            except (IOError, OSError):
+                # The supervisor is gone, so nothing will restart this
+                # worker or route requests for other shards.
+                log('Supervisor exited, stopping worker %d' % shard[0],
+                    level='error')
+                log_writer.flush()
+                os._exit(1)
+
+    reporter = threading.Thread(target=report)
+    reporter.daemon = True
+    reporter.start()
+    serve(args, instances, shard=shard,
+          ready=lambda: send(('ready', None)))
+
+
+class Supervisor(object):
+    """Shard the BMCs across worker processes and keep them running
+
+    Each worker serves the addresses that shard_of assigns to it, with its
+    own state file, notification socket and profile directory derived from
+    those given.  Workers that exit are restarted individually, after a
+    delay that grows while they keep failing to start.  Workers report
+    their metrics every REPORT_INTERVAL seconds, and the supervisor serves
+    the sum of them.  SIGHUP and SIGUSR1 are passed on to every worker when
+    the workers handle them.
+    """
+    REPORT_INTERVAL = 5
+    # One token for a read plus the quarter of the burst kept for writes
+    MIN_WORKER_BURST = 2
+
+    def __init__(self, args, instances, count):
+        self.args = args
+        self.instances = instances
+        self.count = count
+        self.workers = [None] * count
+        self.failures = [0] * count
+        self.restart_at = {}
+        self.ready = set()
+        self.metrics = Metrics()
+        self._latest = {}
+        self._retired = Metrics()
+        self._lock = threading.Lock()
+
+    def _suffix(self, path, index):
+        return '%s.%d' % (path, index)
+
+    def worker_args(self, index):
+        """Return the options of worker index"""
+        args = copy.copy(self.args)
+        args.processes = 1
+        args.metrics_port = 0
+        # The limit applies to the whole of the supervisor.  Each worker
+        # still needs room for a read on top of the tokens it keeps for
+        # writes, so small bursts are rounded up, at the cost of a slightly
+        # larger burst across all of the workers.
+        args.api_rate = self.args.api_rate / float(self.count)
+        args.api_burst = self.args.api_burst / float(self.count)
+        if args.api_rate > 0:
+            args.api_burst = max(args.api_burst or args.api_rate,
+                                 self.MIN_WORKER_BURST)
+        if args.state_file:
+            args.state_file = self._suffix(args.state_file, index)
+        if args.notification_socket:
+            args.notification_socket = self._suffix(args.notification_socket,
+                                                    index)
+        if args.control_socket:
+            args.control_socket = self._suffix(args.control_socket, index)
+        if args.profile:
+            args.profile = os.path.join(args.profile, 'worker-%d' % index)
+        return args
+
+    def start(self, index):
+        receiver, sender = _multiprocessing.Pipe(False)
+        process = _multiprocessing.Process(
+            target=_run_worker,
+            args=(self.worker_args(index), self.instances,
+                  (index, self.count), sender),
+            name='openstackbmc-worker-%d' % index)
+        process.daemon = True
+        process.start()
+        sender.close()
+        self.workers[index] = (process, receiver)
+        self.restart_at.pop(index, None)
+        log('Started worker %d with pid %d' % (index, process.pid))
+
+    def poll(self):
+        """Handle messages from the workers and restart any that exited"""
+        now = _now()
+        for index, (process, receiver) in enumerate(self.workers):
+            try:
+                while receiver.poll():
+                    kind, value = receiver.recv()
+                    if kind == 'ready':
+                        self.ready.add(index)
+                        self.failures[index] = 0
+                    elif kind == 'metrics':
+                        with self._lock:
+                            self._latest[index] = value
+            except (EOFError, IOError, OSError):
+                pass
+            if index in self.restart_at:
+                if now >= self.restart_at[index]:
+                    self.metrics.inc('openstackbmc_worker_restarts_total',
+                                     worker=str(index))
+                    self.start(index)
+            elif process.exitcode is not None:
+                receiver.close()
+                with self._lock:
+                    # Counters from the old worker still count towards the
+                    # totals, but it no longer reports any instance.
+                    self._retired.merge(self._latest.pop(index, {}),
+                                        gauges=False)
+                delay = _backoff(self.failures[index])
+                self.failures[index] += 1
+                log('Worker %d exited with status %s, restarting in %.1f '
+                    'seconds' % (index, process.exitcode, delay),
+                    level='error')
+                self.restart_at[index] = now + delay
+
+    def render(self):
+        """Return the sum of the metrics of every worker"""
+        total = Metrics()
+        total.merge(self.metrics.snapshot())
+        with self._lock:
+            total.merge(self._retired.snapshot())
+            for values in self._latest.values():
+                total.merge(values)
+        return total.render()
+
+    def signal_workers(self, signum, frame=None):
+        for process, receiver in self.workers:
+            if process.exitcode is None:
+                os.kill(process.pid, signum)
+
+    def run(self):
+        """Start the workers and supervise them forever"""
+        for index in range(self.count):
+            self.start(index)
+        # Exiting normally stops the workers
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        if self.args.reload_interval:
+            signal.signal(signal.SIGHUP, self.signal_workers)
+        if self.args.profile:
+            signal.signal(signal.SIGUSR1, self.signal_workers)
+        if self.args.notification_socket:
+            relay = _NotificationRelay(
+                self.args.notification_socket,
+                [self._suffix(self.args.notification_socket, index)
+                 for index in range(self.count)])
+            relay.bind()
+            relay.start()
+        if self.args.metrics_port:
+            start_metrics_server(self.args.metrics_address,
+                                 self.args.metrics_port, self.render)
+        watchdog.configure()
+        notified = False
+        while True:
+            self.poll()
+            if not notified and len(self.ready) == self.count:
+                sd_notify('READY=1\nSTATUS=Serving %d BMCs in %d workers' %
+                          (len(self.instances), self.count))
+                notified = True
+            watchdog.feed()
+            time.sleep(0.5)
+
+
+def _configure_logging(args):
+    log_writer.configure(json_format=args.log_format == 'json',
+                         buffered=args.log_buffered,
+                         status_interval=args.log_status_interval,
+                         level=args.log_level)
 
 
 def main():
@@ -187,9 +2731,101 @@ def main():
                         help='Address to bind to; defaults to ::')
     parser.add_argument('--instance',
                         dest='instance',
-                        required=True,
                         help='The uuid or name of the OpenStack instance '
                         'to manage')
+    parser.add_argument('--instances-file',
+                        dest='instances_file',
+                        help='A JSON file mapping BMC addresses to the uuid '
+                             'or name of the instance to manage on that '
+                             'address.  All of the BMCs are served from this '
+                             'process.  Cannot be used with --instance.')
+    parser.add_argument('--bmc',
+                        dest='bmcs',
+                        action='append',
+                        default=[],
+                        type=_parse_bmc_arg,
+                        metavar='ADDRESS=INSTANCE',
+                        help='Serve a BMC for INSTANCE on ADDRESS from this '
+                             'process.  May be specified multiple times and '
+                             'combined with --instances-file.  Cannot be '
+                             'used with --instance.')
+    parser.add_argument('--reload-interval',
+                        dest='reload_interval',
+                        type=float,
+                        default=0,
+                        help='Check --instances-file for changes every '
+                             'RELOAD_INTERVAL seconds, or on SIGHUP, and '
+                             'start or stop BMCs for the addresses that were '
+                             'added or removed without restarting the '
+                             'others.  Defaults to 0, which only reads the '
+                             'file at startup.')
+    parser.add_argument('--shared-socket',
+                        dest='shared_socket',
+                        default=False,
+                        action='store_true',
+                        help='Serve every BMC address from one socket bound '
+                             'to all addresses on --port, and route each '
+                             'packet by the address it was sent to, rather '
+                             'than opening a socket per address.  Requires '
+                             'Python 3.')
+    parser.add_argument('--processes',
+                        dest='processes',
+                        type=int,
+                        default=1,
+                        help='Shard the BMCs across this many worker '
+                             'processes, restarted individually if they '
+                             'exit, so that more than one CPU is used.  The '
+                             'state file, notification socket and profile '
+                             'directory of each worker are named after the '
+                             'ones given, and --api-rate is split between '
+                             'the workers.  0 starts one worker per CPU.  '
+                             'Defaults to 1, which serves every BMC from '
+                             'this process.')
+    parser.add_argument('--backend',
+                        dest='backend',
+                        choices=['nova', 'simulator'],
+                        default='nova',
+                        help='Control instances in the host cloud with Nova, '
+                             'or simulate them in memory to load test IPMI '
+                             'clients with more BMCs than a cloud could '
+                             'provide.  The simulator creates a powered off '
+                             'instance named after each instance the BMCs '
+                             'are asked to manage, and needs the '
+                             'openstack_virtual_baremetal package.  Defaults '
+                             'to nova.')
+    parser.add_argument('--simulator-latency',
+                        dest='simulator_latency',
+                        type=float,
+                        default=0,
+                        help='With --backend simulator, seconds each API '
+                             'call takes.  Defaults to 0.')
+    parser.add_argument('--simulator-boot-time',
+                        dest='simulator_boot_time',
+                        type=float,
+                        default=0,
+                        help='With --backend simulator, seconds a simulated '
+                             'instance takes to power on or reboot.  '
+                             'Defaults to 0.')
+    parser.add_argument('--simulator-shutdown-time',
+                        dest='simulator_shutdown_time',
+                        type=float,
+                        default=0,
+                        help='With --backend simulator, seconds a simulated '
+                             'instance takes to power off.  Defaults to 0.')
+    parser.add_argument('--simulator-error-rate',
+                        dest='simulator_error_rate',
+                        type=float,
+                        default=0,
+                        help='With --backend simulator, fraction of API calls '
+                             'to fail at random.  Defaults to 0.')
+    parser.add_argument('--simulator-power-failure-rate',
+                        dest='simulator_power_failure_rate',
+                        type=float,
+                        default=0,
+                        help='With --backend simulator, fraction of power '
+                             'operations that are accepted but leave the '
+                             'instance in the state it was in, at random.  '
+                             'Defaults to 0.')
     parser.add_argument('--cache-status',
                         dest='cache_status',
                         default=False,
@@ -197,24 +2833,507 @@ def main():
                         help='Cache the status of the managed instance.  This '
                              'can reduce load on the host cloud, but if the '
                              'instance status is changed outside the BMC then '
-                             'it may become out of sync.')
+                             'it may be out of date for up to --cache-ttl '
+                             'seconds.')
+    parser.add_argument('--cache-ttl',
+                        dest='cache_ttl',
+                        type=float,
+                        default=30,
+                        help='Seconds before a cached status is refreshed.  '
+                             'Once expired the cached value is still used '
+                             'while it is refreshed in the background.  '
+                             'Defaults to 30.')
+    parser.add_argument('--boot-device-ttl',
+                        dest='boot_device_ttl',
+                        type=float,
+                        default=300,
+                        help='With --cache-status, seconds to trust the boot '
+                             'device last set or read by the BMC before '
+                             'reading it from Nova again to pick up changes '
+                             'made outside the BMC.  Defaults to 300.')
+    parser.add_argument('--poll-interval',
+                        dest='poll_interval',
+                        type=float,
+                        default=0,
+                        help='Refresh the status of every managed instance '
+                             'with a single servers.list call every '
+                             'POLL_INTERVAL seconds, and answer power status '
+                             'queries from the result.  This is most useful '
+                             'when serving multiple BMCs from one process.  '
+                             'Defaults to 0, which disables polling.')
+    parser.add_argument('--status-table',
+                        dest='status_table',
+                        metavar='PATH',
+                        help='Share instance statuses with the other '
+                             'openstackbmc processes on this host through a '
+                             'table in the file at PATH, preferably on a '
+                             'tmpfs.  One process run with --status-updater '
+                             'refreshes the status of every instance managed '
+                             'by the others with a single servers.list call '
+                             'per --poll-interval, and the BMCs answer power '
+                             'status queries from the table, reading it '
+                             'every POLL_INTERVAL seconds (1 by default).  A '
+                             'BMC only asks Nova itself once a status in the '
+                             'table is older than --cache-ttl.')
+    parser.add_argument('--status-updater',
+                        dest='status_updater',
+                        default=False,
+                        action='store_true',
+                        help='Keep the statuses in --status-table up to date '
+                             'every --poll-interval seconds instead of '
+                             'serving BMCs.')
+    parser.add_argument('--transition-interval',
+                        dest='transition_interval',
+                        type=float,
+                        default=1,
+                        help='After a power command, poll Nova in the '
+                             'background until the power transition '
+                             'completes, starting after this many seconds '
+                             'and backing off to every %d seconds, and '
+                             'answer power status queries from the result.  '
+                             'Defaults to 1.  0 disables this, so every '
+                             'query during a transition asks Nova.' %
+                             TransitionTracker.MAX_INTERVAL)
+    parser.add_argument('--notification-socket',
+                        dest='notification_socket',
+                        help='Path of a UNIX datagram socket to create and '
+                             'read Nova versioned notifications from, one '
+                             'JSON document per datagram.  Instance statuses '
+                             'are updated as the notifications arrive and '
+                             'answered from until they are older than '
+                             '--cache-ttl, as with --cache-status, so '
+                             '--cache-ttl and --poll-interval can be raised '
+                             'and polling left as a slow safety net.  Only '
+                             'the user running openstackbmc may send to it.')
+    parser.add_argument('--control-socket',
+                        dest='control_socket',
+                        metavar='PATH',
+                        help='Path of a UNIX socket to create for inspecting '
+                             'and adjusting the BMCs while they run, without '
+                             'losing their caches and sessions to a restart.  '
+                             'See --control.')
+    parser.add_argument('--control',
+                        dest='control',
+                        metavar='COMMAND',
+                        help='Send COMMAND to the BMCs listening on '
+                             '--control-socket, or to every worker if they '
+                             'were started with --processes, print the '
+                             'replies and exit.  The commands are "dump '
+                             '[BMC]" to show the cached state of the BMCs '
+                             'and the counters, "flush BMC" and "refresh '
+                             'BMC" to forget or reread the cached state of '
+                             'one BMC, "ttl status|boot-device SECONDS" to '
+                             'change --cache-ttl or --boot-device-ttl, and '
+                             '"log-level LEVEL" to change --log-level.  A '
+                             'BMC is named by its address or by the uuid or '
+                             'name of its instance.')
+    parser.add_argument('--power-workers',
+                        dest='power_workers',
+                        type=int,
+                        default=0,
+                        help='Acknowledge power commands immediately and run '
+                             'the Nova calls on a pool of this many worker '
+                             'threads.  Commands for an instance still run in '
+                             'order.  Defaults to 0, which makes the Nova '
+                             'calls before replying.')
+    parser.add_argument('--startup-timeout',
+                        dest='startup_timeout',
+                        type=float,
+                        default=0,
+                        help='Give up and exit if an instance cannot be found '
+                             'within this many seconds of starting.  Defaults '
+                             'to 0, which retries indefinitely.')
+    parser.add_argument('--api-rate',
+                        dest='api_rate',
+                        type=float,
+                        default=0,
+                        help='Limit the Nova API calls made by this process '
+                             'to API_RATE per second.  Power and boot device '
+                             'changes take precedence over status reads, '
+                             'and reads fall back to the last known value '
+                             'when over the limit.  Defaults to 0, which '
+                             'disables the limit.')
+    parser.add_argument('--api-burst',
+                        dest='api_burst',
+                        type=float,
+                        default=0,
+                        help='With --api-rate, the most Nova API calls that '
+                             'can be made at once.  Defaults to API_RATE.')
+    parser.add_argument('--state-file',
+                        dest='state_file',
+                        help='File in which to remember the uuids of the '
+                             'managed instances, so a restarted BMC does not '
+                             'need to look them up again.  The last known '
+                             'status and boot device of each instance are '
+                             'saved as well, and with --cache-status a '
+                             'restarted BMC answers from them until they '
+                             'are refreshed.')
+    parser.add_argument('--state-interval',
+                        dest='state_interval',
+                        type=float,
+                        default=60,
+                        help='With --state-file, save the state every '
+                             'STATE_INTERVAL seconds as well as on exit.  '
+                             'Defaults to 60.  0 only saves it on exit.')
+    parser.add_argument('--metrics-port',
+                        dest='metrics_port',
+                        type=int,
+                        default=0,
+                        help='Serve metrics in the Prometheus text format '
+                             'over HTTP on this port.  Defaults to 0, which '
+                             'disables the metrics endpoint.')
+    parser.add_argument('--metrics-address',
+                        dest='metrics_address',
+                        default='127.0.0.1',
+                        help='Address for the metrics endpoint to listen on; '
+                             'defaults to 127.0.0.1')
+    parser.add_argument('--profile',
+                        dest='profile',
+                        metavar='DIRECTORY',
+                        help='Profile the handling of each kind of IPMI '
+                             'command with cProfile, and write the results '
+                             'to DIRECTORY/COMMAND.pstats periodically, on '
+                             'SIGUSR1 and on exit.  Packets that open a new '
+                             'session are profiled as session_setup.')
+    parser.add_argument('--profile-interval',
+                        dest='profile_interval',
+                        type=float,
+                        default=60,
+                        help='With --profile, seconds between writes of the '
+                             'profiles.  Defaults to 60.  0 only writes them '
+                             'on SIGUSR1 and on exit.')
+    parser.add_argument('--log-format',
+                        dest='log_format',
+                        choices=['text', 'json'],
+                        default='text',
+                        help='Write log messages as plain text or as one JSON '
+                             'object per line.  Defaults to text.')
+    parser.add_argument('--log-buffered',
+                        dest='log_buffered',
+                        default=False,
+                        action='store_true',
+                        help='Buffer log messages and write them from a '
+                             'background thread so that logging never blocks '
+                             'IPMI requests.')
+    parser.add_argument('--log-level',
+                        dest='log_level',
+                        choices=sorted(LogWriter.LEVELS,
+                                       key=LogWriter.LEVELS.get),
+                        default='info',
+                        help='The lowest level of message to log.  Debug '
+                             'messages explain why a cached status was '
+                             'used.  Defaults to info.')
+    parser.add_argument('--log-status-interval',
+                        dest='log_status_interval',
+                        type=float,
+                        default=0,
+                        help='Only log power state reports when the state '
+                             'changes, plus a count of the repeated reports '
+                             'every LOG_STATUS_INTERVAL seconds.  Defaults to '
+                             '0, which logs every report.')
+    parser.add_argument('--measure-imports',
+                        dest='measure_imports',
+                        default=False,
+                        action='store_true',
+                        help='Report how long importing the BMC and each of '
+                             'its heavy dependencies takes, and exit.  Exits '
+                             'non-zero if starting the BMC imports any of the '
+                             'dependencies that are only meant to be '
+                             'imported when first used.')
     parser.add_argument('--os-cloud',
                         dest='os_cloud',
                         default=os.environ.get('OS_CLOUD'),
                         help='Use the specified cloud from clouds.yaml. '
                              'Defaults to the OS_CLOUD environment variable.')
     args = parser.parse_args()
-    # Default to ipv6 format, but if we get an ipv4 address passed in use the
-    # appropriate format for pyghmi to listen on it.
-    addr_format = '%s'
-    if ':' not in args.address:
-        addr_format = '::ffff:%s'
-    mybmc = OpenStackBmc({'admin': 'password'}, port=args.port,
-                         address=addr_format % args.address,
-                         instance=args.instance,
-                         cache_status=args.cache_status,
-                         os_cloud=args.os_cloud)
-    mybmc.listen()
+    if args.measure_imports:
+        eager = []
+        for name, seconds, loaded in measure_imports():
+            deferred = ' (deferred)' if name in DEFERRED_IMPORTS else ''
+            print('%s: %.3fs%s' % (name, seconds, deferred))
+            if name == 'openstackbmc':
+                eager = loaded
+        if eager:
+            print('Imported at startup: %s' % ', '.join(eager))
+            sys.exit(1)
+        return
+    if args.control:
+        if not args.control_socket:
+            parser.error('--control requires --control-socket')
+        paths = _control_paths(args.control_socket)
+        if not paths:
+            parser.error('No control socket at %s' % args.control_socket)
+        replies = dict((path, send_control(path, args.control))
+                       for path in paths)
+        if len(paths) == 1:
+            print(json.dumps(replies[paths[0]], indent=2, sort_keys=True))
+        else:
+            print(json.dumps(replies, indent=2, sort_keys=True))
+        # With several workers only the one serving a BMC can find it
+        if all('error' in reply for reply in replies.values()):
+            sys.exit(1)
+        return
+    if args.status_table and args.backend == 'simulator':
+        # The simulated instances only exist in the process that made them
+        parser.error('--status-table cannot be used with --backend '
+                     'simulator')
+    if args.status_updater:
+        if not args.status_table or args.poll_interval <= 0:
+            parser.error('--status-updater requires --status-table and '
+                         '--poll-interval')
+        _configure_logging(args)
+        update_status_table(args)
+        return
+    instances = {}
+    if args.instances_file:
+        instances.update(load_instances_file(args.instances_file))
+    instances.update(dict(args.bmcs))
+    if args.instance and instances:
+        parser.error('--instance cannot be used with --instances-file or '
+                     '--bmc')
+    if not args.instance and not instances:
+        parser.error('One of --instance, --instances-file or --bmc is '
+                     'required')
+
+    if args.reload_interval and not args.instances_file:
+        parser.error('--reload-interval requires --instances-file')
+    if args.backend == 'simulator':
+        if args.state_file:
+            # The simulated instances get new uuids every time
+            parser.error('--state-file cannot be used with --backend '
+                         'simulator')
+        try:
+            importlib.import_module('openstack_virtual_baremetal.fakecloud')
+        except ImportError as e:
+            parser.error('--backend simulator is not available: %s' % e)
+
+    if args.instance:
+        instances = {args.address: args.instance}
+    processes = args.processes or multiprocessing.cpu_count()
+    if not args.reload_interval:
+        # Workers with no BMCs would have nothing to do
+        processes = min(processes, len(instances))
+    if processes > 1 and args.shared_socket:
+        parser.error('--shared-socket cannot be used with more than one '
+                     'process')
+    _configure_logging(args)
+    if processes > 1:
+        Supervisor(args, instances, processes).run()
+    else:
+        serve(args, instances)
+
+
+def serve(args, instances, shard=None, ready=None):
+    """Serve BMCs for instances, a dict of addresses and instances, forever
+
+    :param shard: An (index, count) tuple to only serve the addresses of one
+                  worker of a supervisor.
+    :param ready: Called once the BMCs are ready, instead of notifying
+                  systemd.
+    """
+    instances = in_shard(instances, shard)
+    rate_limiter.configure(args.api_rate, args.api_burst)
+    if args.profile:
+        profiler.configure(args.profile, args.profile_interval)
+        signal.signal(signal.SIGUSR1,
+                      lambda signum, frame: profiler.request_dump())
+        atexit.register(profiler.dump)
+
+    # All of the BMCs share one client, and pyghmi's event loop is global to
+    # the process so a single listen() call serves every address.  The client
+    # is only created when it is first used, so BMCs whose instances are
+    # already known from the state file start answering straight away.
+    if args.backend == 'simulator':
+        novaclient = simulated_compute(args, instances.values())
+    else:
+        novaclient = LazyProxy(
+            lambda: os_client_config.make_client('compute',
+                                                 cloud=args.os_cloud))
+    status_table = StatusTable()
+    poller = None
+    if args.status_table:
+        shared = SharedStatusFile(args.status_table)
+        shared.open()
+        poller = SharedStatusPoller(
+            shared, args.poll_interval or SharedStatusPoller.INTERVAL,
+            status_table)
+    elif args.poll_interval > 0:
+        poller = StatusPoller(novaclient, args.poll_interval, status_table)
+    dispatcher = None
+    if args.power_workers > 0:
+        dispatcher = CommandDispatcher(args.power_workers)
+    tracker = None
+    if args.transition_interval > 0:
+        tracker = TransitionTracker(novaclient, status_table,
+                                    args.transition_interval)
+    if args.notification_socket:
+        notifications = NotificationListener(args.notification_socket,
+                                             status_table, tracker)
+        notifications.bind()
+        notifications.start()
+    state = {}
+    if args.state_file:
+        state = load_state(args.state_file)
+    instance_map = dict((k, tuple(v)) for k, v in
+                        state.get('instances', {}).items())
+    unresolved = set(instances.values()) - set(instance_map)
+    if len(unresolved) > 1:
+        # Looking up each instance separately would mean one or two API calls
+        # per BMC, so resolve them all at once.  Anything that does not match
+        # exactly one server is left for the BMC to report.
+        instance_map.update(_retry(
+            lambda: resolve_instances(novaclient, unresolved),
+            'resolving instances', args.startup_timeout))
+
+    def start_bmc(address, instance, instance_map):
+        return OpenStackBmc({'admin': 'password'}, port=args.port,
+                            address=_bmc_address(address),
+                            instance=instance,
+                            cache_status=args.cache_status,
+                            os_cloud=args.os_cloud,
+                            novaclient=novaclient,
+                            poller=poller,
+                            cache_ttl=args.cache_ttl,
+                            status_table=status_table,
+                            dispatcher=dispatcher,
+                            boot_device_ttl=args.boot_device_ttl,
+                            instance_map=instance_map,
+                            startup_timeout=args.startup_timeout,
+                            tracker=tracker,
+                            listener=listener,
+                            notifications=bool(args.notification_socket))
+
+    state_lock = threading.Lock()
+
+    def update_state():
+        if args.state_file:
+            with state_lock:
+                # InstancesWatcher changes bmcs and instances one after the
+                # other from its own thread, so skip any BMC that is missing
+                # from instances.  It is saved next time.
+                running = [(instances.get(address), mybmc)
+                           for address, mybmc in list(bmcs.items())]
+                running = [(instance, mybmc) for instance, mybmc in running
+                           if instance is not None]
+                state['instances'] = dict(
+                    (instance, [mybmc.instance, mybmc.instance_name])
+                    for instance, mybmc in running)
+                state.update(snapshot_state([b for i, b in running],
+                                            status_table))
+                save_state(args.state_file, state)
+
+    listener = None
+    if args.shared_socket:
+        listener = SharedListener(args.port)
+        listener.bind()
+    else:
+        # pyghmi wakes its IO thread through the first socket it opens, which
+        # only works if that socket is bound to a loopback address.  Open one
+        # that is not a BMC's, which also leaves every BMC free to be stopped.
+        ipmisession.Session._assignsocket()
+    bmcs = {}
+    missing = {}
+    # Every address this process serves, whether or not it has started yet
+    wanted = dict(instances)
+    for address in sorted(instances):
+        try:
+            bmcs[address] = start_bmc(address, instances[address],
+                                      instance_map)
+        except InstanceNotFound as e:
+            # Serve the others, and keep trying this one in the background
+            log('Not serving %s yet: %s' % (address, e), level='error')
+            missing[address] = instances.pop(address)
+    # The IO thread may already be waiting on the sockets that existed
+    # before the rest of the BMCs were started
+    _wake_event_loop()
+    restore_state(state, bmcs.values(), status_table)
+    update_state()
+    if args.state_file:
+        # systemd stops the service with SIGTERM, so save the state then
+        # as well as on a normal exit
+        atexit.register(update_state)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        if args.state_interval > 0:
+            saver = threading.Thread(target=_repeat,
+                                     args=(update_state, args.state_interval,
+                                           'saving state'))
+            saver.daemon = True
+            saver.start()
+
+    def announce():
+        # Every instance has been found and every socket bound, so any
+        # requests that arrived meanwhile are answered as soon as the event
+        # loop starts.
+        if ready is not None:
+            ready()
+        else:
+            sd_notify('READY=1\nSTATUS=Serving %d BMCs' % len(bmcs))
+
+    announced = threading.Event()
+
+    def on_change():
+        update_state()
+        # A BMC still looking for its instance does not count as started
+        if not announced.is_set() and watcher.complete:
+            announced.set()
+            announce()
+
+    watcher = None
+    if args.reload_interval:
+        watcher = InstancesWatcher(args.instances_file, args.reload_interval,
+                                   novaclient, bmcs, instances, start_bmc,
+                                   fixed=dict(args.bmcs),
+                                   on_change=on_change, shard=shard)
+        signal.signal(signal.SIGHUP, lambda signum, frame: watcher.wake())
+    elif missing:
+        watcher = InstancesWatcher(None, InstancesWatcher.RETRY_INTERVAL,
+                                   novaclient, bmcs, instances, start_bmc,
+                                   fixed=wanted, on_change=on_change,
+                                   shard=shard)
+    if missing:
+        watcher.reset()
+    if args.control_socket:
+        control = ControlServer(args.control_socket, bmcs, args)
+        control.bind()
+        control.start()
+    if args.metrics_port:
+        start_metrics_server(args.metrics_address, args.metrics_port)
+    if poller is not None:
+        poller.start()
+    if ready is None:
+        watchdog.configure()
+    if missing:
+        if ready is None:
+            sd_notify('STATUS=Waiting for the instances of %s' %
+                      ', '.join(sorted(missing)))
+    else:
+        announced.set()
+        announce()
+    if watcher is not None:
+        watcher.start()
+    if listener is not None:
+        listener.listen()
+    else:
+        OpenStackBmc.listen()
+
+
+def update_status_table(args):
+    """Keep the statuses in args.status_table up to date, forever"""
+    rate_limiter.configure(args.api_rate, args.api_burst)
+    shared = SharedStatusFile(args.status_table)
+    shared.open()
+    novaclient = LazyProxy(
+        lambda: os_client_config.make_client('compute', cloud=args.os_cloud))
+    updater = StatusUpdater(novaclient, args.poll_interval, shared)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if args.metrics_port:
+        start_metrics_server(args.metrics_address, args.metrics_port)
+    updater.start()
+    watchdog.configure()
+    sd_notify('READY=1\nSTATUS=Updating %s' % args.status_table)
+    while updater.is_alive():
+        watchdog.feed()
+        updater.join(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,88 @@
+# Copyright 2026 Red Hat Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import mock
+import testtools
+
+from openstack_virtual_baremetal import bmcbench
+
+
+class TestBmcBench(testtools.TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(50, bmcbench.percentile(values, 50))
+        self.assertEqual(95, bmcbench.percentile(values, 95))
+        self.assertEqual(99, bmcbench.percentile(values, 99))
+        self.assertEqual(7, bmcbench.percentile([7], 99))
+        self.assertIsNone(bmcbench.percentile([], 50))
+
+    def test_summary(self):
+        results = bmcbench.Results()
+        results.record('power_status', 0.1)
+        results.record('power_status', 0.3)
+        results.record('power_on', 0.2, error=True)
+        results.record('power_on', 0.4)
+        summary = results.summary(2.0, {'get': 3, 'start': 1})
+        self.assertEqual(4, summary['commands'])
+        self.assertEqual(1, summary['errors'])
+        self.assertEqual(2.0, summary['commands_per_second'])
+        self.assertEqual(1.0, summary['nova_calls_per_command'])
+        self.assertEqual(0.2, summary['latency']['p50'])
+        self.assertEqual(0.4, summary['latency']['p99'])
+        self.assertEqual({'count': 2, 'errors': 1, 'p50': 0.2, 'p95': 0.4,
+                          'p99': 0.4}, summary['per_command']['power_on'])
+        text = bmcbench.format_summary(summary)
+        self.assertIn('Commands/sec:      2.0', text)
+        self.assertIn('Nova calls: get=3, start=1', text)
+
+    def test_send(self):
+        results = bmcbench.Results()
+        ipmicmd = mock.Mock()
+        ipmicmd.raw_command.return_value = {'data': [1]}
+        bmcbench._send(ipmicmd, 'power_on', results)
+        ipmicmd.raw_command.assert_called_once_with(netfn=0, command=2,
+                                                    data=(1,))
+        self.assertEqual(1, len(results.latencies['power_on']))
+        self.assertEqual(0, results.errors['power_on'])
+
+    def test_send_error(self):
+        results = bmcbench.Results()
+        ipmicmd = mock.Mock()
+        ipmicmd.raw_command.return_value = {'error': 'timeout'}
+        bmcbench._send(ipmicmd, 'power_status', results)
+        self.assertEqual(1, results.errors['power_status'])
+
+    def test_node_address(self):
+        args = bmcbench._parse_args(['--base-port', '1000'])
+        self.assertEqual(('127.0.0.1', 1002), bmcbench.node_address(args, 2))
+        args = bmcbench._parse_args(['--base-port', '1000',
+                                     '--shared-socket'])
+        self.assertEqual(('127.0.1.3', 1000), bmcbench.node_address(args, 2))
+        self.assertEqual(('127.0.2.1', 1000),
+                         bmcbench.node_address(args, 250))
+
+    @mock.patch('pyghmi.ipmi.command.Command')
+    @mock.patch('openstack_virtual_baremetal.bmcbench._request_cipher_suite_3')
+    def test_run(self, mock_cipher, mock_command):
+        mock_command.return_value.raw_command.return_value = {}
+        args = bmcbench._parse_args(['--nodes', '3', '--iterations', '2',
+                                     '--workload', 'deploy'])
+        results = bmcbench.Results()
+        bmcbench.run(args, results)
+        self.assertEqual(3, mock_command.call_count)
+        mock_command.assert_any_call(bmc='127.0.0.1', userid='admin',
+                                     password='password', port=16232)
+        self.assertEqual(3 * 2 * len(bmcbench.WORKLOADS['deploy']),
+                         results.commands)
+        self.assertEqual(3 * 2 * 3, len(results.latencies['power_status']))
@@ -0,0 +1,307 @@
+# Copyright 2026 Red Hat Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+
+import mock
+from novaclient import exceptions
+import testtools
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+
+from openstack_virtual_baremetal import fakecloud
+
+
+class TestFakeCompute(testtools.TestCase):
+    def setUp(self):
+        super(TestFakeCompute, self).setUp()
+        self.compute = fakecloud.FakeCompute()
+        self.server = self.compute.add_server('baremetal-0')
+
+    def test_get(self):
+        server = self.compute.servers.get(self.server.id)
+        self.assertEqual('baremetal-0', server.name)
+        self.assertEqual('ACTIVE', server.status)
+        self.assertIsNone(getattr(server, 'OS-EXT-STS:task_state'))
+        self.assertEqual({'get': 1}, self.compute.calls)
+
+    def test_get_not_found(self):
+        self.assertRaises(exceptions.NotFound, self.compute.servers.get,
+                          'missing')
+
+    def test_get_snapshot(self):
+        server = self.compute.servers.get(self.server.id)
+        self.compute.servers.set_meta_item(self.server.id,
+                                           'libvirt:pxe-first', '1')
+        self.assertEqual({}, server.metadata)
+        server = self.compute.servers.get(self.server.id)
+        self.assertEqual({'libvirt:pxe-first': '1'}, server.metadata)
+
+    def test_list(self):
+        self.compute.add_server('baremetal-1')
+        self.compute.add_server('undercloud')
+        servers = self.compute.servers.list()
+        self.assertEqual(3, len(servers))
+        servers = self.compute.servers.list(
+            search_opts={'name': '^baremetal-1$'})
+        self.assertEqual(['baremetal-1'], [s.name for s in servers])
+        self.assertEqual(2, self.compute.total_calls)
+
+    @mock.patch.object(fakecloud.FakeServerManager, 'MAX_LIMIT', 2)
+    def test_list_paging(self):
+        self.compute.add_server('baremetal-1')
+        self.compute.add_server('undercloud')
+        first = self.compute.servers.list()
+        self.assertEqual(2, len(first))
+        rest = self.compute.servers.list(marker=first[-1].id)
+        self.assertEqual(['undercloud'], [s.name for s in rest])
+        self.assertEqual(1, len(self.compute.servers.list(limit=1)))
+        self.assertEqual(3, len(self.compute.servers.list(limit=-1)))
+        self.assertRaises(exceptions.BadRequest, self.compute.servers.list,
+                          marker='missing')
+
+    def test_stop_start(self):
+        self.compute.servers.stop(self.server.id)
+        self.assertEqual('SHUTOFF',
+                         self.compute.servers.get(self.server.id).status)
+        self.compute.servers.start(self.server.id)
+        self.assertEqual('ACTIVE',
+                         self.compute.servers.get(self.server.id).status)
+
+    def test_start_active_conflict(self):
+        self.assertRaises(exceptions.Conflict, self.compute.servers.start,
+                          self.server.id)
+
+    @mock.patch('time.time')
+    def test_transition(self, mock_time):
+        mock_time.return_value = 100
+        self.compute.transition_time = 5
+        self.compute.servers.stop(self.server.id)
+        server = self.compute.servers.get(self.server.id)
+        self.assertEqual('ACTIVE', server.status)
+        self.assertEqual('powering-off',
+                         getattr(server, 'OS-EXT-STS:task_state'))
+        self.assertRaises(exceptions.Conflict, self.compute.servers.reboot,
+                          self.server.id, reboot_type='HARD')
+        mock_time.return_value = 105
+        server = self.compute.servers.get(self.server.id)
+        self.assertEqual('SHUTOFF', server.status)
+        self.assertIsNone(getattr(server, 'OS-EXT-STS:task_state'))
+
+    @mock.patch('time.time')
+    def test_hard_reboot(self, mock_time):
+        mock_time.return_value = 100
+        self.compute.transition_time = 5
+        self.compute.servers.reboot(self.server.id, reboot_type='HARD')
+        self.assertEqual('HARD_REBOOT',
+                         self.compute.servers.get(self.server.id).status)
+        mock_time.return_value = 105
+        self.assertEqual('ACTIVE',
+                         self.compute.servers.get(self.server.id).status)
+
+    @mock.patch('time.time')
+    def test_boot_shutdown_time(self, mock_time):
+        mock_time.return_value = 100
+        self.compute.transition_time = 1
+        self.compute.boot_time = 10
+        self.compute.shutdown_time = 5
+        self.compute.servers.stop(self.server.id)
+        mock_time.return_value = 104
+        self.assertEqual('ACTIVE',
+                         self.compute.servers.get(self.server.id).status)
+        mock_time.return_value = 105
+        self.assertEqual('SHUTOFF',
+                         self.compute.servers.get(self.server.id).status)
+        self.compute.servers.start(self.server.id)
+        mock_time.return_value = 114
+        self.assertEqual('SHUTOFF',
+                         self.compute.servers.get(self.server.id).status)
+        mock_time.return_value = 115
+        self.assertEqual('ACTIVE',
+                         self.compute.servers.get(self.server.id).status)
+
+    def test_power_failure(self):
+        self.compute.power_failure_rate = 1
+        self.compute.servers.stop(self.server.id)
+        server = self.compute.servers.get(self.server.id)
+        self.assertEqual('ACTIVE', server.status)
+        self.assertIsNone(getattr(server, 'OS-EXT-STS:task_state'))
+
+    def test_error_rate(self):
+        self.compute.error_rate = 1
+        e = self.assertRaises(exceptions.ClientException,
+                              self.compute.servers.list)
+        self.assertEqual(503, e.code)
+        self.assertEqual({'list': 1}, self.compute.calls)
+
+    @mock.patch('time.sleep')
+    def test_latency(self, mock_sleep):
+        compute = fakecloud.FakeCompute(latency=0.1, jitter=0.05, seed=1)
+        compute.servers.list()
+        delay = mock_sleep.call_args[0][0]
+        self.assertTrue(0.1 <= delay <= 0.15)
+
+    def test_reset_calls(self):
+        self.compute.servers.list()
+        self.compute.reset_calls()
+        self.assertEqual(0, self.compute.total_calls)
+
+
+class TestFakeCloud(testtools.TestCase):
+    def setUp(self):
+        super(TestFakeCloud, self).setUp()
+        self.cloud = fakecloud.FakeCloud()
+        self.cloud.populate(3)
+
+    def test_populate(self):
+        servers = self.cloud.compute.servers.list()
+        self.assertEqual(['bmc', 'baremetal_0', 'baremetal_1', 'baremetal_2',
+                          'undercloud'], [s.name for s in servers])
+        self.assertEqual(9, len(self.cloud.ports))
+        ports = [p['name'] for p in self.cloud.ports.values()]
+        self.assertEqual(3, len([p for p in ports if p.startswith('bmc')]))
+        addresses = servers[1].addresses['provision'][0]
+        self.assertEqual('10.1.1.1', addresses['addr'])
+
+    def test_populate_boot_from_volume(self):
+        cloud = fakecloud.FakeCloud()
+        cloud.populate(1, boot_from_volume=True)
+        server = cloud.compute.servers.list(
+            search_opts={'name': 'baremetal_0'})[0]
+        self.assertEqual('', server.image)
+        volume = server.to_dict()['os-extended-volumes:volumes_attached'][0]
+        self.assertEqual(40, cloud.volumes[volume['id']]['size'])
+
+    def test_token(self):
+        status, body, headers = self.cloud.handle(
+            'POST', '/identity/v3/auth/tokens', body={})
+        self.assertEqual(201, status)
+        self.assertIn('X-Subject-Token', headers)
+        types = [s['type'] for s in body['token']['catalog']]
+        for service_type in ('compute', 'network', 'image', 'volumev3',
+                             'orchestration'):
+            self.assertIn(service_type, types)
+
+    def test_list_servers(self):
+        status, body, _ = self.cloud.handle(
+            'GET', '/compute/v2.1/servers/detail', {'name': '^undercloud$'})
+        self.assertEqual(200, status)
+        self.assertEqual(['undercloud'], [s['name'] for s in body['servers']])
+
+    def test_list_servers_paging(self):
+        status, body, _ = self.cloud.handle(
+            'GET', '/compute/v2.1/servers/detail', {'limit': '2'})
+        self.assertEqual(['bmc', 'baremetal_0'],
+                         [s['name'] for s in body['servers']])
+        status, body, _ = self.cloud.handle(
+            'GET', '/compute/v2.1/servers/detail',
+            {'marker': body['servers'][-1]['id']})
+        self.assertEqual(['baremetal_1', 'baremetal_2', 'undercloud'],
+                         [s['name'] for s in body['servers']])
+
+    def test_server_action(self):
+        server = self.cloud.compute.servers.list(
+            search_opts={'name': 'baremetal_0'})[0]
+        path = '/compute/v2.1/servers/%s' % server.id
+        status, _, _ = self.cloud.handle('POST', path + '/action',
+                                         body={'os-start': None})
+        self.assertEqual(202, status)
+        status, body, _ = self.cloud.handle('GET', path)
+        self.assertEqual('ACTIVE', body['server']['status'])
+        status, body, _ = self.cloud.handle('POST', path + '/action',
+                                            body={'os-start': None})
+        self.assertEqual(409, status)
+
+    def test_not_found(self):
+        status, _, _ = self.cloud.handle('GET', '/compute/v2.1/servers/foo')
+        self.assertEqual(404, status)
+        status, _, _ = self.cloud.handle('GET', '/nothing')
+        self.assertEqual(404, status)
+
+    def test_list_ports_filter(self):
+        server = self.cloud.compute.servers.list(
+            search_opts={'name': 'baremetal_1'})[0]
+        status, body, _ = self.cloud.handle('GET', '/network/v2.0/ports',
+                                            {'device_id': server.id})
+        self.assertEqual(['baremetal_1'], [p['name'] for p in body['ports']])
+        self.assertNotIn('_prefix', self.cloud.handle(
+            'GET', '/network/v2.0/subnets')[1]['subnets'][0])
+
+    @mock.patch('time.time')
+    def test_stack(self, mock_time):
+        mock_time.return_value = 100
+        self.cloud.stack_create_time = 10
+        path = '/orchestration/v1/%s/stacks' % self.cloud.project_id
+        status, body, _ = self.cloud.handle('POST', path,
+                                            body={'stack_name': 'foo'})
+        self.assertEqual(201, status)
+        stack_id = body['stack']['id']
+        status, body, _ = self.cloud.handle('GET', path + '/foo')
+        self.assertEqual('CREATE_IN_PROGRESS', body['stack']['stack_status'])
+        self.assertNotIn('_events', body['stack'])
+        mock_time.return_value = 110
+        status, body, _ = self.cloud.handle('GET',
+                                            path + '/foo/%s' % stack_id)
+        self.assertEqual('CREATE_COMPLETE', body['stack']['stack_status'])
+        status, body, _ = self.cloud.handle('GET', path + '/foo/events')
+        self.assertEqual(['CREATE_IN_PROGRESS', 'CREATE_COMPLETE'],
+                         [e['resource_status'] for e in body['events']])
+        status, _, _ = self.cloud.handle('POST', path,
+                                         body={'stack_name': 'foo'})
+        self.assertEqual(409, status)
+
+    def test_error_injection(self):
+        self.cloud.error_rate = 1
+        status, _, _ = self.cloud.handle('GET', '/network/v2.0/ports')
+        self.assertEqual(503, status)
+        # Authentication is never failed
+        status, _, _ = self.cloud.handle('POST', '/identity/v3/auth/tokens',
+                                         body={})
+        self.assertEqual(201, status)
+        self.assertEqual({'list_ports': 1, 'create_token': 1},
+                         self.cloud.calls)
+
+    @mock.patch('time.sleep')
+    def test_latency(self, mock_sleep):
+        self.cloud.latency = 0.5
+        self.cloud.handle('GET', '/network/v2.0/ports')
+        mock_sleep.assert_called_once_with(0.5)
+
+
+class TestFakeCloudServer(testtools.TestCase):
+    def test_request(self):
+        cloud = fakecloud.FakeCloud()
+        cloud.populate(1)
+        server = fakecloud.FakeCloudServer(cloud)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        server.start()
+        self.assertEqual('http://127.0.0.1:%d' % server.server_address[1],
+                         cloud.base_url)
+        conn = httplib.HTTPConnection('127.0.0.1', server.server_address[1])
+        conn.request('GET', '/network/v2.0/ports?name=baremetal_0')
+        response = conn.getresponse()
+        self.assertEqual(200, response.status)
+        body = json.loads(response.read().decode('utf-8'))
+        self.assertEqual(['baremetal_0'], [p['name'] for p in body['ports']])
+        conn.close()
+
+    def test_clouds_yaml(self):
+        cloud = fakecloud.FakeCloud()
+        cloud.base_url = 'http://127.0.0.1:5050'
+        config = cloud.clouds_yaml()['clouds']['fakecloud']
+        self.assertEqual('http://127.0.0.1:5050/identity/v3',
+                         config['auth']['auth_url'])
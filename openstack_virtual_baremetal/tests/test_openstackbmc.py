@@ -12,8 +12,20 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import collections
+import json
+import os
+import pstats
+import signal
+import socket
 import sys
+import threading
+import time
 import unittest
+try:
+    import httplib as http_client
+except ImportError:
+    from http import client as http_client
 
 import fixtures
 import mock
@@ -30,14 +42,17 @@ from openstack_virtual_baremetal import openstackbmc
             '_find_instance')
 @mock.patch('os_client_config.make_client')
 class TestOpenStackBmcInit(testtools.TestCase):
+    def _server(self):
+        mock_server = mock.Mock()
+        mock_server.id = 'abc-123'
+        mock_server.name = 'foo-instance'
+        return mock_server
+
     def test_init_os_cloud(self, mock_make_client, mock_find_instance,
                            mock_bmc_init, mock_log):
         mock_client = mock.Mock()
-        mock_server = mock.Mock()
-        mock_server.name = 'foo-instance'
-        mock_client.servers.get.return_value = mock_server
         mock_make_client.return_value = mock_client
-        mock_find_instance.return_value = 'abc-123'
+        mock_find_instance.return_value = self._server()
         bmc = openstackbmc.OpenStackBmc(authdata={'admin': 'password'},
                                         port=623,
                                         address='::ffff:127.0.0.1',
@@ -49,20 +64,69 @@ class TestOpenStackBmcInit(testtools.TestCase):
         mock_make_client.assert_called_once_with('compute', cloud='bar')
         mock_find_instance.assert_called_once_with('foo')
         self.assertEqual('abc-123', bmc.instance)
-        mock_client.servers.get.assert_called_once_with('abc-123')
+        self.assertEqual('foo-instance', bmc.instance_name)
+        self.assertFalse(mock_client.servers.get.called)
         mock_log.assert_called_once_with('Managing instance: %s UUID: %s' %
                                          ('foo-instance', 'abc-123'))
 
+    def test_init_listener(self, mock_make_client, mock_find_instance,
+                           mock_bmc_init, mock_log):
+        mock_find_instance.return_value = self._server()
+        mock_listener = mock.Mock()
+        bmc = openstackbmc.OpenStackBmc(authdata={'admin': 'password'},
+                                        port=623,
+                                        address='::ffff:127.0.0.1',
+                                        instance='foo',
+                                        cache_status=False,
+                                        os_cloud='bar',
+                                        listener=mock_listener)
+        # Bound to a free port, then moved onto the listener
+        mock_bmc_init.assert_called_once_with({'admin': 'password'}, port=0,
+                                              address='::ffff:127.0.0.1')
+        mock_listener.attach.assert_called_once_with(bmc, '::ffff:127.0.0.1')
+
+    def test_init_shared_client(self, mock_make_client, mock_find_instance,
+                                mock_bmc_init, mock_log):
+        mock_client = mock.Mock()
+        mock_find_instance.return_value = self._server()
+        bmc = openstackbmc.OpenStackBmc(authdata={'admin': 'password'},
+                                        port=623,
+                                        address='::ffff:127.0.0.1',
+                                        instance='foo',
+                                        cache_status=False,
+                                        os_cloud='bar',
+                                        novaclient=mock_client
+                                        )
+        self.assertFalse(mock_make_client.called)
+        self.assertIs(mock_client, bmc.novaclient)
+
+    def test_init_instance_map(self, mock_make_client, mock_find_instance,
+                               mock_bmc_init, mock_log):
+        mock_client = mock.Mock()
+        bmc = openstackbmc.OpenStackBmc(
+            authdata={'admin': 'password'},
+            port=623,
+            address='::ffff:127.0.0.1',
+            instance='foo',
+            cache_status=False,
+            os_cloud='bar',
+            novaclient=mock_client,
+            instance_map={'foo': ('abc-123', 'foo-instance')})
+        self.assertFalse(mock_find_instance.called)
+        self.assertFalse(mock_client.mock_calls)
+        self.assertEqual('abc-123', bmc.instance)
+        self.assertEqual('foo-instance', bmc.instance_name)
+        # Not confirmed until Nova is asked about it
+        self.assertFalse(bmc.verified)
+
     @mock.patch('time.sleep')
-    def test_init_retry(self, _, mock_make_client, mock_find_instance,
-                        mock_bmc_init, mock_log):
+    def test_init_retry(self, mock_sleep, mock_make_client,
+                        mock_find_instance, mock_bmc_init, mock_log):
         self.useFixture(fixtures.EnvironmentVariable('OS_CLOUD', None))
         mock_client = mock.Mock()
-        mock_server = mock.Mock()
-        mock_server.name = 'foo-instance'
-        mock_client.servers.get.return_value = mock_server
         mock_make_client.return_value = mock_client
-        mock_find_instance.side_effect = (Exception, 'abc-123')
+        mock_find_instance.side_effect = (Exception, Exception,
+                                          self._server())
         bmc = openstackbmc.OpenStackBmc(authdata={'admin': 'password'},
                                         port=623,
                                         address='::ffff:127.0.0.1',
@@ -71,16 +135,57 @@ class TestOpenStackBmcInit(testtools.TestCase):
                                         os_cloud='foo'
                                         )
         mock_make_client.assert_called_once_with('compute', cloud='foo')
-        find_calls = [mock.call('foo'), mock.call('foo')]
+        find_calls = [mock.call('foo'), mock.call('foo'), mock.call('foo')]
         self.assertEqual(find_calls, mock_find_instance.mock_calls)
         self.assertEqual('abc-123', bmc.instance)
-        mock_client.servers.get.assert_called_once_with('abc-123')
         log_calls = [mock.call('Exception finding instance "%s": %s' %
-                               ('foo', '')),
+                               ('foo', ''), level='error'),
+                     mock.call('Exception finding instance "%s": %s' %
+                               ('foo', ''), level='error'),
                      mock.call('Managing instance: %s UUID: %s' %
                                ('foo-instance', 'abc-123'))
                      ]
         self.assertEqual(log_calls, mock_log.mock_calls)
+        # Exponential backoff with jitter
+        first, second = [c[1][0] for c in mock_sleep.mock_calls]
+        self.assertTrue(0.25 <= first <= 0.5)
+        self.assertTrue(0.5 <= second <= 1)
+
+    @mock.patch('time.sleep')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc._now')
+    def test_init_timeout(self, mock_now, mock_sleep, mock_make_client,
+                          mock_find_instance, mock_bmc_init, mock_log):
+        mock_now.side_effect = [0, 5, 11]
+        mock_find_instance.side_effect = Exception
+        self.assertRaises(SystemExit,
+                          openstackbmc.OpenStackBmc,
+                          authdata={'admin': 'password'},
+                          port=623,
+                          address='::ffff:127.0.0.1',
+                          instance='foo',
+                          cache_status=False,
+                          os_cloud='foo',
+                          startup_timeout=10)
+        self.assertEqual(2, mock_find_instance.call_count)
+        mock_log.assert_called_with('Timed out finding instance "foo"',
+                                    level='error')
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.OpenStackBmc.'
+                '_close_socket')
+    def test_init_not_found(self, mock_close, mock_make_client,
+                            mock_find_instance, mock_bmc_init, mock_log):
+        mock_find_instance.side_effect = openstackbmc.InstanceNotFound
+        self.assertRaises(openstackbmc.InstanceNotFound,
+                          openstackbmc.OpenStackBmc,
+                          authdata={'admin': 'password'},
+                          port=623,
+                          address='::ffff:127.0.0.1',
+                          instance='foo',
+                          cache_status=False,
+                          os_cloud='foo')
+        # Not retried, and the address is free for another attempt
+        mock_find_instance.assert_called_once_with('foo')
+        mock_close.assert_called_once_with()
 
 
 @mock.patch('openstack_virtual_baremetal.openstackbmc.OpenStackBmc.'
@@ -101,16 +206,28 @@ class TestOpenStackBmc(unittest.TestCase):
                                              )
         self.bmc.novaclient = self.mock_client
         self.bmc.instance = 'abc-123'
-        self.bmc.cached_status = None
+        self.bmc.query = 'foo'
+        self.bmc.verified = True
         self.bmc.target_status = None
         self.bmc.cache_status = False
+        self.bmc.cache_ttl = None
+        self.bmc.poller = None
+        self.bmc.dispatcher = None
+        self.bmc.tracker = None
+        self.bmc.notifications = False
+        self.bmc.single_flight = openstackbmc.SingleFlight()
+        self.bmc.boot_device = None
+        self.bmc.boot_device_time = None
+        self.bmc.boot_device_ttl = None
+        self.bmc.status_table = openstackbmc.StatusTable()
 
     def test_find_instance(self, mock_nova, mock_log, mock_init):
         self._create_bmc(mock_nova)
         mock_server = mock.Mock()
         self.mock_client.servers.get.return_value = mock_server
         instance = self.bmc._find_instance('abc-123')
-        self.assertEqual('abc-123', instance)
+        self.assertEqual(mock_server, instance)
+        self.mock_client.servers.get.assert_called_once_with('abc-123')
 
     def test_find_instance_by_name(self, mock_nova, mock_log, mock_init):
         self._create_bmc(mock_nova)
@@ -119,26 +236,74 @@ class TestOpenStackBmc(unittest.TestCase):
         self.mock_client.servers.get.side_effect = exceptions.NotFound('foo')
         self.mock_client.servers.list.return_value = [mock_server]
         instance = self.bmc._find_instance('abc-123')
-        self.assertEqual('abc-123', instance)
+        self.assertEqual(mock_server, instance)
 
-    @mock.patch('sys.exit')
-    def test_find_instance_multiple(self, mock_exit, mock_nova, mock_log,
-                                    mock_init):
+    def test_find_instance_multiple(self, mock_nova, mock_log, mock_init):
         self._create_bmc(mock_nova)
         mock_server = mock.Mock()
         self.mock_client.servers.get.side_effect = exceptions.NotFound('foo')
         self.mock_client.servers.list.return_value = [mock_server, mock_server]
-        self.bmc._find_instance('abc-123')
-        mock_exit.assert_called_once_with(1)
+        self.assertRaises(openstackbmc.InstanceNotFound,
+                          self.bmc._find_instance, 'abc-123')
 
-    @mock.patch('sys.exit')
-    def test_find_instance_not_found(self, mock_exit, mock_nova, mock_log,
-                                     mock_init):
+    def test_find_instance_not_found(self, mock_nova, mock_log, mock_init):
         self._create_bmc(mock_nova)
         self.mock_client.servers.get.side_effect = exceptions.NotFound('foo')
         self.mock_client.servers.list.return_value = []
-        self.bmc._find_instance('abc-123')
-        mock_exit.assert_called_once_with(1)
+        self.assertRaises(openstackbmc.InstanceNotFound,
+                          self.bmc._find_instance, 'abc-123')
+
+    def test_saved_instance_recreated(self, mock_nova, mock_log, mock_init):
+        self._create_bmc(mock_nova)
+        self.bmc.verified = False
+        self.bmc.instance_name = 'foo'
+        self.bmc.poller = openstackbmc.StatusPoller(self.mock_client, 10)
+        self.bmc.poller.add('abc-123')
+        mock_server = mock.Mock()
+        mock_server.id = 'def-456'
+        mock_server.name = 'foo'
+        mock_server.status = 'SHUTOFF'
+        mock_server.metadata = {}
+        # The saved uuid, then the name, are not found
+        self.mock_client.servers.get.side_effect = [
+            exceptions.NotFound('abc-123'), exceptions.NotFound('foo'),
+            mock_server]
+        self.mock_client.servers.list.return_value = [mock_server]
+        self.assertFalse(self.bmc.get_power_state())
+        self.assertEqual([mock.call('abc-123'), mock.call('foo'),
+                          mock.call('def-456')],
+                         self.mock_client.servers.get.call_args_list)
+        self.assertEqual('def-456', self.bmc.instance)
+        self.assertTrue(self.bmc.verified)
+        self.assertEqual(set(['def-456']), self.bmc.poller.instances)
+        self.assertEqual('SHUTOFF', self.bmc.status_table.get('def-456'))
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.OpenStackBmc.'
+                '_instance_active', return_value=False)
+    def test_saved_instance_recreated_power_on(self, mock_active, mock_nova,
+                                               mock_log, mock_init):
+        self._create_bmc(mock_nova)
+        self.bmc.verified = False
+        self.bmc.instance_name = 'foo'
+        mock_server = mock.Mock()
+        mock_server.id = 'def-456'
+        self.mock_client.servers.get.side_effect = exceptions.NotFound('foo')
+        self.mock_client.servers.list.return_value = [mock_server]
+        self.mock_client.servers.start.side_effect = [
+            exceptions.NotFound('abc-123'), None]
+        self.bmc.power_on()
+        self.assertEqual([mock.call('abc-123'), mock.call('def-456')],
+                         self.mock_client.servers.start.call_args_list)
+
+    def test_verified_instance_not_found(self, mock_nova, mock_log,
+                                         mock_init):
+        self._create_bmc(mock_nova)
+        self.assertTrue(self.bmc.verified)
+        self.mock_client.servers.get.side_effect = exceptions.NotFound('foo')
+        self.assertRaises(exceptions.NotFound, self.bmc.get_power_state)
+        self.mock_client.servers.get.assert_called_once_with('abc-123')
+        self.assertFalse(self.mock_client.servers.list.called)
+        self.assertEqual('abc-123', self.bmc.instance)
 
     def test_get_boot_device(self, mock_nova, mock_log, mock_init):
         self._create_bmc(mock_nova)
@@ -166,9 +331,11 @@ class TestOpenStackBmc(unittest.TestCase):
         self.mock_client.servers.get.return_value = mock_server
         self.bmc.set_boot_device('hd')
         self.mock_client.servers.set_meta_item.assert_called_once_with(
-            mock_server,
+            'abc-123',
             'libvirt:pxe-first',
             '')
+        self.assertFalse(self.mock_client.servers.get.called)
+        self.assertEqual('hd', self.bmc.boot_device)
 
     def test_set_boot_device_net(self, mock_nova, mock_log, mock_init):
         self._create_bmc(mock_nova)
@@ -176,9 +343,72 @@ class TestOpenStackBmc(unittest.TestCase):
         self.mock_client.servers.get.return_value = mock_server
         self.bmc.set_boot_device('network')
         self.mock_client.servers.set_meta_item.assert_called_once_with(
-            mock_server,
+            'abc-123',
             'libvirt:pxe-first',
             '1')
+        self.assertFalse(self.mock_client.servers.get.called)
+        self.assertEqual('network', self.bmc.boot_device)
+
+    def test_set_boot_device_saved_instance_recreated(self, mock_nova,
+                                                      mock_log, mock_init):
+        self._create_bmc(mock_nova)
+        self.bmc.verified = False
+        self.bmc.instance_name = 'foo'
+        mock_server = mock.Mock()
+        mock_server.id = 'def-456'
+        self.mock_client.servers.get.side_effect = exceptions.NotFound('foo')
+        self.mock_client.servers.list.return_value = [mock_server]
+        self.mock_client.servers.set_meta_item.side_effect = [
+            exceptions.NotFound('abc-123'), None]
+        self.bmc.set_boot_device('network')
+        self.assertEqual(
+            [mock.call('abc-123', 'libvirt:pxe-first', '1'),
+             mock.call('def-456', 'libvirt:pxe-first', '1')],
+            self.mock_client.servers.set_meta_item.call_args_list)
+        self.assertEqual('def-456', self.bmc.instance)
+        self.assertEqual('network', self.bmc.boot_device)
+
+    def test_boot_device_cached(self, mock_nova, mock_log, mock_init):
+        self._create_bmc(mock_nova)
+        self.bmc.cache_status = True
+        self.bmc.boot_device_ttl = 300
+        self.bmc.set_boot_device('network')
+        self.assertEqual('network', self.bmc.get_boot_device())
+        self.assertFalse(self.mock_client.servers.get.called)
+
+    def test_boot_device_cache_expired(self, mock_nova, mock_log, mock_init):
+        self._create_bmc(mock_nova)
+        self.bmc.cache_status = True
+        self.bmc.boot_device_ttl = 300
+        self.bmc.boot_device = 'network'
+        self.bmc.boot_device_time = openstackbmc._now() - 600
+        mock_server = mock.Mock()
+        mock_server.metadata = {}
+        self.mock_client.servers.get.return_value = mock_server
+        self.assertEqual('hd', self.bmc.get_boot_device())
+        self.mock_client.servers.get.assert_called_once_with('abc-123')
+        self.assertEqual('hd', self.bmc.boot_device)
+
+    def test_boot_device_cache_disabled(self, mock_nova, mock_log,
+                                        mock_init):
+        self._create_bmc(mock_nova)
+        self.bmc.boot_device_ttl = 300
+        self.bmc.set_boot_device('network')
+        mock_server = mock.Mock()
+        mock_server.metadata = {}
+        self.mock_client.servers.get.return_value = mock_server
+        self.assertEqual('hd', self.bmc.get_boot_device())
+        self.mock_client.servers.get.assert_called_once_with('abc-123')
+
+    def test_fetch_status_caches_boot_device(self, mock_nova, mock_log,
+                                             mock_init):
+        self._create_bmc(mock_nova)
+        mock_server = mock.Mock()
+        mock_server.status = 'ACTIVE'
+        mock_server.metadata = {'libvirt:pxe-first': '1'}
+        self.mock_client.servers.get.return_value = mock_server
+        self.assertEqual('ACTIVE', self.bmc._fetch_status())
+        self.assertEqual('network', self.bmc.boot_device)
 
     def test_instance_active(self, mock_nova, mock_log, mock_init):
         self._create_bmc(mock_nova)
@@ -194,32 +424,134 @@ class TestOpenStackBmc(unittest.TestCase):
         self.mock_client.servers.get.return_value = mock_server
         self.assertFalse(self.bmc._instance_active())
 
+    def test_instance_active_rebooting(self, mock_nova, mock_log,
+                                       mock_init):
+        self._create_bmc(mock_nova)
+        mock_server = mock.Mock()
+        mock_server.status = 'HARD_REBOOT'
+        self.mock_client.servers.get.return_value = mock_server
+        self.assertTrue(self.bmc._instance_active())
+
+    def test_instance_active_rebooting_cached(self, mock_nova, mock_log,
+                                              mock_init):
+        self._create_bmc(mock_nova)
+        self.bmc.target_status = 'ACTIVE'
+        self.bmc.status_table.update('abc-123', 'HARD_REBOOT')
+        self.bmc.cache_status = True
+        self.assertTrue(self.bmc._instance_active())
+        self.assertFalse(self.mock_client.servers.get.called)
+
     def test_instance_active_mismatch(self, mock_nova, mock_log, mock_init):
         self._create_bmc(mock_nova)
         mock_server = mock.Mock()
         mock_server.status = 'ACTIVE'
         self.mock_client.servers.get.return_value = mock_server
         self.bmc.target_status = 'ACTIVE'
-        self.bmc.cached_status = 'SHUTOFF'
+        self.bmc.status_table.update('abc-123', 'SHUTOFF')
         self.bmc.cache_status = True
         self.assertTrue(self.bmc._instance_active())
+        self.assertEqual('ACTIVE', self.bmc.status_table.get('abc-123'))
 
     def test_instance_active_cached(self, mock_nova, mock_log, mock_init):
         self._create_bmc(mock_nova)
         self.bmc.target_status = 'ACTIVE'
-        self.bmc.cached_status = 'ACTIVE'
+        self.bmc.status_table.update('abc-123', 'ACTIVE')
+        self.bmc.cache_status = True
+        self.assertTrue(self.bmc._instance_active())
+        self.assertFalse(self.mock_client.servers.get.called)
+
+    @mock.patch('threading.Thread')
+    def test_instance_active_cache_fresh(self, mock_thread, mock_nova,
+                                         mock_log, mock_init):
+        self._create_bmc(mock_nova)
+        self.bmc.status_table.update('abc-123', 'ACTIVE')
+        self.bmc.cache_status = True
+        self.bmc.cache_ttl = 30
+        self.assertTrue(self.bmc._instance_active())
+        self.assertFalse(mock_thread.called)
+        self.assertFalse(self.mock_client.servers.get.called)
+
+    @mock.patch('threading.Thread')
+    def test_instance_active_cache_expired(self, mock_thread, mock_nova,
+                                           mock_log, mock_init):
+        self._create_bmc(mock_nova)
+        self.bmc.status_table.update('abc-123', 'ACTIVE',
+                                     openstackbmc._now() - 60)
         self.bmc.cache_status = True
+        self.bmc.cache_ttl = 30
+        # The stale value is served while the refresh happens in the
+        # background
         self.assertTrue(self.bmc._instance_active())
         self.assertFalse(self.mock_client.servers.get.called)
+        mock_thread.assert_called_once_with(
+            target=self.bmc._refresh_status)
+        mock_thread.return_value.start.assert_called_once_with()
+        # Only one refresh at a time
+        self.assertTrue(self.bmc._instance_active())
+        self.assertEqual(1, mock_thread.call_count)
+
+    def test_refresh_status(self, mock_nova, mock_log, mock_init):
+        self._create_bmc(mock_nova)
+        mock_server = mock.Mock()
+        mock_server.status = 'SHUTOFF'
+        self.mock_client.servers.get.return_value = mock_server
+        self.bmc.status_table.update('abc-123', 'ACTIVE',
+                                     openstackbmc._now() - 60)
+        self.assertTrue(self.bmc.status_table.start_refresh('abc-123'))
+        self.bmc._refresh_status()
+        status, age = self.bmc.status_table.lookup('abc-123')
+        self.assertEqual('SHUTOFF', status)
+        self.assertLess(age, 30)
+        self.assertTrue(self.bmc.status_table.start_refresh('abc-123'))
+
+    def test_refresh_status_error(self, mock_nova, mock_log, mock_init):
+        self._create_bmc(mock_nova)
+        self.mock_client.servers.get.side_effect = Exception('boom')
+        self.assertTrue(self.bmc.status_table.start_refresh('abc-123'))
+        self.bmc._refresh_status()
+        self.assertTrue(mock_log.called)
+        self.assertTrue(self.bmc.status_table.start_refresh('abc-123'))
 
     def test_cache_disabled(self, mock_nova, mock_log, mock_init):
         self._create_bmc(mock_nova)
         self.bmc.target_status = 'ACTIVE'
-        self.bmc.cached_status = 'ACTIVE'
+        self.bmc.status_table.update('abc-123', 'ACTIVE')
+        mock_server = mock.Mock()
+        mock_server.status = 'SHUTOFF'
+        self.mock_client.servers.get.return_value = mock_server
+        self.assertFalse(self.bmc._instance_active())
+
+    def test_instance_active_poller(self, mock_nova, mock_log, mock_init):
+        self._create_bmc(mock_nova)
+        self.bmc.poller = openstackbmc.StatusPoller(self.mock_client, 10,
+                                                    self.bmc.status_table)
+        self.bmc.status_table.update('abc-123', 'ACTIVE')
+        self.assertTrue(self.bmc._instance_active())
+        self.assertFalse(self.mock_client.servers.get.called)
+
+    def test_instance_active_notifications(self, mock_nova, mock_log,
+                                           mock_init):
+        self._create_bmc(mock_nova)
+        self.bmc.notifications = True
+        listener = openstackbmc.NotificationListener(
+            '/run/notifications', self.bmc.status_table, None)
+        self.assertTrue(listener.handle(json.dumps({
+            'event_type': 'instance.power_on.end',
+            'payload': {'nova_object.data': {'uuid': 'abc-123',
+                                             'state': 'active'}}})))
+        self.assertTrue(self.bmc._instance_active())
+        self.assertFalse(self.mock_client.servers.get.called)
+
+    def test_instance_active_poller_unknown(self, mock_nova, mock_log,
+                                            mock_init):
+        self._create_bmc(mock_nova)
+        self.bmc.poller = openstackbmc.StatusPoller(self.mock_client, 10,
+                                                    self.bmc.status_table)
         mock_server = mock.Mock()
         mock_server.status = 'SHUTOFF'
         self.mock_client.servers.get.return_value = mock_server
         self.assertFalse(self.bmc._instance_active())
+        self.mock_client.servers.get.assert_called_once_with('abc-123')
 
     @mock.patch('openstack_virtual_baremetal.openstackbmc.OpenStackBmc.'
                 '_instance_active')
@@ -248,7 +580,62 @@ class TestOpenStackBmc(unittest.TestCase):
         self.bmc.power_off()
         self.mock_client.servers.stop.assert_called_once_with('abc-123')
         mock_log.assert_called_once_with('Ignoring exception: '
-                                         '"Conflict (HTTP a)"')
+                                         '"Conflict (HTTP a)"',
+                                         level='warning')
+
+    @mock.patch('pyghmi.ipmi.bmc.Bmc.handle_raw_request')
+    def test_handle_raw_request(self, mock_handle, mock_nova, mock_log,
+                                mock_init):
+        self._create_bmc(mock_nova)
+        metrics = openstackbmc.Metrics()
+        request = {'netfn': 0, 'command': 1, 'data': []}
+        session = mock.Mock()
+        with mock.patch.object(openstackbmc, 'metrics', metrics):
+            self.bmc.handle_raw_request(request, session)
+        mock_handle.assert_called_once_with(request, session)
+        self.assertEqual(1, metrics.get('openstackbmc_ipmi_commands_total',
+                                        command='power_status'))
+        self.assertIn('openstackbmc_ipmi_command_duration_seconds_count'
+                      '{command="power_status"} 1',
+                      metrics.render().splitlines())
+
+    @mock.patch('pyghmi.ipmi.bmc.Bmc.handle_raw_request')
+    def test_handle_raw_request_profiled(self, mock_handle, mock_nova,
+                                         mock_log, mock_init):
+        self._create_bmc(mock_nova)
+        mock_profiler = mock.MagicMock()
+        request = {'netfn': 0, 'command': 2, 'data': [1]}
+        with mock.patch.object(openstackbmc, 'profiler', mock_profiler):
+            self.bmc.handle_raw_request(request, mock.Mock())
+        mock_profiler.profile.assert_called_once_with('power_on')
+        self.assertTrue(mock_profiler.profile.return_value.__exit__.called)
+
+    @mock.patch('pyghmi.ipmi.private.serversession.IpmiServer.'
+                'process_pktqueue')
+    def test_process_pktqueue_profiled(self, mock_process, mock_nova,
+                                       mock_log, mock_init):
+        self._create_bmc(mock_nova)
+        mock_profiler = mock.MagicMock()
+        with mock.patch.object(openstackbmc, 'profiler', mock_profiler):
+            self.bmc.process_pktqueue()
+        mock_process.assert_called_once_with()
+        mock_profiler.profile.assert_called_once_with('session_setup')
+
+    def test_power_off_conflict_counted(self, mock_nova, mock_log,
+                                        mock_init):
+        self._create_bmc(mock_nova)
+        mock_server = mock.Mock()
+        mock_server.status = 'ACTIVE'
+        self.mock_client.servers.get.return_value = mock_server
+        self.mock_client.servers.stop.side_effect = exceptions.Conflict('a')
+        metrics = openstackbmc.Metrics()
+        with mock.patch.object(openstackbmc, 'metrics', metrics):
+            self.bmc.power_off()
+        self.assertEqual(1,
+                         metrics.get('openstackbmc_power_conflicts_total',
+                                     command='power_off'))
+        self.assertEqual(1, metrics.get('openstackbmc_nova_errors_total',
+                                        operation='stop'))
 
     @mock.patch('openstack_virtual_baremetal.openstackbmc.OpenStackBmc.'
                 '_instance_active')
@@ -269,6 +656,19 @@ class TestOpenStackBmc(unittest.TestCase):
         self.mock_client.servers.start.assert_called_once_with('abc-123')
         self.assertEqual('ACTIVE', self.bmc.target_status)
 
+    def test_power_on_invalidates_cache(self, mock_nova, mock_log,
+                                        mock_init):
+        self._create_bmc(mock_nova)
+        self.bmc.cache_status = True
+        # Changed outside the BMC, so the cached status is wrong
+        self.bmc.status_table.update('abc-123', 'ACTIVE')
+        self.bmc.target_status = 'ACTIVE'
+        mock_server = mock.Mock()
+        mock_server.status = 'SHUTOFF'
+        self.mock_client.servers.get.return_value = mock_server
+        self.bmc.power_on()
+        self.mock_client.servers.start.assert_called_once_with('abc-123')
+
     @mock.patch('openstack_virtual_baremetal.openstackbmc.OpenStackBmc.'
                 '_instance_active')
     def test_power_on_conflict(self, mock_active, mock_nova, mock_log,
@@ -279,7 +679,158 @@ class TestOpenStackBmc(unittest.TestCase):
         self.bmc.power_on()
         self.mock_client.servers.start.assert_called_once_with('abc-123')
         mock_log.assert_called_once_with('Ignoring exception: '
-                                         '"Conflict (HTTP a)"')
+                                         '"Conflict (HTTP a)"',
+                                         level='warning')
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.OpenStackBmc.'
+                '_instance_active')
+    def test_power_on_dispatched(self, mock_active, mock_nova, mock_log,
+                                 mock_init):
+        self._create_bmc(mock_nova)
+        mock_active.return_value = False
+        self.bmc.dispatcher = openstackbmc.CommandDispatcher(0)
+        self.bmc.power_on()
+        self.assertEqual('ACTIVE', self.bmc.target_status)
+        self.assertFalse(self.mock_client.servers.start.called)
+        # The pending target is reported until the command has run
+        self.assertTrue(self.bmc.get_power_state())
+        self.assertFalse(mock_active.called)
+        self.bmc.dispatcher._run('abc-123')
+        self.mock_client.servers.start.assert_called_once_with('abc-123')
+        self.assertFalse(self.bmc.get_power_state())
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.OpenStackBmc.'
+                '_instance_active')
+    def test_power_shutdown(self, mock_active, mock_nova, mock_log,
+                            mock_init):
+        self._create_bmc(mock_nova)
+        self.bmc.power_shutdown()
+        self.mock_client.servers.stop.assert_called_once_with('abc-123')
+        self.assertEqual('SHUTOFF', self.bmc.target_status)
+
+    def test_power_reset(self, mock_nova, mock_log, mock_init):
+        self._create_bmc(mock_nova)
+        self.bmc.cache_status = True
+        self.bmc.status_table.update('abc-123', 'SHUTOFF')
+        self.bmc.power_reset()
+        self.mock_client.servers.reboot.assert_called_once_with(
+            'abc-123', reboot_type='HARD')
+        self.assertEqual('ACTIVE', self.bmc.target_status)
+        # Status queries during the reboot don't need to go to Nova
+        self.assertTrue(self.bmc.get_power_state())
+        self.assertFalse(self.mock_client.servers.get.called)
+
+    def test_power_reset_conflict(self, mock_nova, mock_log, mock_init):
+        self._create_bmc(mock_nova)
+        self.bmc.status_table.update('abc-123', 'ACTIVE')
+        self.mock_client.servers.reboot.side_effect = exceptions.Conflict('a')
+        self.bmc.power_reset()
+        self.assertIsNone(self.bmc.status_table.get('abc-123'))
+        mock_log.assert_called_once_with('Ignoring exception: '
+                                         '"Conflict (HTTP a)"',
+                                         level='warning')
+
+    def test_power_on_tracked(self, mock_nova, mock_log, mock_init):
+        self._create_bmc(mock_nova)
+        self.bmc.tracker = mock.Mock()
+        mock_server = mock.Mock()
+        mock_server.status = 'SHUTOFF'
+        self.mock_client.servers.get.return_value = mock_server
+        self.bmc.power_on()
+        self.bmc.tracker.track.assert_called_once_with('abc-123')
+        self.bmc.tracker.tracking.return_value = True
+        # Queries during the transition don't go to Nova
+        for i in range(5):
+            self.assertFalse(self.bmc.get_power_state())
+        self.assertEqual(1, self.mock_client.servers.get.call_count)
+        self.bmc.status_table.update('abc-123', 'ACTIVE')
+        self.assertTrue(self.bmc.get_power_state())
+        self.assertEqual(1, self.mock_client.servers.get.call_count)
+
+    def test_power_off_tracked(self, mock_nova, mock_log, mock_init):
+        self._create_bmc(mock_nova)
+        self.bmc.tracker = mock.Mock()
+        mock_server = mock.Mock()
+        mock_server.status = 'ACTIVE'
+        self.mock_client.servers.get.return_value = mock_server
+        self.bmc.power_off()
+        self.bmc.tracker.track.assert_called_once_with('abc-123')
+
+    def test_power_on_conflict_not_tracked(self, mock_nova, mock_log,
+                                           mock_init):
+        self._create_bmc(mock_nova)
+        self.bmc.tracker = mock.Mock()
+        mock_server = mock.Mock()
+        mock_server.status = 'SHUTOFF'
+        self.mock_client.servers.get.return_value = mock_server
+        self.mock_client.servers.start.side_effect = exceptions.Conflict('a')
+        self.bmc.power_on()
+        self.assertFalse(self.bmc.tracker.track.called)
+
+    def test_get_status_tracked_unknown(self, mock_nova, mock_log,
+                                        mock_init):
+        self._create_bmc(mock_nova)
+        self.bmc.tracker = mock.Mock()
+        self.bmc.tracker.tracking.return_value = True
+        mock_server = mock.Mock()
+        mock_server.status = 'ACTIVE'
+        self.mock_client.servers.get.return_value = mock_server
+        self.assertEqual('ACTIVE', self.bmc._get_status())
+        self.mock_client.servers.get.assert_called_once_with('abc-123')
+
+    def _rate_limit(self):
+        limiter = openstackbmc.RateLimiter()
+        limiter.configure(1)
+        limiter._tokens = 0
+        patcher = mock.patch.object(openstackbmc, 'rate_limiter', limiter)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return limiter
+
+    def test_get_status_rate_limited(self, mock_nova, mock_log, mock_init):
+        self._create_bmc(mock_nova)
+        self._rate_limit()
+        self.bmc.status_table.update('abc-123', 'SHUTOFF')
+        self.assertEqual('SHUTOFF', self.bmc._get_status())
+        self.assertFalse(self.mock_client.servers.get.called)
+
+    def test_get_boot_device_rate_limited(self, mock_nova, mock_log,
+                                          mock_init):
+        self._create_bmc(mock_nova)
+        self._rate_limit()
+        self.bmc.boot_device = 'network'
+        self.assertEqual('network', self.bmc.get_boot_device())
+        self.assertFalse(self.mock_client.servers.get.called)
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.RateLimiter.'
+                'acquire')
+    def test_power_on_urgent(self, mock_acquire, mock_nova, mock_log,
+                             mock_init):
+        self._create_bmc(mock_nova)
+        limiter = self._rate_limit()
+        mock_server = mock.Mock()
+        mock_server.status = 'SHUTOFF'
+        self.mock_client.servers.get.return_value = mock_server
+        self.bmc.power_on()
+        # The status check made by the power command is a write as well
+        self.assertEqual([mock.call('write'), mock.call('write')],
+                         mock_acquire.call_args_list)
+        self.assertEqual('read', limiter.priority('get'))
+
+    def test_power_cycle(self, mock_nova, mock_log, mock_init):
+        self._create_bmc(mock_nova)
+        self.bmc.power_cycle()
+        self.mock_client.servers.reboot.assert_called_once_with(
+            'abc-123', reboot_type='HARD')
+
+    def test_power_reset_dispatched(self, mock_nova, mock_log, mock_init):
+        self._create_bmc(mock_nova)
+        self.bmc.dispatcher = openstackbmc.CommandDispatcher(0)
+        self.bmc.power_reset()
+        self.assertFalse(self.mock_client.servers.reboot.called)
+        self.bmc.dispatcher._run('abc-123')
+        self.mock_client.servers.reboot.assert_called_once_with(
+            'abc-123', reboot_type='HARD')
 
     @mock.patch('openstack_virtual_baremetal.openstackbmc.OpenStackBmc.'
                 '_instance_active')
@@ -291,38 +842,2363 @@ class TestOpenStackBmc(unittest.TestCase):
         self.assertIsNone(val)
         mock_log.assert_called_once_with('abc-123 is already on.')
 
+    def test_close(self, mock_nova, mock_log, mock_init):
+        self._create_bmc(mock_nova)
+        self.bmc.instance_name = 'foo'
+        self.bmc.poller = openstackbmc.StatusPoller(self.mock_client, 10)
+        self.bmc.poller.add('abc-123')
+        self.bmc.status_table.update('abc-123', 'ACTIVE')
+        self.bmc.serversocket = mock.Mock()
+        other_socket = mock.Mock()
+        other_bmc = mock.Mock()
+        session = mock.Mock(bmc=self.bmc)
+        other_session = mock.Mock(bmc=other_bmc)
+        handlers = {self.bmc.serversocket: {0: self.bmc},
+                    other_socket: {0: other_bmc},
+                    ('::1', 1000): {623: session},
+                    ('::1', 1001): {623: session, 624: other_session}}
+        iosockets = [mock.Mock(), other_socket, self.bmc.serversocket]
 
-class TestMain(unittest.TestCase):
-    @mock.patch('openstack_virtual_baremetal.openstackbmc.OpenStackBmc')
-    def test_main(self, mock_bmc):
-        mock_instance = mock.Mock()
-        mock_bmc.return_value = mock_instance
-        mock_argv = ['openstackbmc', '--port', '111', '--address', '1.2.3.4',
-                     '--instance', 'foobar', '--os-cloud', 'foo']
-        with mock.patch.object(sys, 'argv', mock_argv):
-            openstackbmc.main()
-        mock_bmc.assert_called_once_with({'admin': 'password'},
-                                         port=111,
-                                         address='::ffff:1.2.3.4',
-                                         instance='foobar',
-                                         cache_status=False,
-                                         os_cloud='foo'
-                                         )
-        mock_instance.listen.assert_called_once_with()
+        def wait():
+            # The IO thread is done with the socket before it is closed
+            self.assertNotIn(self.bmc.serversocket, iosockets)
+            self.assertFalse(self.bmc.serversocket.close.called)
+        with mock.patch.object(openstackbmc.ipmisession.Session,
+                               'bmc_handlers', handlers):
+            with mock.patch.object(openstackbmc.ipmisession, 'iosockets',
+                                   iosockets):
+                with mock.patch('openstack_virtual_baremetal.openstackbmc.'
+                                '_wait_for_event_loop',
+                                side_effect=wait) as mock_wait:
+                    self.bmc.close()
+        mock_wait.assert_called_once_with()
+        self.assertEqual({other_socket: {0: other_bmc},
+                          ('::1', 1001): {624: other_session}}, handlers)
+        self.assertNotIn(self.bmc.serversocket, iosockets)
+        self.bmc.serversocket.close.assert_called_once_with()
+        self.assertEqual(set(), self.bmc.poller.instances)
+        self.assertIsNone(self.bmc.status_table.get('abc-123'))
 
-    @mock.patch('openstack_virtual_baremetal.openstackbmc.OpenStackBmc')
-    def test_main_default_addr(self, mock_bmc):
-        mock_instance = mock.Mock()
-        mock_bmc.return_value = mock_instance
-        mock_argv = ['openstackbmc', '--port', '111',
-                     '--instance', 'foobar', '--os-cloud', 'bar']
-        with mock.patch.object(sys, 'argv', mock_argv):
-            openstackbmc.main()
-        mock_bmc.assert_called_once_with({'admin': 'password'},
-                                         port=111,
-                                         address='::',
-                                         instance='foobar',
-                                         cache_status=False,
-                                         os_cloud='bar'
-                                         )
-        mock_instance.listen.assert_called_once_with()
+    def test_cold_reset(self, mock_nova, mock_log, mock_init):
+        self._create_bmc(mock_nova)
+        self.bmc.serversocket = mock.Mock()
+        self.bmc.status_table.update('abc-123', 'ACTIVE')
+        self.bmc.target_status = 'SHUTOFF'
+        self.bmc._cache_boot_device('network')
+        other_bmc = mock.Mock()
+        session = mock.Mock(bmc=self.bmc)
+        other_session = mock.Mock(bmc=other_bmc)
+        handlers = {self.bmc.serversocket: {0: self.bmc},
+                    ('::1', 1000): {623: session, 624: other_session}}
+        iosockets = [mock.Mock(), self.bmc.serversocket]
+        with mock.patch.object(openstackbmc.ipmisession.Session,
+                               'bmc_handlers', handlers):
+            with mock.patch.object(openstackbmc.ipmisession, 'iosockets',
+                                   iosockets):
+                self.assertEqual(0, self.bmc.cold_reset())
+        # Still serving, but as though it had just started
+        self.assertEqual({self.bmc.serversocket: {0: self.bmc},
+                          ('::1', 1000): {624: other_session}}, handlers)
+        self.assertIn(self.bmc.serversocket, iosockets)
+        self.assertFalse(self.bmc.serversocket.close.called)
+        self.assertIsNone(self.bmc.status_table.get('abc-123'))
+        self.assertIsNone(self.bmc.target_status)
+        self.assertIsNone(self.bmc.boot_device)
+
+    def test_close_shared_socket(self, mock_nova, mock_log, mock_init):
+        self._create_bmc(mock_nova)
+        self.bmc.instance_name = 'foo'
+        self.bmc.serversocket = mock.Mock()
+        handlers = {self.bmc.serversocket: {0: self.bmc}}
+        with mock.patch.object(openstackbmc.ipmisession.Session,
+                               'bmc_handlers', handlers):
+            with mock.patch.object(openstackbmc.ipmisession, 'iosockets',
+                                   [mock.Mock()]):
+                self.bmc.close()
+        self.assertEqual({}, handlers)
+        self.bmc.serversocket.close.assert_called_once_with()
+
+    def test_close_wakeup_socket(self, mock_nova, mock_log, mock_init):
+        self._create_bmc(mock_nova)
+        self.bmc.instance_name = 'foo'
+        self.bmc.serversocket = mock.Mock()
+        handlers = {self.bmc.serversocket: {0: self.bmc}}
+        iosockets = [self.bmc.serversocket]
+        with mock.patch.object(openstackbmc.ipmisession.Session,
+                               'bmc_handlers', handlers):
+            with mock.patch.object(openstackbmc.ipmisession, 'iosockets',
+                                   iosockets):
+                self.bmc.close()
+        self.assertEqual({}, handlers)
+        # The IO thread still needs it
+        self.assertEqual([self.bmc.serversocket], iosockets)
+        self.assertFalse(self.bmc.serversocket.close.called)
+
+    def test_flush_cache(self, mock_nova, mock_log, mock_init):
+        self._create_bmc(mock_nova)
+        self.bmc.status_table.update('abc-123', 'ACTIVE')
+        self.bmc._cache_boot_device('network')
+        self.bmc.flush_cache()
+        self.assertIsNone(self.bmc.status_table.get('abc-123'))
+        self.assertIsNone(self.bmc.boot_device)
+        self.assertIsNone(self.bmc.boot_device_time)
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc._now',
+                return_value=100)
+    def test_describe(self, mock_now, mock_nova, mock_log, mock_init):
+        self._create_bmc(mock_nova)
+        self.bmc.instance_name = 'foo'
+        self.bmc.target_status = 'ACTIVE'
+        self.bmc.cache_ttl = 30
+        self.bmc.status_table.update('abc-123', 'SHUTOFF', 90)
+        self.bmc._cache_boot_device('hd', 5)
+        self.bmc.tracker = mock.Mock()
+        self.bmc.tracker.tracking.return_value = True
+        self.assertEqual({'instance': 'abc-123',
+                          'name': 'foo',
+                          'status': 'SHUTOFF',
+                          'status_age': 10,
+                          'target_status': 'ACTIVE',
+                          'boot_device': 'hd',
+                          'boot_device_age': 5,
+                          'cache_ttl': 30,
+                          'boot_device_ttl': None,
+                          'in_transition': True,
+                          'command_pending': False},
+                         self.bmc.describe())
+        self.bmc.tracker.tracking.assert_called_once_with('abc-123')
+
+
+class TestLogWriter(unittest.TestCase):
+    def setUp(self):
+        super(TestLogWriter, self).setUp()
+        self.stream = mock.Mock()
+        self.writer = openstackbmc.LogWriter(self.stream)
+
+    def _lines(self):
+        return ''.join(c[1][0] for c in
+                       self.stream.write.mock_calls).splitlines()
+
+    def test_write_text(self):
+        self.writer.write('foo bar', instance='abc-123')
+        self.stream.write.assert_called_once_with('foo bar\n')
+        self.stream.flush.assert_called_once_with()
+
+    def test_write_json(self):
+        self.writer.configure(json_format=True)
+        self.writer.write('foo bar', level='error', instance='abc-123')
+        record = json.loads(self._lines()[0])
+        self.assertEqual('foo bar', record['message'])
+        self.assertEqual('error', record['level'])
+        self.assertEqual('abc-123', record['instance'])
+        self.assertIn('time', record)
+
+    def test_level(self):
+        self.writer.configure(level='warning')
+        self.writer.write('foo')
+        self.writer.write('bar', level='debug')
+        self.writer.write('baz', level='error')
+        self.assertEqual(['baz'], self._lines())
+        self.writer.level = 'debug'
+        self.writer.write('qux', level='debug')
+        self.assertEqual(['baz', 'qux'], self._lines())
+
+    def test_write_buffered(self):
+        self.writer.configure(buffered=True)
+        for i in range(10):
+            self.writer.write('foo %d' % i)
+        self.writer.flush()
+        self.assertEqual(['foo %d' % i for i in range(10)], self._lines())
+
+    def test_write_buffered_full(self):
+        self.writer.QUEUE_SIZE = 2
+        writing = threading.Event()
+        release = threading.Event()
+
+        def slow_write(data):
+            writing.set()
+            release.wait(5)
+
+        self.stream.write.side_effect = slow_write
+        self.writer.configure(buffered=True)
+        self.writer.write('first')
+        self.assertTrue(writing.wait(5))
+        # The writer thread is busy, so two records fit in the queue and the
+        # rest are dropped
+        for line in ('second', 'third', 'fourth', 'fifth'):
+            self.writer.write(line)
+        self.stream.write.side_effect = None
+        release.set()
+        self.writer.flush()
+        self.writer.write('sixth')
+        self.writer.flush()
+        self.assertEqual(['second', 'third', 'Dropped 2 log records',
+                          'sixth'],
+                         self._lines()[1:])
+
+    def test_status_unlimited(self):
+        self.writer.status('abc-123', True)
+        self.writer.status('abc-123', True)
+        self.assertEqual(
+            ['Reporting power state "True" for instance abc-123'] * 2,
+            self._lines())
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc._now')
+    def test_status_rate_limited(self, mock_now):
+        self.writer.configure(status_interval=60)
+        mock_now.return_value = 0
+        self.writer.status('abc-123', True)
+        mock_now.return_value = 10
+        self.writer.status('abc-123', True)
+        self.writer.status('abc-123', True)
+        self.writer.status('def-456', False)
+        self.assertEqual(
+            ['Reporting power state "True" for instance abc-123',
+             'Reporting power state "False" for instance def-456'],
+            self._lines())
+        mock_now.return_value = 70
+        self.writer.status('abc-123', True)
+        mock_now.return_value = 80
+        self.writer.status('abc-123', True)
+        self.writer.status('abc-123', False)
+        self.assertEqual(
+            ['Reported power state "True" for instance abc-123 3 times in '
+             'the last 70 seconds',
+             'Reported power state "True" for instance abc-123 1 times in '
+             'the last 10 seconds',
+             'Reporting power state "False" for instance abc-123'],
+            self._lines()[2:])
+
+
+@mock.patch('openstack_virtual_baremetal.openstackbmc.log')
+class TestCommandProfiler(testtools.TestCase):
+    def setUp(self):
+        super(TestCommandProfiler, self).setUp()
+        self.directory = os.path.join(
+            self.useFixture(fixtures.TempDir()).path, 'profiles')
+        self.profiler = openstackbmc.CommandProfiler()
+
+    def _work(self):
+        return sorted(range(1000), key=lambda i: -i)
+
+    def test_disabled(self, mock_log):
+        with self.profiler.profile('power_status'):
+            self._work()
+        self.assertEqual({}, self.profiler._profiles)
+
+    def test_dump(self, mock_log):
+        self.profiler.configure(self.directory)
+        with self.profiler.profile('power_status'):
+            self._work()
+        with self.profiler.profile('power_status'):
+            self._work()
+        with self.profiler.profile('bootdev_get'):
+            pass
+        # Only dumped when asked to
+        self.assertEqual([], os.listdir(self.directory))
+        self.profiler.dump()
+        self.assertEqual(['bootdev_get.pstats', 'power_status.pstats'],
+                         sorted(os.listdir(self.directory)))
+        stats = pstats.Stats(os.path.join(self.directory,
+                                          'power_status.pstats'))
+        calls = [v[1] for k, v in stats.stats.items() if k[2] == '_work']
+        self.assertEqual([2], calls)
+
+    def test_request_dump(self, mock_log):
+        self.profiler.configure(self.directory)
+        self.profiler.request_dump()
+        with self.profiler.profile('power_status'):
+            # Not until the command has been handled
+            self.assertEqual([], os.listdir(self.directory))
+        self.assertEqual(['power_status.pstats'],
+                         os.listdir(self.directory))
+        self.assertFalse(self.profiler._dump_requested)
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc._now')
+    def test_interval(self, mock_now, mock_log):
+        mock_now.return_value = 100
+        self.profiler.configure(self.directory, 60)
+        mock_now.return_value = 159
+        with self.profiler.profile('power_status'):
+            pass
+        self.assertEqual([], os.listdir(self.directory))
+        mock_now.return_value = 160
+        with self.profiler.profile('power_status'):
+            pass
+        self.assertEqual(['power_status.pstats'],
+                         os.listdir(self.directory))
+        self.assertEqual(220, self.profiler._next_dump)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counter_gauge(self):
+        metrics = openstackbmc.Metrics()
+        metrics.inc('openstackbmc_nova_calls_total', operation='get')
+        metrics.inc('openstackbmc_nova_calls_total', 2, operation='get')
+        metrics.set('openstackbmc_power_state', 1, instance='abc-123')
+        self.assertEqual(3, metrics.get('openstackbmc_nova_calls_total',
+                                        operation='get'))
+        self.assertEqual(0, metrics.get('openstackbmc_nova_calls_total',
+                                        operation='list'))
+        output = metrics.render().splitlines()
+        self.assertIn('# TYPE openstackbmc_nova_calls_total counter', output)
+        self.assertIn('openstackbmc_nova_calls_total{operation="get"} 3',
+                      output)
+        self.assertIn('# TYPE openstackbmc_power_state gauge', output)
+        self.assertIn('openstackbmc_power_state{instance="abc-123"} 1',
+                      output)
+
+    def test_counters(self):
+        metrics = openstackbmc.Metrics()
+        metrics.inc('openstackbmc_nova_calls_total', operation='get')
+        metrics.inc('openstackbmc_cache_hits_total', 2, cache='status')
+        metrics.set('openstackbmc_power_state', 1, instance='abc-123')
+        metrics.observe('openstackbmc_nova_call_duration_seconds', 0.1,
+                        operation='get')
+        self.assertEqual(
+            {'openstackbmc_nova_calls_total{operation="get"}': 1,
+             'openstackbmc_cache_hits_total{cache="status"}': 2},
+            metrics.counters())
+
+    def test_merge(self):
+        worker = openstackbmc.Metrics()
+        worker.inc('openstackbmc_nova_calls_total', 2, operation='get')
+        worker.set('openstackbmc_power_state', 1, instance='abc-123')
+        worker.observe('openstackbmc_nova_call_duration_seconds', 0.02,
+                       operation='get')
+        total = openstackbmc.Metrics()
+        total.inc('openstackbmc_nova_calls_total', operation='get')
+        total.merge(worker.snapshot())
+        total.merge(worker.snapshot(), gauges=False)
+        self.assertEqual(5, total.get('openstackbmc_nova_calls_total',
+                                      operation='get'))
+        self.assertEqual(1, total.get('openstackbmc_power_state',
+                                      instance='abc-123'))
+        output = total.render().splitlines()
+        self.assertIn('openstackbmc_nova_call_duration_seconds_count'
+                      '{operation="get"} 2', output)
+        # The snapshot is a copy
+        worker.inc('openstackbmc_nova_calls_total', operation='get')
+        self.assertEqual(5, total.get('openstackbmc_nova_calls_total',
+                                      operation='get'))
+
+    def test_histogram(self):
+        metrics = openstackbmc.Metrics()
+        name = 'openstackbmc_nova_call_duration_seconds'
+        metrics.observe(name, 0.003, operation='get')
+        metrics.observe(name, 0.2, operation='get')
+        metrics.observe(name, 20, operation='get')
+        output = metrics.render().splitlines()
+        self.assertIn('# TYPE %s histogram' % name, output)
+        self.assertIn('%s_bucket{operation="get",le="0.001"} 0' % name,
+                      output)
+        self.assertIn('%s_bucket{operation="get",le="0.005"} 1' % name,
+                      output)
+        self.assertIn('%s_bucket{operation="get",le="0.25"} 2' % name,
+                      output)
+        self.assertIn('%s_bucket{operation="get",le="10.0"} 2' % name,
+                      output)
+        self.assertIn('%s_bucket{operation="get",le="+Inf"} 3' % name,
+                      output)
+        self.assertIn('%s_count{operation="get"} 3' % name, output)
+
+    def test_nova_call(self):
+        with mock.patch.object(openstackbmc, 'metrics',
+                               openstackbmc.Metrics()) as metrics:
+            func = mock.Mock(return_value='foo')
+            self.assertEqual('foo', openstackbmc._nova_call('get', func, 'a',
+                                                            b='c'))
+            func.assert_called_once_with('a', b='c')
+            func.side_effect = Exception
+            self.assertRaises(Exception, openstackbmc._nova_call, 'get',
+                              func)
+            self.assertEqual(2, metrics.get('openstackbmc_nova_calls_total',
+                                            operation='get'))
+            self.assertEqual(1, metrics.get('openstackbmc_nova_errors_total',
+                                            operation='get'))
+
+    def test_metrics_server(self):
+        server = openstackbmc.start_metrics_server('127.0.0.1', 0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        openstackbmc.metrics.inc('openstackbmc_ipmi_commands_total',
+                                 command='test')
+        conn = http_client.HTTPConnection('127.0.0.1',
+                                          server.server_address[1])
+        conn.request('GET', '/metrics')
+        response = conn.getresponse()
+        self.assertEqual(200, response.status)
+        body = response.read().decode('utf-8')
+        self.assertIn('openstackbmc_ipmi_commands_total{command="test"}',
+                      body)
+        conn.request('GET', '/foo')
+        self.assertEqual(404, conn.getresponse().status)
+
+    def test_ipmi_command_name(self):
+        self.assertEqual('power_status',
+                         openstackbmc._ipmi_command_name(
+                             {'netfn': 0, 'command': 1, 'data': []}))
+        self.assertEqual('power_on',
+                         openstackbmc._ipmi_command_name(
+                             {'netfn': 0, 'command': 2, 'data': [1]}))
+        self.assertEqual('bootdev_set',
+                         openstackbmc._ipmi_command_name(
+                             {'netfn': 0, 'command': 8, 'data': [5]}))
+        self.assertEqual('netfn_10_command_16',
+                         openstackbmc._ipmi_command_name(
+                             {'netfn': 10, 'command': 16, 'data': []}))
+
+
+@mock.patch('openstack_virtual_baremetal.openstackbmc._now')
+class TestRateLimiter(unittest.TestCase):
+    def _limiter(self, mock_now, rate=10, burst=None, reserve=None):
+        mock_now.return_value = 100
+        limiter = openstackbmc.RateLimiter()
+        limiter.configure(rate, burst, reserve)
+        limiter._cond = mock.MagicMock()
+        return limiter
+
+    def test_unlimited(self, mock_now):
+        limiter = openstackbmc.RateLimiter()
+        for i in range(100):
+            limiter.acquire(limiter.READ)
+        self.assertTrue(limiter.ready(limiter.READ))
+
+    def test_configure(self, mock_now):
+        limiter = self._limiter(mock_now)
+        self.assertEqual(10, limiter.burst)
+        self.assertEqual(2.5, limiter.reserve)
+        limiter = self._limiter(mock_now, 0.5)
+        self.assertEqual(1, limiter.burst)
+        self.assertEqual(0, limiter.reserve)
+        limiter = self._limiter(mock_now, 10, 0.5, 2)
+        self.assertEqual(1, limiter.burst)
+        self.assertEqual(0, limiter.reserve)
+        limiter = self._limiter(mock_now, 10, 4, 8)
+        self.assertEqual(3, limiter.reserve)
+
+    def test_slow_rate_reads(self, mock_now):
+        for rate in (0.5, 1, 1.2):
+            limiter = self._limiter(mock_now, rate)
+            # A full bucket always holds enough for a read
+            self.assertTrue(limiter.ready(limiter.READ))
+            limiter.acquire(limiter.READ)
+            self.assertFalse(limiter.ready(limiter.READ))
+            mock_now.return_value += 2 / rate
+            self.assertTrue(limiter.ready(limiter.READ))
+            self.assertFalse(limiter._cond.wait.called)
+
+    def test_priority(self, mock_now):
+        limiter = openstackbmc.RateLimiter()
+        self.assertEqual(limiter.READ, limiter.priority('get'))
+        self.assertEqual(limiter.WRITE, limiter.priority('start'))
+        with limiter.urgent():
+            self.assertEqual(limiter.WRITE, limiter.priority('get'))
+        self.assertEqual(limiter.READ, limiter.priority('get'))
+
+    def test_reads_leave_reserve(self, mock_now):
+        limiter = self._limiter(mock_now, 10, 4, 2)
+        limiter.acquire(limiter.READ)
+        limiter.acquire(limiter.READ)
+        self.assertFalse(limiter.ready(limiter.READ))
+        self.assertTrue(limiter.ready(limiter.WRITE))
+        limiter.acquire(limiter.WRITE)
+        limiter.acquire(limiter.WRITE)
+        self.assertFalse(limiter.ready(limiter.WRITE))
+        self.assertFalse(limiter._cond.wait.called)
+
+    def test_refill(self, mock_now):
+        limiter = self._limiter(mock_now, 4, 1, 0)
+        limiter.acquire(limiter.WRITE)
+        self.assertFalse(limiter.ready(limiter.WRITE))
+        mock_now.return_value = 100.25
+        self.assertTrue(limiter.ready(limiter.WRITE))
+        mock_now.return_value = 200
+        limiter.acquire(limiter.WRITE)
+        # Never more than burst tokens
+        self.assertFalse(limiter.ready(limiter.WRITE))
+
+    def test_acquire_waits(self, mock_now):
+        limiter = self._limiter(mock_now, 4, 1, 0)
+        limiter.acquire(limiter.WRITE)
+
+        def wait(timeout):
+            mock_now.return_value += timeout
+        limiter._cond.wait.side_effect = wait
+        limiter.acquire(limiter.WRITE)
+        limiter._cond.wait.assert_called_once_with(mock.ANY)
+        self.assertEqual(0.25, limiter._cond.wait.call_args[0][0])
+        self.assertEqual(1, openstackbmc.metrics.get(
+            'openstackbmc_rate_limited_total', priority='write'))
+
+    def test_reads_wait_for_writes(self, mock_now):
+        limiter = self._limiter(mock_now, 10, 4, 0)
+        limiter._waiting_writes = 1
+        self.assertFalse(limiter.ready(limiter.READ))
+        self.assertTrue(limiter.ready(limiter.WRITE))
+
+
+class TestCommandDispatcher(unittest.TestCase):
+    def test_ordering(self):
+        dispatcher = openstackbmc.CommandDispatcher(0)
+        calls = []
+
+        def first():
+            # Submitted while the first command is running
+            dispatcher.submit('abc-123', lambda: calls.append('second'))
+            calls.append('first')
+
+        dispatcher.submit('abc-123', first)
+        self.assertTrue(dispatcher.pending('abc-123'))
+        self.assertFalse(dispatcher.pending('def-456'))
+        dispatcher._run(dispatcher._ready.get_nowait())
+        self.assertEqual(['first', 'second'], calls)
+        self.assertFalse(dispatcher.pending('abc-123'))
+        # The key was only queued once
+        self.assertTrue(dispatcher._ready.empty())
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.log')
+    def test_exception(self, mock_log):
+        dispatcher = openstackbmc.CommandDispatcher(0)
+        calls = []
+
+        def fail():
+            raise Exception('boom')
+
+        dispatcher.submit('abc-123', fail)
+        dispatcher.submit('abc-123', lambda: calls.append('next'))
+        dispatcher._run('abc-123')
+        self.assertEqual(['next'], calls)
+        mock_log.assert_called_once_with(
+            'Exception running command for abc-123: boom', level='error')
+
+    def test_workers(self):
+        dispatcher = openstackbmc.CommandDispatcher(2)
+        done = threading.Event()
+        dispatcher.submit('abc-123', done.set)
+        self.assertTrue(done.wait(5))
+
+
+class TestSingleFlight(unittest.TestCase):
+    def test_do(self):
+        single_flight = openstackbmc.SingleFlight()
+        self.assertEqual('foo', single_flight.do('abc-123', lambda: 'foo'))
+        self.assertEqual('bar', single_flight.do('abc-123', lambda: 'bar'))
+
+    def test_do_exception(self):
+        single_flight = openstackbmc.SingleFlight()
+
+        def fail():
+            raise ValueError('boom')
+
+        self.assertRaises(ValueError, single_flight.do, 'abc-123', fail)
+        self.assertEqual('foo', single_flight.do('abc-123', lambda: 'foo'))
+
+    def _run_concurrent(self, func, key2='abc-123'):
+        single_flight = openstackbmc.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return func()
+
+        results = []
+
+        def call(key):
+            try:
+                results.append(single_flight.do(key, slow))
+            except Exception as e:
+                results.append(e)
+
+        first = threading.Thread(target=call, args=('abc-123',))
+        first.start()
+        self.assertTrue(started.wait(5))
+        second = threading.Thread(target=call, args=(key2,))
+        second.start()
+        # Give the second caller a chance to join the first call
+        time.sleep(0.1)
+        release.set()
+        first.join(5)
+        second.join(5)
+        return calls, results
+
+    def test_concurrent_shared(self):
+        calls, results = self._run_concurrent(lambda: 'foo')
+        self.assertEqual(1, len(calls))
+        self.assertEqual(['foo', 'foo'], results)
+
+    def test_concurrent_shared_exception(self):
+        error = ValueError('boom')
+
+        def fail():
+            raise error
+
+        calls, results = self._run_concurrent(fail)
+        self.assertEqual(1, len(calls))
+        self.assertEqual([error, error], results)
+
+    def test_concurrent_different_keys(self):
+        calls, results = self._run_concurrent(lambda: 'foo', 'def-456')
+        self.assertEqual(2, len(calls))
+
+
+class TestStatusPoller(unittest.TestCase):
+    def _server(self, id, status):
+        server = mock.Mock()
+        server.id = id
+        server.status = status
+        return server
+
+    def test_poll(self):
+        mock_client = mock.Mock()
+        mock_client.servers.list.return_value = [
+            self._server('abc-123', 'ACTIVE'),
+            self._server('def-456', 'SHUTOFF'),
+            self._server('unmanaged', 'ACTIVE'),
+        ]
+        poller = openstackbmc.StatusPoller(mock_client, 10)
+        poller.add('abc-123')
+        poller.add('def-456')
+        poller.poll()
+        mock_client.servers.list.assert_called_once_with(limit=-1)
+        self.assertEqual('ACTIVE', poller.table.get('abc-123'))
+        self.assertEqual('SHUTOFF', poller.table.get('def-456'))
+        self.assertIsNone(poller.table.get('unmanaged'))
+
+    def test_remove(self):
+        poller = openstackbmc.StatusPoller(mock.Mock(), 10)
+        poller.add('abc-123')
+        poller.remove('abc-123')
+        poller.remove('def-456')
+        self.assertEqual(set(), poller.instances)
+
+
+class TestSharedStatusFile(testtools.TestCase):
+    def setUp(self):
+        super(TestSharedStatusFile, self).setUp()
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        self.path = os.path.join(tempdir, 'status')
+        self.mock_log = self.useFixture(fixtures.MockPatch(
+            'openstack_virtual_baremetal.openstackbmc.log')).mock
+
+    def _open(self, capacity=8):
+        shared = openstackbmc.SharedStatusFile(self.path, capacity)
+        shared.open()
+        self.addCleanup(shared.close)
+        return shared
+
+    @mock.patch('time.time', return_value=1000)
+    def test_claim_write_read(self, mock_time):
+        bmc1 = self._open()
+        bmc2 = self._open()
+        self.assertTrue(bmc1.claim('abc-123'))
+        self.assertTrue(bmc2.claim('def-456'))
+        self.assertEqual((None, None), bmc1.read('abc-123'))
+        updater = self._open()
+        self.assertEqual(['abc-123', 'def-456'], updater.instances())
+        updater.write({'abc-123': 'ACTIVE', 'def-456': 'SHUTOFF',
+                       'unclaimed': 'ACTIVE'})
+        self.assertEqual(('ACTIVE', 1000), bmc1.read('abc-123'))
+        self.assertEqual(('SHUTOFF', 1000), bmc2.read('def-456'))
+        # Only claimed instances can be read
+        self.assertEqual((None, None), bmc1.read('def-456'))
+        self.assertEqual(['abc-123', 'def-456'], updater.instances())
+        self.assertEqual(openstackbmc.SharedStatusFile.HEADER_SIZE +
+                         8 * openstackbmc.SharedStatusFile.RECORD.size,
+                         os.path.getsize(self.path))
+
+    def test_claim_reuses_record(self):
+        self._open().claim('abc-123')
+        self._open().write({'abc-123': 'ACTIVE'})
+        restarted = self._open()
+        self.assertTrue(restarted.claim('abc-123'))
+        self.assertEqual('ACTIVE', restarted.read('abc-123')[0])
+        self.assertEqual(['abc-123'], restarted.instances())
+
+    def test_release(self):
+        shared = self._open()
+        shared.claim('abc-123')
+        shared.claim('def-456')
+        shared.release('abc-123')
+        shared.release('unclaimed')
+        self.assertEqual(['def-456'], shared.instances())
+        self.assertEqual((None, None), shared.read('abc-123'))
+        shared.claim('ghi-789')
+        self.assertEqual(['ghi-789', 'def-456'], shared.instances())
+
+    def test_claim_full(self):
+        shared = self._open(capacity=1)
+        self.assertTrue(shared.claim('abc-123'))
+        self.assertFalse(shared.claim('def-456'))
+        self.assertTrue(self.mock_log.called)
+        self.assertEqual((None, None), shared.read('def-456'))
+
+    def test_claim_too_long(self):
+        shared = self._open()
+        self.assertFalse(shared.claim('x' * 37))
+        self.assertEqual([], shared.instances())
+
+    def test_open_reinitializes(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'garbage')
+        shared = self._open()
+        self.assertTrue(self.mock_log.called)
+        self.assertEqual([], shared.instances())
+        shared.claim('abc-123')
+        self.mock_log.reset_mock()
+        self.assertEqual(['abc-123'], self._open().instances())
+        self.assertFalse(self.mock_log.called)
+
+    def test_half_written_record(self):
+        shared = self._open()
+        shared.claim('abc-123')
+        # As if a writer died between marking the record and finishing it
+        openstackbmc.SharedStatusFile.SEQUENCE.pack_into(
+            shared._map, shared._offset(0), 3)
+        self.assertEqual([], shared.instances())
+        self.assertEqual((None, None), shared.read('abc-123'))
+        self.assertTrue(shared.claim('def-456'))
+        self.assertEqual(['def-456'], shared.instances())
+
+
+class TestSharedStatusPoller(unittest.TestCase):
+    @mock.patch('time.time', return_value=1000)
+    @mock.patch('openstack_virtual_baremetal.openstackbmc._now',
+                return_value=100)
+    def test_poll(self, mock_now, mock_time):
+        shared = mock.Mock()
+        shared.read.side_effect = lambda instance: {
+            'abc-123': ('ACTIVE', 995),
+            'def-456': ('ACTIVE', 990),
+        }.get(instance, (None, None))
+        poller = openstackbmc.SharedStatusPoller(shared, 1)
+        for instance in ('abc-123', 'def-456', 'ghi-789'):
+            poller.add(instance)
+        # Newer than the shared status
+        poller.table.update('def-456', 'SHUTOFF', 95)
+        poller.poll()
+        self.assertEqual(('ACTIVE', 5), poller.table.lookup('abc-123'))
+        self.assertEqual(('SHUTOFF', 5), poller.table.lookup('def-456'))
+        self.assertEqual((None, None), poller.table.lookup('ghi-789'))
+        shared.claim.assert_has_calls([mock.call('abc-123'),
+                                       mock.call('def-456'),
+                                       mock.call('ghi-789')])
+
+    def test_remove(self):
+        shared = mock.Mock()
+        poller = openstackbmc.SharedStatusPoller(shared, 1)
+        poller.add('abc-123')
+        poller.remove('abc-123')
+        self.assertEqual(set(), poller.instances)
+        shared.release.assert_called_once_with('abc-123')
+
+
+class TestStatusUpdater(unittest.TestCase):
+    def test_poll(self):
+        server = mock.Mock(id='abc-123', status='ACTIVE')
+        unclaimed = mock.Mock(id='def-456', status='ACTIVE')
+        mock_client = mock.Mock()
+        mock_client.servers.list.return_value = [server, unclaimed]
+        shared = mock.Mock()
+        shared.instances.return_value = ['abc-123', 'ghi-789']
+        updater = openstackbmc.StatusUpdater(mock_client, 5, shared)
+        updater.poll()
+        mock_client.servers.list.assert_called_once_with(limit=-1)
+        shared.write.assert_called_once_with({'abc-123': 'ACTIVE'})
+
+    def test_poll_unclaimed(self):
+        mock_client = mock.Mock()
+        shared = mock.Mock()
+        shared.instances.return_value = []
+        openstackbmc.StatusUpdater(mock_client, 5, shared).poll()
+        self.assertFalse(mock_client.servers.list.called)
+        self.assertFalse(shared.write.called)
+
+
+class TestTransitionTracker(unittest.TestCase):
+    def _server(self, id, status, task_state=None):
+        server = mock.Mock()
+        server.id = id
+        server.status = status
+        setattr(server, 'OS-EXT-STS:task_state', task_state)
+        return server
+
+    def setUp(self):
+        super(TestTransitionTracker, self).setUp()
+        self.mock_client = mock.Mock()
+        self.tracker = openstackbmc.TransitionTracker(
+            self.mock_client, openstackbmc.StatusTable(), 1)
+        # Don't start the background thread
+        self.tracker._thread = mock.Mock()
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc._now')
+    def test_poll_backoff(self, mock_now):
+        mock_now.return_value = 100
+        self.tracker.track('abc-123')
+        self.assertEqual([101, 1, 700], self.tracker._tracked['abc-123'])
+        self.mock_client.servers.get.return_value = self._server(
+            'abc-123', 'SHUTOFF', 'powering-on')
+        for expected in (2, 4, 8, 10, 10):
+            self.tracker.poll(['abc-123'])
+            self.assertEqual([100 + expected, expected, 700],
+                             self.tracker._tracked['abc-123'])
+        self.assertEqual('SHUTOFF', self.tracker.table.get('abc-123'))
+        self.assertTrue(self.tracker.tracking('abc-123'))
+
+    def test_poll_done(self):
+        self.tracker.track('abc-123')
+        self.mock_client.servers.get.return_value = self._server(
+            'abc-123', 'ACTIVE')
+        self.tracker.poll(['abc-123'])
+        self.assertFalse(self.tracker.tracking('abc-123'))
+        self.assertEqual('ACTIVE', self.tracker.table.get('abc-123'))
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc._now')
+    def test_poll_timeout(self, mock_now):
+        mock_now.return_value = 100
+        self.tracker.track('abc-123')
+        mock_now.return_value = 700
+        self.mock_client.servers.get.return_value = self._server(
+            'abc-123', 'SHUTOFF', 'powering-on')
+        self.tracker.poll(['abc-123'])
+        self.assertFalse(self.tracker.tracking('abc-123'))
+
+    def test_poll_deleted(self):
+        self.tracker.track('abc-123')
+        self.mock_client.servers.get.side_effect = exceptions.NotFound('foo')
+        self.tracker.poll(['abc-123'])
+        # Treated the same as when several instances are polled at once
+        self.assertFalse(self.tracker.tracking('abc-123'))
+
+    def test_poll_many(self):
+        self.tracker.track('abc-123')
+        self.tracker.track('def-456')
+        self.tracker.track('deleted')
+        self.mock_client.servers.list.return_value = [
+            self._server('abc-123', 'ACTIVE'),
+            self._server('def-456', 'ACTIVE', 'powering-off'),
+            self._server('unmanaged', 'ACTIVE'),
+        ]
+        self.tracker.poll(['abc-123', 'def-456', 'deleted'])
+        self.mock_client.servers.list.assert_called_once_with(limit=-1)
+        self.assertFalse(self.mock_client.servers.get.called)
+        self.assertFalse(self.tracker.tracking('abc-123'))
+        self.assertTrue(self.tracker.tracking('def-456'))
+        self.assertFalse(self.tracker.tracking('deleted'))
+        self.assertIsNone(self.tracker.table.get('unmanaged'))
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc._now')
+    def test_due(self, mock_now):
+        mock_now.return_value = 100
+        self.tracker.track('abc-123')
+        mock_now.return_value = 101
+        self.assertEqual(['abc-123'], self.tracker._due())
+
+    def test_background(self):
+        self.tracker = openstackbmc.TransitionTracker(
+            self.mock_client, openstackbmc.StatusTable(), 0.01)
+        self.mock_client.servers.get.return_value = self._server(
+            'abc-123', 'ACTIVE')
+        self.tracker.track('abc-123')
+        for i in range(100):
+            if not self.tracker.tracking('abc-123'):
+                break
+            time.sleep(0.01)
+        self.assertFalse(self.tracker.tracking('abc-123'))
+        self.assertEqual('ACTIVE', self.tracker.table.get('abc-123'))
+
+    def test_finish(self):
+        self.tracker.track('abc-123')
+        self.tracker.finish('abc-123')
+        self.tracker.finish('def-456')
+        self.assertFalse(self.tracker.tracking('abc-123'))
+
+
+class TestNotificationListener(testtools.TestCase):
+    def setUp(self):
+        super(TestNotificationListener, self).setUp()
+        self.table = openstackbmc.StatusTable()
+        self.tracker = mock.Mock()
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        self.listener = openstackbmc.NotificationListener(
+            os.path.join(tempdir, 'notifications'), self.table, self.tracker)
+
+    def _notification(self, event_type, state, task_state=None,
+                      uuid='abc-123'):
+        return json.dumps({
+            'priority': 'INFO',
+            'event_type': event_type,
+            'publisher_id': 'nova-compute:compute-0',
+            'payload': {
+                'nova_object.name': 'InstanceActionPayload',
+                'nova_object.namespace': 'nova',
+                'nova_object.version': '1.8',
+                'nova_object.data': {'uuid': uuid,
+                                     'state': state,
+                                     'task_state': task_state,
+                                     'power_state': 'running'},
+            },
+        })
+
+    def test_power_on(self):
+        self.assertTrue(self.listener.handle(
+            self._notification('instance.power_on.start', 'stopped',
+                               'powering-on')))
+        self.assertEqual('SHUTOFF', self.table.get('abc-123'))
+        self.assertFalse(self.tracker.finish.called)
+        self.assertTrue(self.listener.handle(
+            self._notification('instance.power_on.end', 'active')))
+        self.assertEqual('ACTIVE', self.table.get('abc-123'))
+        self.tracker.finish.assert_called_once_with('abc-123')
+
+    def test_reboot(self):
+        self.listener.handle(self._notification('instance.reboot.start',
+                                                'active', 'rebooting_hard'))
+        self.assertEqual('HARD_REBOOT', self.table.get('abc-123'))
+
+    def test_oslo_envelope(self):
+        message = json.dumps({
+            'oslo.version': '2.0',
+            'oslo.message': self._notification('instance.power_off.end',
+                                               'stopped')})
+        self.assertTrue(self.listener.handle(message))
+        self.assertEqual('SHUTOFF', self.table.get('abc-123'))
+
+    def test_ignored(self):
+        self.assertFalse(self.listener.handle(
+            self._notification('volume.create.end', 'available')))
+        self.assertFalse(self.listener.handle(
+            self._notification('instance.update', 'unknown')))
+        self.assertFalse(self.listener.handle(
+            json.dumps({'event_type': 'instance.update', 'payload': {}})))
+        self.assertIsNone(self.table.get('abc-123'))
+
+    def test_no_tracker(self):
+        self.listener.tracker = None
+        self.assertTrue(self.listener.handle(
+            self._notification('instance.power_off.end', 'stopped')))
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.log')
+    def test_socket(self, mock_log):
+        # A socket left behind by a previous run is replaced
+        open(self.listener.path, 'w').close()
+        self.listener.bind()
+        self.listener.start()
+        self.assertEqual(0o600, os.stat(self.listener.path).st_mode & 0o777)
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.addCleanup(sender.close)
+        sender.sendto(b'not json', self.listener.path)
+        sender.sendto(self._notification('instance.power_on.end',
+                                         'active').encode('utf-8'),
+                      self.listener.path)
+        for i in range(100):
+            if self.table.get('abc-123'):
+                break
+            time.sleep(0.01)
+        self.assertEqual('ACTIVE', self.table.get('abc-123'))
+        self.assertEqual('error', mock_log.call_args[1]['level'])
+
+
+class TestControlServer(testtools.TestCase):
+    def setUp(self):
+        super(TestControlServer, self).setUp()
+        self.useFixture(fixtures.MockPatch(
+            'openstack_virtual_baremetal.openstackbmc.log'))
+        self.useFixture(fixtures.MockPatchObject(
+            openstackbmc, 'metrics', openstackbmc.Metrics()))
+        self.log_writer = self.useFixture(fixtures.MockPatchObject(
+            openstackbmc, 'log_writer', openstackbmc.LogWriter())).mock
+        self.foo = self._bmc('abc-123', 'foo')
+        self.bar = self._bmc('def-456', 'bar')
+        self.bmcs = {'1.2.3.4': self.foo, '1.2.3.5': self.bar}
+        self.args = mock.Mock(cache_ttl=30, boot_device_ttl=300)
+        self.server = openstackbmc.ControlServer('/run/control.sock',
+                                                 self.bmcs, self.args)
+
+    def _bmc(self, instance, name):
+        mybmc = mock.Mock(instance=instance, instance_name=name)
+        mybmc.describe.return_value = {'instance': instance}
+        return mybmc
+
+    def test_dump(self):
+        openstackbmc.metrics.inc('openstackbmc_nova_calls_total',
+                                 operation='get')
+        self.assertEqual(
+            {'bmcs': [{'address': '1.2.3.4', 'instance': 'abc-123'},
+                      {'address': '1.2.3.5', 'instance': 'def-456'}],
+             'counters': {'openstackbmc_nova_calls_total{operation="get"}':
+                          1},
+             'log_level': 'info'},
+            self.server.handle('dump\n'))
+
+    def test_dump_one(self):
+        for name in ('1.2.3.5', 'def-456', 'bar'):
+            reply = self.server.handle('dump %s' % name)
+            self.assertEqual([{'address': '1.2.3.5', 'instance': 'def-456'}],
+                             reply['bmcs'])
+
+    def test_dump_unknown(self):
+        self.assertEqual({'error': 'dump: No BMC for baz'},
+                         self.server.handle('dump baz'))
+
+    def test_flush(self):
+        reply = self.server.handle('flush foo')
+        self.foo.flush_cache.assert_called_once_with()
+        self.assertFalse(self.bar.flush_cache.called)
+        self.assertEqual('1.2.3.4', reply['bmcs'][0]['address'])
+
+    def test_refresh(self):
+        self.foo._fetch_status.side_effect = Exception('Nova is down')
+        self.assertEqual({'error': 'refresh: Nova is down'},
+                         self.server.handle('refresh foo'))
+        self.foo._fetch_status.side_effect = None
+        reply = self.server.handle('refresh 1.2.3.4')
+        self.assertEqual(2, self.foo._fetch_status.call_count)
+        self.assertEqual('1.2.3.4', reply['bmcs'][0]['address'])
+
+    def test_ttl(self):
+        self.assertEqual({'cache_ttl': 5},
+                         self.server.handle('ttl status 5'))
+        self.assertEqual({'boot_device_ttl': 60},
+                         self.server.handle('ttl boot-device 60'))
+        for mybmc in (self.foo, self.bar):
+            self.assertEqual(5, mybmc.cache_ttl)
+            self.assertEqual(60, mybmc.boot_device_ttl)
+        # For BMCs started later
+        self.assertEqual(5, self.args.cache_ttl)
+        self.assertIn('error', self.server.handle('ttl foo 5'))
+        self.assertIn('error', self.server.handle('ttl status'))
+        self.assertIn('error', self.server.handle('ttl status never'))
+        self.assertEqual(5, self.args.cache_ttl)
+
+    def test_log_level(self):
+        self.assertEqual({'log_level': 'debug'},
+                         self.server.handle('log-level debug'))
+        self.assertEqual('debug', openstackbmc.log_writer.level)
+        self.assertIn('error', self.server.handle('log-level loud'))
+        self.assertEqual('debug', openstackbmc.log_writer.level)
+
+    def test_unknown(self):
+        self.assertEqual({'error': 'Unknown command: reboot'},
+                         self.server.handle('reboot\n'))
+        self.assertEqual({'error': 'Unknown command: '},
+                         self.server.handle(''))
+
+    def test_send_control(self):
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        self.server.path = os.path.join(tempdir, 'control.sock')
+        self.server.bind()
+        self.server.start()
+        self.assertEqual(0o600, os.stat(self.server.path).st_mode & 0o777)
+        self.assertEqual(
+            {'log_level': 'warning'},
+            openstackbmc.send_control(self.server.path, 'log-level warning'))
+        reply = openstackbmc.send_control(self.server.path, 'dump foo')
+        self.assertEqual([{'address': '1.2.3.4', 'instance': 'abc-123'}],
+                         reply['bmcs'])
+
+    def test_control_paths(self):
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        path = os.path.join(tempdir, 'control.sock')
+        self.assertEqual([], openstackbmc._control_paths(path))
+        for index in range(2):
+            open('%s.%d' % (path, index), 'w').close()
+        self.assertEqual([path + '.0', path + '.1'],
+                         openstackbmc._control_paths(path))
+        open(path, 'w').close()
+        self.assertEqual([path], openstackbmc._control_paths(path))
+
+
+class TestSharedListener(testtools.TestCase):
+    def setUp(self):
+        super(TestSharedListener, self).setUp()
+        self.handlers = {}
+        self.sessionqueue = collections.deque()
+        self.useFixture(fixtures.MockPatchObject(
+            openstackbmc.ipmisession.Session, 'bmc_handlers', self.handlers))
+        self.useFixture(fixtures.MockPatchObject(
+            openstackbmc.ipmisession, 'sessionqueue', self.sessionqueue))
+        self.useFixture(fixtures.MockPatchObject(
+            openstackbmc.ipmisession, 'iosockets', [mock.Mock()]))
+        self.listener = openstackbmc.SharedListener(0)
+        self.bmc = mock.Mock()
+        self.bmc.pktqueue = collections.deque()
+        self.listener.attach(self.bmc, '::ffff:127.0.0.5')
+        self.vsock = self.bmc.serversocket
+        self.packed = socket.inet_pton(socket.AF_INET6, '::ffff:127.0.0.5')
+
+    def test_attach(self):
+        self.bmc._close_socket.assert_called_once_with()
+        self.assertEqual('::ffff:127.0.0.5', self.bmc.port)
+        self.assertEqual({self.vsock: {0: self.bmc}}, self.handlers)
+        self.assertEqual({self.packed: self.vsock}, self.listener.sockets)
+        self.assertEqual(('::ffff:127.0.0.5', '::ffff:127.0.0.5'),
+                         self.vsock.getsockname())
+
+    def test_detach(self):
+        self.vsock.close()
+        self.assertEqual({}, self.listener.sockets)
+
+    def test_dispatch_sessionless(self):
+        client = ('::ffff:127.0.0.9', 1000, 0, 0)
+        self.assertTrue(self.listener.dispatch(b'1234', client, self.packed))
+        self.assertEqual([(b'1234', client, self.vsock, False)],
+                         list(self.bmc.pktqueue))
+        self.assertEqual([self.bmc], list(self.sessionqueue))
+
+    def test_dispatch_session(self):
+        client = ('::ffff:127.0.0.9', 1000, 0, 0)
+        session = mock.Mock()
+        session.pktqueue = collections.deque()
+        other_session = mock.Mock()
+        self.handlers[client] = {'::ffff:127.0.0.6': other_session,
+                                 '::ffff:127.0.0.5': session}
+        self.assertTrue(self.listener.dispatch(b'1234', client, self.packed))
+        self.assertEqual([(b'1234', client, self.vsock, True)],
+                         list(session.pktqueue))
+        self.assertEqual([session], list(self.sessionqueue))
+
+    def test_dispatch_ignored(self):
+        client = ('::ffff:127.0.0.9', 1000, 0, 0)
+        other = socket.inet_pton(socket.AF_INET6, '::ffff:127.0.0.6')
+        self.assertFalse(self.listener.dispatch(b'1234', client, other))
+        self.assertFalse(self.listener.dispatch(b'123', client, self.packed))
+        del self.handlers[self.vsock]
+        self.assertFalse(self.listener.dispatch(b'1234', client, self.packed))
+        self.assertEqual([], list(self.sessionqueue))
+
+    @testtools.skipUnless(hasattr(socket.socket, 'recvmsg'),
+                          'Requires recvmsg')
+    @mock.patch('pyghmi.ipmi.private.session.Session._assignsocket')
+    def test_socket(self, mock_assign):
+        self.listener.bind()
+        self.addCleanup(self.listener.socket.close)
+        mock_assign.assert_called_once_with()
+        port = self.listener.socket.getsockname()[1]
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(client.close)
+        client.bind(('127.0.0.9', 0))
+        client.settimeout(5)
+        client.sendto(b'request', ('127.0.0.5', port))
+        # Not for any BMC
+        client.sendto(b'request', ('127.0.0.6', port))
+        for i in range(100):
+            self.listener.receive()
+            if self.bmc.pktqueue:
+                break
+            time.sleep(0.01)
+        data, clientaddr, vsock, in_session = self.bmc.pktqueue.popleft()
+        self.assertEqual(b'request', data)
+        self.assertEqual(('::ffff:127.0.0.9', client.getsockname()[1], 0, 0),
+                         clientaddr)
+        self.assertIs(self.vsock, vsock)
+        self.vsock.sendto(b'reply', clientaddr)
+        # The reply comes from the address the request was sent to
+        self.assertEqual((b'reply', ('127.0.0.5', port)),
+                         client.recvfrom(100))
+        time.sleep(0.05)
+        self.listener.receive()
+        self.assertEqual(0, len(self.bmc.pktqueue))
+
+
+class TestShard(unittest.TestCase):
+    def test_shard_of(self):
+        addresses = ['10.0.%d.%d' % (i // 250, i % 250) for i in range(1000)]
+        shards = [openstackbmc.shard_of(a, 4) for a in addresses]
+        self.assertEqual(shards, [openstackbmc.shard_of(a, 4)
+                                  for a in addresses])
+        counts = collections.Counter(shards)
+        self.assertEqual([0, 1, 2, 3], sorted(counts))
+        self.assertTrue(min(counts.values()) > 200)
+
+    def test_in_shard(self):
+        instances = dict(('10.0.0.%d' % i, 'node-%d' % i) for i in range(20))
+        shards = [openstackbmc.in_shard(instances, (i, 3)) for i in range(3)]
+        merged = {}
+        for shard in shards:
+            self.assertTrue(shard)
+            merged.update(shard)
+        self.assertEqual(instances, merged)
+        self.assertEqual(20, sum(len(shard) for shard in shards))
+        self.assertEqual(instances, openstackbmc.in_shard(instances, None))
+
+
+@mock.patch('openstack_virtual_baremetal.openstackbmc.log')
+class TestSupervisor(testtools.TestCase):
+    def setUp(self):
+        super(TestSupervisor, self).setUp()
+        self.args = mock.Mock(state_file='/var/lib/state.json',
+                              notification_socket='/run/notify.sock',
+                              control_socket='/run/control.sock',
+                              profile='/tmp/profile', api_rate=10,
+                              api_burst=4, processes=0, metrics_port=9100)
+        self.instances = {'1.2.3.4': 'foo', '1.2.3.5': 'bar'}
+        self.supervisor = openstackbmc.Supervisor(self.args, self.instances,
+                                                  2)
+        self.mock_mp = self.useFixture(fixtures.MockPatch(
+            'openstack_virtual_baremetal.openstackbmc._multiprocessing')).mock
+        self.mock_mp.Pipe.side_effect = lambda duplex: (mock.Mock(),
+                                                        mock.Mock())
+        self.mock_mp.Process.side_effect = lambda **kwargs: mock.Mock(pid=1)
+
+    def test_worker_args(self, mock_log):
+        args = self.supervisor.worker_args(1)
+        self.assertEqual(1, args.processes)
+        self.assertEqual(0, args.metrics_port)
+        self.assertEqual(5, args.api_rate)
+        self.assertEqual(2, args.api_burst)
+        self.assertEqual('/var/lib/state.json.1', args.state_file)
+        self.assertEqual('/run/notify.sock.1', args.notification_socket)
+        self.assertEqual('/run/control.sock.1', args.control_socket)
+        self.assertEqual('/tmp/profile/worker-1', args.profile)
+        # The supervisor's own options are unchanged
+        self.assertEqual('/var/lib/state.json', self.args.state_file)
+
+    def test_worker_args_small_burst(self, mock_log):
+        self.args.api_rate = 4
+        self.args.api_burst = 0
+        args = openstackbmc.Supervisor(self.args, self.instances,
+                                       4).worker_args(0)
+        self.assertEqual(1, args.api_rate)
+        self.assertEqual(2, args.api_burst)
+        limiter = openstackbmc.RateLimiter()
+        limiter.configure(args.api_rate, args.api_burst)
+        self.assertGreaterEqual(limiter.burst, limiter.reserve + 1)
+        self.assertTrue(limiter.ready(limiter.READ))
+        # Unlimited stays unlimited
+        self.args.api_rate = 0
+        args = openstackbmc.Supervisor(self.args, self.instances,
+                                       4).worker_args(0)
+        self.assertEqual(0, args.api_rate)
+        self.assertEqual(0, args.api_burst)
+
+    def test_start(self, mock_log):
+        self.supervisor.start(1)
+        process = self.supervisor.workers[1][0]
+        kwargs = self.mock_mp.Process.call_args[1]
+        self.assertIs(openstackbmc._run_worker, kwargs['target'])
+        worker_args, instances, shard, sender = kwargs['args']
+        self.assertEqual('/var/lib/state.json.1', worker_args.state_file)
+        self.assertEqual(self.instances, instances)
+        self.assertEqual((1, 2), shard)
+        self.assertTrue(process.daemon)
+        process.start.assert_called_once_with()
+        sender.close.assert_called_once_with()
+
+    def test_poll(self, mock_log):
+        self.supervisor.start(0)
+        self.supervisor.start(1)
+        process, receiver = self.supervisor.workers[0]
+        process.exitcode = None
+        self.supervisor.workers[1][0].exitcode = None
+        self.supervisor.workers[1][1].poll.return_value = False
+        worker = openstackbmc.Metrics()
+        worker.inc('openstackbmc_nova_calls_total', 2, operation='get')
+        worker.set('openstackbmc_power_state', 1, instance='abc-123')
+        messages = [('ready', None), ('metrics', worker.snapshot())]
+        receiver.poll.side_effect = lambda: bool(messages)
+        receiver.recv.side_effect = lambda: messages.pop(0)
+        self.supervisor.poll()
+        self.assertEqual(set([0]), self.supervisor.ready)
+        output = self.supervisor.render().splitlines()
+        self.assertIn('openstackbmc_nova_calls_total{operation="get"} 2',
+                      output)
+        self.assertIn('openstackbmc_power_state{instance="abc-123"} 1',
+                      output)
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc._now')
+    def test_poll_restart(self, mock_now, mock_log):
+        mock_now.return_value = 100
+        self.supervisor.start(0)
+        self.supervisor.start(1)
+        self.supervisor.workers[1][0].exitcode = None
+        self.supervisor.workers[1][1].poll.return_value = False
+        process, receiver = self.supervisor.workers[0]
+        receiver.poll.return_value = False
+        worker = openstackbmc.Metrics()
+        worker.inc('openstackbmc_nova_calls_total', 2, operation='get')
+        worker.set('openstackbmc_power_state', 1, instance='abc-123')
+        self.supervisor._latest[0] = worker.snapshot()
+        process.exitcode = 1
+        self.supervisor.poll()
+        receiver.close.assert_called_once_with()
+        self.assertEqual(1, self.supervisor.failures[0])
+        self.assertTrue(100 < self.supervisor.restart_at[0] <= 100.5)
+        # Counters survive the worker, but its gauges do not
+        output = self.supervisor.render().splitlines()
+        self.assertIn('openstackbmc_nova_calls_total{operation="get"} 2',
+                      output)
+        self.assertNotIn('openstackbmc_power_state{instance="abc-123"} 1',
+                         output)
+        self.assertEqual(2, self.mock_mp.Process.call_count)
+        self.supervisor.poll()
+        self.assertEqual(2, self.mock_mp.Process.call_count)
+        mock_now.return_value = 101
+        self.supervisor.poll()
+        self.assertEqual(3, self.mock_mp.Process.call_count)
+        self.assertNotIn(0, self.supervisor.restart_at)
+        self.assertEqual(1, self.supervisor.metrics.get(
+            'openstackbmc_worker_restarts_total', worker='0'))
+
+    @mock.patch('os.kill')
+    def test_signal_workers(self, mock_kill, mock_log):
+        self.supervisor.start(0)
+        self.supervisor.start(1)
+        running, stopped = [w[0] for w in self.supervisor.workers]
+        running.exitcode = None
+        stopped.exitcode = 0
+        self.supervisor.signal_workers(signal.SIGHUP)
+        mock_kill.assert_called_once_with(running.pid, signal.SIGHUP)
+
+
+class TestRunWorker(testtools.TestCase):
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.log_writer')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.serve')
+    def test_run_worker(self, mock_serve, mock_log_writer):
+        self.useFixture(fixtures.EnvironmentVariable('NOTIFY_SOCKET', 'foo'))
+        self.useFixture(fixtures.EnvironmentVariable('WATCHDOG_USEC', '1'))
+        args = mock.Mock(log_format='json')
+        conn = mock.Mock()
+        openstackbmc._run_worker(args, {'1.2.3.4': 'foo'}, (0, 2), conn)
+        self.assertNotIn('NOTIFY_SOCKET', os.environ)
+        self.assertNotIn('WATCHDOG_USEC', os.environ)
+        mock_log_writer.configure.assert_called_once_with(
+            json_format=True, buffered=args.log_buffered,
+            status_interval=args.log_status_interval,
+            level=args.log_level)
+        mock_serve.assert_called_once_with(args, {'1.2.3.4': 'foo'},
+                                           shard=(0, 2), ready=mock.ANY)
+        mock_serve.call_args[1]['ready']()
+        conn.send.assert_called_once_with(('ready', None))
+
+
+class TestSdNotify(testtools.TestCase):
+    def _listen(self, path):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.addCleanup(sock.close)
+        sock.bind(path)
+        sock.settimeout(5)
+        return sock
+
+    def test_notify(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path, 'n')
+        sock = self._listen(path)
+        self.useFixture(fixtures.EnvironmentVariable('NOTIFY_SOCKET', path))
+        self.assertTrue(openstackbmc.sd_notify('READY=1'))
+        self.assertEqual(b'READY=1', sock.recv(100))
+
+    def test_notify_abstract(self):
+        name = 'openstackbmc-test-%d' % os.getpid()
+        sock = self._listen('\0' + name)
+        self.useFixture(fixtures.EnvironmentVariable('NOTIFY_SOCKET',
+                                                     '@' + name))
+        self.assertTrue(openstackbmc.sd_notify('WATCHDOG=1'))
+        self.assertEqual(b'WATCHDOG=1', sock.recv(100))
+
+    def test_notify_unset(self):
+        self.useFixture(fixtures.EnvironmentVariable('NOTIFY_SOCKET', None))
+        self.assertFalse(openstackbmc.sd_notify('READY=1'))
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.log')
+    def test_notify_error(self, mock_log):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path, 'n')
+        self.useFixture(fixtures.EnvironmentVariable('NOTIFY_SOCKET', path))
+        self.assertFalse(openstackbmc.sd_notify('READY=1'))
+        self.assertEqual('warning', mock_log.call_args[1]['level'])
+
+
+@mock.patch('openstack_virtual_baremetal.openstackbmc.sd_notify')
+class TestWatchdog(testtools.TestCase):
+    def _watchdog(self, usec='4000000', pid=None):
+        self.useFixture(fixtures.EnvironmentVariable('WATCHDOG_USEC', usec))
+        self.useFixture(fixtures.EnvironmentVariable('WATCHDOG_PID', pid))
+        watchdog = openstackbmc.Watchdog()
+        watchdog.configure()
+        return watchdog
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc._now')
+    def test_feed(self, mock_now, mock_notify):
+        watchdog = self._watchdog(pid=str(os.getpid()))
+        self.assertEqual(2, watchdog.interval)
+        mock_now.return_value = 100
+        watchdog.feed()
+        mock_now.return_value = 101
+        watchdog.feed()
+        mock_notify.assert_called_once_with('WATCHDOG=1')
+        mock_now.return_value = 102
+        watchdog.feed()
+        self.assertEqual(2, mock_notify.call_count)
+
+    def test_disabled(self, mock_notify):
+        watchdog = self._watchdog(usec=None)
+        self.assertEqual(0, watchdog.interval)
+        watchdog.feed()
+        self.assertFalse(mock_notify.called)
+
+    def test_other_pid(self, mock_notify):
+        watchdog = self._watchdog(pid=str(os.getpid() + 1))
+        self.assertEqual(0, watchdog.interval)
+
+    @mock.patch('pyghmi.ipmi.private.session.Session.wait_for_rsp')
+    def test_listen(self, mock_wait, mock_notify):
+        mock_wait.side_effect = [None, KeyboardInterrupt]
+        with mock.patch.object(openstackbmc, 'watchdog',
+                               self._watchdog()) as watchdog:
+            self.assertRaises(KeyboardInterrupt,
+                              openstackbmc.OpenStackBmc.listen)
+        mock_wait.assert_called_with(watchdog.interval)
+        mock_notify.assert_called_once_with('WATCHDOG=1')
+
+
+class TestLazyProxy(unittest.TestCase):
+    def test_lazy(self):
+        factory = mock.Mock()
+        proxy = openstackbmc.LazyProxy(factory)
+        self.assertFalse(factory.called)
+        self.assertIs(factory.return_value.foo, proxy.foo)
+        self.assertIs(factory.return_value.bar, proxy.bar)
+        factory.assert_called_once_with()
+
+    def test_deferred_imports(self):
+        self.assertIs(exceptions.NotFound, openstackbmc.exceptions.NotFound)
+
+    def test_measure_imports(self):
+        results = openstackbmc.measure_imports()
+        self.assertEqual(['openstackbmc', 'pyghmi.ipmi.bmc'] +
+                         openstackbmc.DEFERRED_IMPORTS,
+                         [name for name, seconds, loaded in results])
+        name, seconds, loaded = results[0]
+        self.assertGreater(seconds, 0)
+        self.assertEqual([], loaded)
+        name, seconds, loaded = results[-1]
+        self.assertEqual(['os_client_config'], loaded)
+
+
+class TestResolveInstances(unittest.TestCase):
+    def _server(self, id, name):
+        server = mock.Mock()
+        server.id = id
+        server.name = name
+        return server
+
+    def test_resolve_instances(self):
+        mock_client = mock.Mock()
+        mock_client.servers.list.return_value = [
+            self._server('abc-123', 'foo'),
+            self._server('def-456', 'bar'),
+            self._server('ghi-789', 'dup'),
+            self._server('jkl-012', 'dup'),
+        ]
+        resolved = openstackbmc.resolve_instances(
+            mock_client, ['abc-123', 'bar', 'dup', 'missing'])
+        mock_client.servers.list.assert_called_once_with(limit=-1)
+        self.assertEqual({'abc-123': ('abc-123', 'foo'),
+                          'bar': ('def-456', 'bar')},
+                         resolved)
+
+
+@mock.patch('pyghmi.ipmi.private.session._io_wait')
+class TestWaitForEventLoop(unittest.TestCase):
+    @mock.patch('pyghmi.ipmi.private.session.myself', '::1')
+    @mock.patch('pyghmi.ipmi.private.session.iothread', mock.Mock())
+    def test_wait(self, mock_io_wait):
+        openstackbmc._wait_for_event_loop()
+        mock_io_wait.assert_called_once_with(0)
+
+    @mock.patch('pyghmi.ipmi.private.session.iothread', None)
+    def test_no_thread(self, mock_io_wait):
+        openstackbmc._wait_for_event_loop()
+        self.assertFalse(mock_io_wait.called)
+
+
+@mock.patch('openstack_virtual_baremetal.openstackbmc._wake_event_loop')
+@mock.patch('openstack_virtual_baremetal.openstackbmc.log')
+class TestInstancesWatcher(testtools.TestCase):
+    def setUp(self):
+        super(TestInstancesWatcher, self).setUp()
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        self.path = os.path.join(tempdir, 'instances.json')
+        self._write({'1.2.3.4': 'foo', '1.2.3.5': 'bar'}, 1000)
+        self.mock_client = mock.Mock()
+        self.bmcs = {'1.2.3.4': mock.Mock(), '1.2.3.5': mock.Mock()}
+        self.instances = {'1.2.3.4': 'foo', '1.2.3.5': 'bar'}
+        self.start_bmc = mock.Mock()
+        self.on_change = mock.Mock()
+        self.watcher = openstackbmc.InstancesWatcher(
+            self.path, 10, self.mock_client, self.bmcs, self.instances,
+            self.start_bmc, fixed={'fd00::1': 'qux'},
+            on_change=self.on_change)
+        self.resolve = self.useFixture(fixtures.MockPatch(
+            'openstack_virtual_baremetal.openstackbmc.resolve_instances')).mock
+
+    def _write(self, instances, mtime):
+        with open(self.path, 'w') as f:
+            json.dump(instances, f)
+        os.utime(self.path, (mtime, mtime))
+
+    def test_reload_shard(self, mock_log, mock_wake):
+        self.bmcs.clear()
+        self.instances.clear()
+        addresses = ['1.2.3.%d' % i for i in range(10)]
+        self._write(dict((a, 'foo') for a in addresses), 2000)
+        self.resolve.return_value = {'foo': ('abc-123', 'foo'),
+                                     'qux': ('jkl-012', 'qux')}
+        self.watcher.shard = (1, 3)
+        self.assertTrue(self.watcher.reload())
+        expected = [a for a in addresses + ['fd00::1']
+                    if openstackbmc.shard_of(a, 3) == 1]
+        self.assertTrue(expected)
+        self.assertEqual(sorted(expected), sorted(self.bmcs))
+
+    def test_unchanged(self, mock_log, mock_wake):
+        self.assertFalse(self.watcher.reload())
+        self.assertFalse(self.resolve.called)
+        self.assertFalse(self.on_change.called)
+
+    def test_reload(self, mock_log, mock_wake):
+        foo_bmc = self.bmcs['1.2.3.4']
+        bar_bmc = self.bmcs['1.2.3.5']
+        self._write({'1.2.3.4': 'foo', '1.2.3.5': 'baz', '1.2.3.6': 'quux'},
+                    2000)
+        instance_map = {'baz': ('def-456', 'baz'),
+                        'quux': ('ghi-789', 'quux'),
+                        'qux': ('jkl-012', 'qux')}
+        self.resolve.return_value = instance_map
+        self.start_bmc.side_effect = lambda address, instance, m: address
+        self.assertTrue(self.watcher.reload())
+        self.resolve.assert_called_once_with(self.mock_client,
+                                             set(['baz', 'quux', 'qux']))
+        self.assertFalse(foo_bmc.close.called)
+        bar_bmc.close.assert_called_once_with()
+        self.assertEqual([mock.call('1.2.3.5', 'baz', instance_map),
+                          mock.call('1.2.3.6', 'quux', instance_map),
+                          mock.call('fd00::1', 'qux', instance_map)],
+                         self.start_bmc.call_args_list)
+        self.assertEqual({'1.2.3.4': foo_bmc, '1.2.3.5': '1.2.3.5',
+                          '1.2.3.6': '1.2.3.6', 'fd00::1': 'fd00::1'},
+                         self.bmcs)
+        self.assertEqual({'1.2.3.4': 'foo', '1.2.3.5': 'baz',
+                          '1.2.3.6': 'quux', 'fd00::1': 'qux'},
+                         self.instances)
+        mock_wake.assert_called_once_with()
+        self.on_change.assert_called_once_with()
+        # Nothing more to do until the file changes again
+        self.assertFalse(self.watcher.reload())
+
+    def test_reload_removed(self, mock_log, mock_wake):
+        bar_bmc = self.bmcs['1.2.3.5']
+        self.watcher.fixed = {}
+        self._write({'1.2.3.4': 'foo'}, 2000)
+        self.assertTrue(self.watcher.reload())
+        self.assertFalse(self.resolve.called)
+        bar_bmc.close.assert_called_once_with()
+        self.assertEqual(['1.2.3.4'], list(self.bmcs))
+        self.assertEqual({'1.2.3.4': 'foo'}, self.instances)
+        self.on_change.assert_called_once_with()
+
+    def test_reload_not_found(self, mock_log, mock_wake):
+        self.watcher.fixed = {}
+        self._write({'1.2.3.4': 'foo', '1.2.3.5': 'bar', '1.2.3.6': 'baz'},
+                    2000)
+        self.resolve.return_value = {}
+        self.assertFalse(self.watcher.reload())
+        self.assertFalse(self.start_bmc.called)
+        self.assertEqual('error', mock_log.call_args[1]['level'])
+        # Retried at the next check even though the file has not changed
+        self.resolve.return_value = {'baz': ('ghi-789', 'baz')}
+        self.assertTrue(self.watcher.reload())
+        self.start_bmc.assert_called_once_with('1.2.3.6', 'baz',
+                                               self.resolve.return_value)
+        self.assertEqual(2000, self.watcher.mtime)
+
+    def test_reload_retry(self, mock_log, mock_wake):
+        self.bmcs.clear()
+        self.instances.clear()
+        watcher = openstackbmc.InstancesWatcher(
+            None, 30, self.mock_client, self.bmcs, self.instances,
+            self.start_bmc, fixed={'1.2.3.4': 'foo'},
+            on_change=self.on_change)
+        # Nothing changes without a file unless there is something to retry
+        self.assertFalse(watcher.reload())
+        self.assertFalse(self.resolve.called)
+        watcher.reset()
+        self.resolve.return_value = {}
+        self.assertFalse(watcher.reload())
+        self.resolve.return_value = {'foo': ('abc-123', 'foo')}
+        self.assertTrue(watcher.reload())
+        self.start_bmc.assert_called_once_with('1.2.3.4', 'foo',
+                                               self.resolve.return_value)
+        self.assertEqual({'1.2.3.4': 'foo'}, self.instances)
+        self.assertFalse(watcher.reload())
+
+    def test_reload_invalid(self, mock_log, mock_wake):
+        with open(self.path, 'w') as f:
+            f.write('{"1.2.3.4": ')
+        os.utime(self.path, (2000, 2000))
+        self.assertFalse(self.watcher.reload())
+        self.assertEqual(2, len(self.bmcs))
+        self.assertEqual('warning', mock_log.call_args[1]['level'])
+
+    def test_wake(self, mock_log, mock_wake):
+        self.watcher.interval = 60
+        self._write({'1.2.3.4': 'foo'}, 2000)
+        self.watcher.fixed = {}
+        self.watcher.start()
+        self.watcher.wake()
+        for i in range(100):
+            if self.on_change.called:
+                break
+            time.sleep(.01)
+        self.on_change.assert_called_once_with()
+
+
+class TestState(testtools.TestCase):
+    def test_save_load(self):
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        path = os.path.join(tempdir, 'state.json')
+        state = {'instances': {'foo': ['abc-123', 'foo']}}
+        openstackbmc.save_state(path, state)
+        self.assertEqual(state, openstackbmc.load_state(path))
+        self.assertEqual(['state.json'], os.listdir(tempdir))
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.log')
+    def test_load_missing(self, mock_log):
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        path = os.path.join(tempdir, 'state.json')
+        self.assertEqual({}, openstackbmc.load_state(path))
+        self.assertTrue(mock_log.called)
+
+    def _bmc(self, instance, boot_device=None, boot_device_time=None):
+        bmc = mock.Mock()
+        bmc.instance = instance
+        bmc.boot_device = boot_device
+        bmc.boot_device_time = boot_device_time
+        return bmc
+
+    @mock.patch('time.time', return_value=1000)
+    @mock.patch('openstack_virtual_baremetal.openstackbmc._now',
+                return_value=100)
+    def test_snapshot_state(self, mock_now, mock_time):
+        table = openstackbmc.StatusTable()
+        table.update('abc-123', 'ACTIVE', 90)
+        bmcs = [self._bmc('abc-123', 'network', 40), self._bmc('def-456')]
+        self.assertEqual({'saved': 1000,
+                          'statuses': {'abc-123': ['ACTIVE', 10]},
+                          'boot_devices': {'abc-123': ['network', 60]}},
+                         openstackbmc.snapshot_state(bmcs, table))
+
+    @mock.patch('time.time', return_value=1005)
+    @mock.patch('openstack_virtual_baremetal.openstackbmc._now',
+                return_value=100)
+    def test_restore_state(self, mock_now, mock_time):
+        state = {'saved': 1000,
+                 'statuses': {'abc-123': ['ACTIVE', 10],
+                              'def-456': ['SHUTOFF', 10],
+                              'unmanaged': ['ACTIVE', 10]},
+                 'boot_devices': {'abc-123': ['network', 60],
+                                  'def-456': ['network', 60]}}
+        table = openstackbmc.StatusTable()
+        # Newer than the saved status
+        table.update('def-456', 'ACTIVE', 99)
+        abc = openstackbmc.OpenStackBmc.__new__(openstackbmc.OpenStackBmc)
+        abc.instance = 'abc-123'
+        abc.boot_device = None
+        defg = self._bmc('def-456', 'hd', 99)
+        openstackbmc.restore_state(state, [abc, defg], table)
+        self.assertEqual(('ACTIVE', 15), table.lookup('abc-123'))
+        self.assertEqual(('ACTIVE', 1), table.lookup('def-456'))
+        self.assertEqual((None, None), table.lookup('unmanaged'))
+        self.assertEqual('network', abc.boot_device)
+        self.assertEqual(35, abc.boot_device_time)
+        self.assertFalse(defg._cache_boot_device.called)
+
+    def test_restore_state_empty(self):
+        table = openstackbmc.StatusTable()
+        bmc = self._bmc('abc-123')
+        openstackbmc.restore_state({}, [bmc], table)
+        self.assertIsNone(table.get('abc-123'))
+        self.assertFalse(bmc._cache_boot_device.called)
+
+
+class TestMain(testtools.TestCase):
+    def setUp(self):
+        super(TestMain, self).setUp()
+        # main opens a socket for pyghmi's IO thread, which would start it
+        self.mock_assign = self.useFixture(fixtures.MockPatch(
+            'openstack_virtual_baremetal.openstackbmc.ipmisession.Session.'
+            '_assignsocket')).mock
+        self.mock_wake = self.useFixture(fixtures.MockPatch(
+            'openstack_virtual_baremetal.openstackbmc._wake_event_loop')).mock
+
+    @mock.patch('os_client_config.make_client')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.OpenStackBmc')
+    def test_main(self, mock_bmc, mock_make_client):
+        mock_client = mock.Mock()
+        mock_make_client.return_value = mock_client
+        mock_argv = ['openstackbmc', '--port', '111', '--address', '1.2.3.4',
+                     '--instance', 'foobar', '--os-cloud', 'foo']
+        with mock.patch.object(sys, 'argv', mock_argv):
+            openstackbmc.main()
+        # The client is not created until it is first used
+        self.assertFalse(mock_make_client.called)
+        mock_bmc.assert_called_once_with({'admin': 'password'},
+                                         port=111,
+                                         address='::ffff:1.2.3.4',
+                                         instance='foobar',
+                                         cache_status=False,
+                                         os_cloud='foo',
+                                         novaclient=mock.ANY,
+                                         poller=None,
+                                         cache_ttl=30,
+                                         status_table=mock.ANY,
+                                         dispatcher=None,
+                                         boot_device_ttl=300,
+                                         instance_map={},
+                                         startup_timeout=0,
+                                         tracker=mock.ANY,
+                                         listener=None,
+                                         notifications=False
+                                         )
+        mock_bmc.listen.assert_called_once_with()
+        self.mock_assign.assert_called_once_with()
+        self.mock_wake.assert_called_once_with()
+        novaclient = mock_bmc.call_args[1]['novaclient']
+        self.assertIs(mock_client.servers, novaclient.servers)
+        self.assertIs(mock_client.servers, novaclient.servers)
+        mock_make_client.assert_called_once_with('compute', cloud='foo')
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.watchdog')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.sd_notify')
+    @mock.patch('os_client_config.make_client')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.OpenStackBmc')
+    def test_main_notify(self, mock_bmc, mock_make_client, mock_notify,
+                         mock_watchdog):
+        mock_bmc.listen.side_effect = lambda: self.assertTrue(
+            mock_notify.called)
+        mock_argv = ['openstackbmc', '--instance', 'foobar']
+        with mock.patch.object(sys, 'argv', mock_argv):
+            openstackbmc.main()
+        mock_notify.assert_called_once_with('READY=1\nSTATUS=Serving 1 BMCs')
+        mock_watchdog.configure.assert_called_once_with()
+        mock_bmc.listen.assert_called_once_with()
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.serve')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.Supervisor')
+    def test_main_processes(self, mock_supervisor, mock_serve):
+        mock_argv = ['openstackbmc', '--bmc', '1.2.3.4=foo', '--bmc',
+                     '1.2.3.5=bar', '--bmc', '1.2.3.6=baz',
+                     '--processes', '2']
+        with mock.patch.object(sys, 'argv', mock_argv):
+            openstackbmc.main()
+        instances = {'1.2.3.4': 'foo', '1.2.3.5': 'bar', '1.2.3.6': 'baz'}
+        mock_supervisor.assert_called_once_with(mock.ANY, instances, 2)
+        mock_supervisor.return_value.run.assert_called_once_with()
+        self.assertFalse(mock_serve.called)
+
+    @mock.patch('multiprocessing.cpu_count')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.serve')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.Supervisor')
+    def test_main_processes_per_cpu(self, mock_supervisor, mock_serve,
+                                    mock_cpu_count):
+        mock_cpu_count.return_value = 8
+        mock_argv = ['openstackbmc', '--bmc', '1.2.3.4=foo', '--bmc',
+                     '1.2.3.5=bar', '--processes', '0']
+        with mock.patch.object(sys, 'argv', mock_argv):
+            openstackbmc.main()
+        # No more workers than BMCs
+        mock_supervisor.assert_called_once_with(mock.ANY, mock.ANY, 2)
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.serve')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.Supervisor')
+    def test_main_processes_single_instance(self, mock_supervisor,
+                                            mock_serve):
+        mock_argv = ['openstackbmc', '--instance', 'foo', '--processes', '4']
+        with mock.patch.object(sys, 'argv', mock_argv):
+            openstackbmc.main()
+        self.assertFalse(mock_supervisor.called)
+        mock_serve.assert_called_once_with(mock.ANY, {'::': 'foo'})
+
+    def test_main_processes_shared_socket(self):
+        mock_argv = ['openstackbmc', '--bmc', '1.2.3.4=foo', '--bmc',
+                     '1.2.3.5=bar', '--processes', '2', '--shared-socket']
+        with mock.patch.object(sys, 'argv', mock_argv):
+            with mock.patch('sys.stderr'):
+                self.assertRaises(SystemExit, openstackbmc.main)
+
+    @mock.patch('os_client_config.make_client')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.OpenStackBmc')
+    def test_main_simulator(self, mock_bmc, mock_make_client):
+        mock_argv = ['openstackbmc', '--bmc', '1.2.3.4=foo',
+                     '--bmc', '1.2.3.5=bar', '--backend', 'simulator',
+                     '--simulator-boot-time', '5',
+                     '--simulator-power-failure-rate', '0.1']
+        with mock.patch.object(sys, 'argv', mock_argv):
+            openstackbmc.main()
+        self.assertFalse(mock_make_client.called)
+        compute = mock_bmc.call_args[1]['novaclient']
+        self.assertEqual(5, compute.boot_time)
+        self.assertEqual(0, compute.shutdown_time)
+        self.assertEqual(0.1, compute.power_failure_rate)
+        # Both instances were resolved against the simulated servers
+        instance_map = mock_bmc.call_args[1]['instance_map']
+        self.assertEqual(['bar', 'foo'], sorted(instance_map))
+        for server in compute.servers.list():
+            self.assertEqual('SHUTOFF', server.status)
+            self.assertEqual((server.id, server.name),
+                             instance_map[server.name])
+
+    def test_main_simulator_state_file(self):
+        mock_argv = ['openstackbmc', '--instance', 'foo', '--backend',
+                     'simulator', '--state-file', 'state.json']
+        with mock.patch.object(sys, 'argv', mock_argv):
+            with mock.patch('sys.stderr'):
+                self.assertRaises(SystemExit, openstackbmc.main)
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.measure_imports')
+    def test_main_measure_imports(self, mock_measure):
+        mock_measure.return_value = [
+            ('openstackbmc', 0.1, []),
+            ('os_client_config', 0.4, [])]
+        mock_argv = ['openstackbmc', '--measure-imports']
+        with mock.patch.object(sys, 'argv', mock_argv):
+            openstackbmc.main()
+        mock_measure.assert_called_once_with()
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.measure_imports')
+    def test_main_measure_imports_eager(self, mock_measure):
+        mock_measure.return_value = [
+            ('openstackbmc', 0.5, ['os_client_config']),
+            ('os_client_config', 0.4, [])]
+        mock_argv = ['openstackbmc', '--measure-imports']
+        with mock.patch.object(sys, 'argv', mock_argv):
+            self.assertRaises(SystemExit, openstackbmc.main)
+
+    @mock.patch('os_client_config.make_client')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.OpenStackBmc')
+    def test_main_default_addr(self, mock_bmc, mock_make_client):
+        mock_client = mock.Mock()
+        mock_make_client.return_value = mock_client
+        mock_argv = ['openstackbmc', '--port', '111',
+                     '--instance', 'foobar', '--os-cloud', 'bar']
+        with mock.patch.object(sys, 'argv', mock_argv):
+            openstackbmc.main()
+        mock_bmc.assert_called_once_with({'admin': 'password'},
+                                         port=111,
+                                         address='::',
+                                         instance='foobar',
+                                         cache_status=False,
+                                         os_cloud='bar',
+                                         novaclient=mock.ANY,
+                                         poller=None,
+                                         cache_ttl=30,
+                                         status_table=mock.ANY,
+                                         dispatcher=None,
+                                         boot_device_ttl=300,
+                                         instance_map={},
+                                         startup_timeout=0,
+                                         tracker=mock.ANY,
+                                         listener=None,
+                                         notifications=False
+                                         )
+        mock_bmc.listen.assert_called_once_with()
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.StatusPoller')
+    @mock.patch('os_client_config.make_client')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.OpenStackBmc')
+    def test_main_poll(self, mock_bmc, mock_make_client, mock_poller):
+        mock_client = mock.Mock()
+        mock_client.servers.list.return_value = []
+        mock_make_client.return_value = mock_client
+        mock_argv = ['openstackbmc', '--bmc', '1.2.3.4=foo',
+                     '--bmc', '1.2.3.5=bar', '--poll-interval', '10',
+                     '--os-cloud', 'bar']
+        with mock.patch.object(sys, 'argv', mock_argv):
+            openstackbmc.main()
+        mock_poller.assert_called_once_with(mock.ANY, 10, mock.ANY)
+        table = mock_poller.call_args[0][2]
+        for call in mock_bmc.call_args_list:
+            self.assertEqual(mock_poller.return_value, call[1]['poller'])
+            self.assertIs(table, call[1]['status_table'])
+        mock_poller.return_value.start.assert_called_once_with()
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.'
+                'SharedStatusPoller')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.SharedStatusFile')
+    @mock.patch('os_client_config.make_client')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.OpenStackBmc')
+    def test_main_status_table(self, mock_bmc, mock_make_client, mock_file,
+                               mock_poller):
+        mock_argv = ['openstackbmc', '--instance', 'foo', '--status-table',
+                     '/run/status']
+        with mock.patch.object(sys, 'argv', mock_argv):
+            openstackbmc.main()
+        mock_file.assert_called_once_with('/run/status')
+        mock_file.return_value.open.assert_called_once_with()
+        mock_poller.assert_called_once_with(
+            mock_file.return_value, mock_poller.INTERVAL, mock.ANY)
+        self.assertEqual(mock_poller.return_value,
+                         mock_bmc.call_args[1]['poller'])
+        self.assertIs(mock_poller.call_args[0][2],
+                      mock_bmc.call_args[1]['status_table'])
+        mock_poller.return_value.start.assert_called_once_with()
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.'
+                'update_status_table')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.serve')
+    def test_main_status_updater(self, mock_serve, mock_update):
+        mock_argv = ['openstackbmc', '--status-updater', '--status-table',
+                     '/run/status', '--poll-interval', '5']
+        with mock.patch.object(sys, 'argv', mock_argv):
+            openstackbmc.main()
+        self.assertFalse(mock_serve.called)
+        args = mock_update.call_args[0][0]
+        self.assertEqual('/run/status', args.status_table)
+        self.assertEqual(5, args.poll_interval)
+
+    def test_main_status_updater_without_poll(self):
+        mock_argv = ['openstackbmc', '--status-updater', '--status-table',
+                     '/run/status']
+        with mock.patch.object(sys, 'argv', mock_argv):
+            with mock.patch('sys.stderr'):
+                self.assertRaises(SystemExit, openstackbmc.main)
+
+    def test_main_status_table_simulator(self):
+        mock_argv = ['openstackbmc', '--instance', 'foo', '--backend',
+                     'simulator', '--status-table', '/run/status']
+        with mock.patch.object(sys, 'argv', mock_argv):
+            with mock.patch('sys.stderr'):
+                self.assertRaises(SystemExit, openstackbmc.main)
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.ControlServer')
+    @mock.patch('os_client_config.make_client')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.OpenStackBmc')
+    def test_main_control_socket(self, mock_bmc, mock_make_client,
+                                 mock_control):
+        mock_argv = ['openstackbmc', '--bmc', '1.2.3.4=foo',
+                     '--control-socket', '/run/control.sock',
+                     '--log-level', 'warning']
+        with mock.patch.object(sys, 'argv', mock_argv):
+            with mock.patch.object(openstackbmc, 'log_writer') as mock_lw:
+                openstackbmc.main()
+        self.assertEqual('warning',
+                         mock_lw.configure.call_args[1]['level'])
+        mock_control.assert_called_once_with(
+            '/run/control.sock', {'1.2.3.4': mock_bmc.return_value},
+            mock.ANY)
+        self.assertEqual(30, mock_control.call_args[0][2].cache_ttl)
+        mock_control.return_value.bind.assert_called_once_with()
+        mock_control.return_value.start.assert_called_once_with()
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.send_control')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc._control_paths')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.serve')
+    def test_main_control(self, mock_serve, mock_paths, mock_send):
+        mock_paths.return_value = ['/run/control.sock']
+        mock_send.return_value = {'log_level': 'debug'}
+        mock_argv = ['openstackbmc', '--control-socket', '/run/control.sock',
+                     '--control', 'log-level debug']
+        with mock.patch.object(sys, 'argv', mock_argv):
+            with mock.patch('sys.stdout') as mock_stdout:
+                openstackbmc.main()
+        mock_send.assert_called_once_with('/run/control.sock',
+                                          'log-level debug')
+        output = ''.join(c[1][0] for c in mock_stdout.write.mock_calls)
+        self.assertEqual({'log_level': 'debug'}, json.loads(output))
+        self.assertFalse(mock_serve.called)
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.send_control')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc._control_paths')
+    def test_main_control_workers(self, mock_paths, mock_send):
+        mock_paths.return_value = ['/run/control.sock.0',
+                                   '/run/control.sock.1']
+        replies = {'/run/control.sock.0': {'error': 'No BMC for foo'},
+                   '/run/control.sock.1': {'bmcs': []}}
+        mock_send.side_effect = lambda path, command: replies[path]
+        mock_argv = ['openstackbmc', '--control-socket', '/run/control.sock',
+                     '--control', 'flush foo']
+        with mock.patch.object(sys, 'argv', mock_argv):
+            with mock.patch('sys.stdout') as mock_stdout:
+                openstackbmc.main()
+        output = ''.join(c[1][0] for c in mock_stdout.write.mock_calls)
+        self.assertEqual(replies, json.loads(output))
+        # Every worker failing is an error
+        replies['/run/control.sock.1'] = {'error': 'No BMC for foo'}
+        with mock.patch.object(sys, 'argv', mock_argv):
+            with mock.patch('sys.stdout'):
+                self.assertRaises(SystemExit, openstackbmc.main)
+
+    def test_main_control_without_socket(self):
+        mock_argv = ['openstackbmc', '--control', 'dump']
+        with mock.patch.object(sys, 'argv', mock_argv):
+            with mock.patch('sys.stderr'):
+                self.assertRaises(SystemExit, openstackbmc.main)
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.watchdog')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.sd_notify')
+    @mock.patch('signal.signal')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.StatusUpdater')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.SharedStatusFile')
+    @mock.patch('os_client_config.make_client')
+    def test_update_status_table(self, mock_make_client, mock_file,
+                                 mock_updater, mock_signal, mock_notify,
+                                 mock_watchdog):
+        mock_updater.return_value.is_alive.side_effect = [True, False]
+        args = mock.Mock(status_table='/run/status', poll_interval=5,
+                         metrics_port=0, api_rate=0, api_burst=0)
+        openstackbmc.update_status_table(args)
+        mock_file.assert_called_once_with('/run/status')
+        mock_updater.assert_called_once_with(mock.ANY, 5,
+                                             mock_file.return_value)
+        mock_updater.return_value.start.assert_called_once_with()
+        mock_notify.assert_called_once_with(
+            'READY=1\nSTATUS=Updating /run/status')
+        mock_watchdog.feed.assert_called_once_with()
+        self.assertFalse(mock_make_client.called)
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.TransitionTracker')
+    @mock.patch('os_client_config.make_client')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.OpenStackBmc')
+    def test_main_transition_interval(self, mock_bmc, mock_make_client,
+                                      mock_tracker):
+        mock_client = mock.Mock()
+        mock_make_client.return_value = mock_client
+        mock_argv = ['openstackbmc', '--instance', 'foobar',
+                     '--transition-interval', '2']
+        with mock.patch.object(sys, 'argv', mock_argv):
+            openstackbmc.main()
+        mock_tracker.assert_called_once_with(mock.ANY, mock.ANY, 2)
+        self.assertEqual(mock_tracker.return_value,
+                         mock_bmc.call_args[1]['tracker'])
+        self.assertIs(mock_tracker.call_args[0][1],
+                      mock_bmc.call_args[1]['status_table'])
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.rate_limiter')
+    @mock.patch('os_client_config.make_client')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.OpenStackBmc')
+    def test_main_api_rate(self, mock_bmc, mock_make_client,
+                           mock_rate_limiter):
+        mock_argv = ['openstackbmc', '--instance', 'foobar',
+                     '--api-rate', '5', '--api-burst', '20']
+        with mock.patch.object(sys, 'argv', mock_argv):
+            openstackbmc.main()
+        mock_rate_limiter.configure.assert_called_once_with(5, 20)
+
+    @mock.patch('atexit.register')
+    @mock.patch('signal.signal')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.profiler')
+    @mock.patch('os_client_config.make_client')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.OpenStackBmc')
+    def test_main_profile(self, mock_bmc, mock_make_client, mock_profiler,
+                          mock_signal, mock_atexit):
+        mock_argv = ['openstackbmc', '--instance', 'foobar',
+                     '--profile', '/tmp/profiles', '--profile-interval', '30']
+        with mock.patch.object(sys, 'argv', mock_argv):
+            openstackbmc.main()
+        mock_profiler.configure.assert_called_once_with('/tmp/profiles', 30)
+        signum, handler = mock_signal.call_args[0]
+        self.assertEqual(signal.SIGUSR1, signum)
+        handler(signum, None)
+        mock_profiler.request_dump.assert_called_once_with()
+        mock_atexit.assert_called_once_with(mock_profiler.dump)
+
+    @mock.patch('os_client_config.make_client')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.OpenStackBmc')
+    def test_main_transition_disabled(self, mock_bmc, mock_make_client):
+        mock_argv = ['openstackbmc', '--instance', 'foobar',
+                     '--transition-interval', '0']
+        with mock.patch.object(sys, 'argv', mock_argv):
+            openstackbmc.main()
+        self.assertIsNone(mock_bmc.call_args[1]['tracker'])
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.'
+                'NotificationListener')
+    @mock.patch('os_client_config.make_client')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.OpenStackBmc')
+    def test_main_notification_socket(self, mock_bmc, mock_make_client,
+                                      mock_listener):
+        mock_argv = ['openstackbmc', '--instance', 'foobar',
+                     '--notification-socket', '/run/notifications',
+                     '--os-cloud', 'foo']
+        with mock.patch.object(sys, 'argv', mock_argv):
+            openstackbmc.main()
+        kwargs = mock_bmc.call_args[1]
+        mock_listener.assert_called_once_with('/run/notifications',
+                                              kwargs['status_table'],
+                                              kwargs['tracker'])
+        mock_listener.return_value.bind.assert_called_once_with()
+        mock_listener.return_value.start.assert_called_once_with()
+        # The BMCs answer from the statuses the notifications push
+        self.assertTrue(kwargs['notifications'])
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.SharedListener')
+    @mock.patch('os_client_config.make_client')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.OpenStackBmc')
+    def test_main_shared_socket(self, mock_bmc, mock_make_client,
+                                mock_listener):
+        mock_argv = ['openstackbmc', '--bmc', '1.2.3.4=foo',
+                     '--shared-socket', '--port', '624', '--os-cloud', 'foo']
+        with mock.patch.object(sys, 'argv', mock_argv):
+            openstackbmc.main()
+        mock_listener.assert_called_once_with(624)
+        listener = mock_listener.return_value
+        listener.bind.assert_called_once_with()
+        self.assertIs(listener, mock_bmc.call_args[1]['listener'])
+        listener.listen.assert_called_once_with()
+        self.assertFalse(mock_bmc.listen.called)
+        self.assertFalse(self.mock_assign.called)
+
+    @mock.patch('os_client_config.make_client')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.OpenStackBmc')
+    def test_main_multiple(self, mock_bmc, mock_make_client):
+        mock_client = mock.Mock()
+        mock_client.servers.list.return_value = []
+        mock_make_client.return_value = mock_client
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        instances_file = os.path.join(tempdir, 'instances.json')
+        with open(instances_file, 'w') as f:
+            json.dump({'1.2.3.4': 'foo', '1.2.3.5': 'bar'}, f)
+        mock_argv = ['openstackbmc', '--instances-file', instances_file,
+                     '--bmc', 'fd00::1=baz', '--os-cloud', 'foo']
+        with mock.patch.object(sys, 'argv', mock_argv):
+            openstackbmc.main()
+        mock_make_client.assert_called_once_with('compute', cloud='foo')
+        calls = [mock.call({'admin': 'password'},
+                           port=623,
+                           address=address,
+                           instance=instance,
+                           cache_status=False,
+                           os_cloud='foo',
+                           novaclient=mock.ANY,
+                           poller=None,
+                           cache_ttl=30,
+                           status_table=mock.ANY,
+                           dispatcher=None,
+                           boot_device_ttl=300,
+                           instance_map={},
+                           startup_timeout=0,
+                           tracker=mock.ANY,
+                           listener=None, notifications=False)
+                 for address, instance in [('::ffff:1.2.3.4', 'foo'),
+                                           ('::ffff:1.2.3.5', 'bar'),
+                                           ('fd00::1', 'baz')]]
+        self.assertEqual(calls, mock_bmc.call_args_list)
+        mock_bmc.listen.assert_called_once_with()
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.OpenStackBmc')
+    def test_main_instance_and_bmc(self, mock_bmc):
+        mock_argv = ['openstackbmc', '--instance', 'foobar',
+                     '--bmc', '1.2.3.4=foo', '--os-cloud', 'foo']
+        with mock.patch.object(sys, 'argv', mock_argv):
+            with mock.patch('sys.stderr'):
+                self.assertRaises(SystemExit, openstackbmc.main)
+        self.assertFalse(mock_bmc.called)
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.OpenStackBmc')
+    def test_main_reload_without_file(self, mock_bmc):
+        mock_argv = ['openstackbmc', '--bmc', '1.2.3.4=foo',
+                     '--reload-interval', '5', '--os-cloud', 'foo']
+        with mock.patch.object(sys, 'argv', mock_argv):
+            with mock.patch('sys.stderr'):
+                self.assertRaises(SystemExit, openstackbmc.main)
+        self.assertFalse(mock_bmc.called)
+
+    @mock.patch('signal.signal')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.ipmisession.'
+                'Session._assignsocket')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.InstancesWatcher')
+    @mock.patch('os_client_config.make_client')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.OpenStackBmc')
+    def test_main_reload(self, mock_bmc, mock_make_client, mock_watcher,
+                         mock_assign, mock_signal):
+        mock_client = mock.Mock()
+        mock_client.servers.list.return_value = []
+        mock_make_client.return_value = mock_client
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        instances_file = os.path.join(tempdir, 'instances.json')
+        with open(instances_file, 'w') as f:
+            json.dump({'1.2.3.4': 'foo'}, f)
+        mock_argv = ['openstackbmc', '--instances-file', instances_file,
+                     '--bmc', 'fd00::1=baz', '--reload-interval', '5',
+                     '--os-cloud', 'foo']
+        with mock.patch.object(sys, 'argv', mock_argv):
+            openstackbmc.main()
+        mock_assign.assert_called_once_with()
+        mock_watcher.assert_called_once_with(
+            instances_file, 5, mock.ANY,
+            {'1.2.3.4': mock_bmc.return_value,
+             'fd00::1': mock_bmc.return_value},
+            {'1.2.3.4': 'foo', 'fd00::1': 'baz'}, mock.ANY,
+            fixed={'fd00::1': 'baz'}, on_change=mock.ANY,
+            shard=None)
+        mock_watcher.return_value.start.assert_called_once_with()
+        signum, handler = mock_signal.call_args[0]
+        self.assertEqual(signal.SIGHUP, signum)
+        handler(signum, None)
+        mock_watcher.return_value.wake.assert_called_once_with()
+        # New BMCs are created the same way as the initial ones
+        start_bmc = mock_watcher.call_args[0][5]
+        start_bmc('1.2.3.5', 'bar', {'bar': ('abc-123', 'bar')})
+        self.assertEqual(
+            mock.call({'admin': 'password'}, port=623,
+                      address='::ffff:1.2.3.5', instance='bar',
+                      cache_status=False, os_cloud='foo',
+                      novaclient=mock.ANY, poller=None, cache_ttl=30,
+                      status_table=mock.ANY, dispatcher=None,
+                      boot_device_ttl=300,
+                      instance_map={'bar': ('abc-123', 'bar')},
+                      startup_timeout=0, tracker=mock.ANY,
+                      listener=None, notifications=False),
+            mock_bmc.call_args)
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.resolve_instances')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.sd_notify')
+    @mock.patch('signal.signal')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.InstancesWatcher.'
+                'start', autospec=True)
+    @mock.patch('os_client_config.make_client')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.OpenStackBmc')
+    def test_main_not_found(self, mock_bmc, mock_make_client, mock_start,
+                            mock_signal, mock_notify, mock_resolve):
+        found = {}
+
+        def start(*args, **kwargs):
+            instance = kwargs['instance']
+            if instance not in kwargs['instance_map']:
+                raise openstackbmc.InstanceNotFound(instance)
+            found[instance] = mock.Mock()
+            return found[instance]
+        mock_bmc.side_effect = start
+        mock_resolve.return_value = {'bar': ('def-456', 'bar')}
+        mock_argv = ['openstackbmc', '--bmc', '1.2.3.4=foo',
+                     '--bmc', '1.2.3.5=bar', '--os-cloud', 'foo']
+        with mock.patch.object(sys, 'argv', mock_argv):
+            openstackbmc.main()
+        # The other BMC is served while the missing one is retried
+        self.assertEqual(['bar'], list(found))
+        mock_bmc.listen.assert_called_once_with()
+        self.assertFalse(mock_signal.called)
+        # Not ready until every BMC is
+        mock_notify.assert_called_once_with(
+            'STATUS=Waiting for the instances of 1.2.3.4')
+        watcher = mock_start.call_args[0][0]
+        self.assertIsNone(watcher.path)
+        self.assertEqual(openstackbmc.InstancesWatcher.RETRY_INTERVAL,
+                         watcher.interval)
+        self.assertFalse(watcher.reload())
+        self.assertFalse(found['bar'].close.called)
+        self.assertEqual(['1.2.3.5'], list(watcher.bmcs))
+        self.assertEqual(1, mock_notify.call_count)
+        mock_resolve.return_value = {'foo': ('abc-123', 'foo')}
+        self.assertTrue(watcher.reload())
+        self.assertFalse(found['bar'].close.called)
+        self.assertEqual({'1.2.3.4': found['foo'], '1.2.3.5': found['bar']},
+                         watcher.bmcs)
+        mock_notify.assert_called_with('READY=1\nSTATUS=Serving 2 BMCs')
+
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.sd_notify')
+    @mock.patch('os_client_config.make_client')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.OpenStackBmc')
+    def test_main_instance_not_found(self, mock_bmc, mock_make_client,
+                                     mock_notify):
+        mock_bmc.side_effect = openstackbmc.InstanceNotFound('foo')
+        mock_argv = ['openstackbmc', '--instance', 'foo', '--os-cloud', 'foo']
+        with mock.patch('openstack_virtual_baremetal.openstackbmc.'
+                        'InstancesWatcher.start'):
+            with mock.patch.object(sys, 'argv', mock_argv):
+                openstackbmc.main()
+        for call in mock_notify.call_args_list:
+            self.assertNotIn('READY=1', call[0][0])
+
+    @mock.patch('signal.signal')
+    @mock.patch('atexit.register')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.InstancesWatcher.'
+                'start', autospec=True)
+    @mock.patch('os_client_config.make_client')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.OpenStackBmc')
+    def test_main_state_file_reload(self, mock_bmc, mock_make_client,
+                                    mock_start, mock_atexit, mock_signal):
+        def fake_bmc(*args, **kwargs):
+            bmc = mock.Mock()
+            bmc.instance, bmc.instance_name = (
+                kwargs['instance_map'][kwargs['instance']])
+            bmc.boot_device = None
+            return bmc
+
+        mock_bmc.side_effect = fake_bmc
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        state_file = os.path.join(tempdir, 'state.json')
+        instances_file = os.path.join(tempdir, 'instances.json')
+        with open(instances_file, 'w') as f:
+            json.dump({'1.2.3.4': 'foo', '1.2.3.5': 'bar'}, f)
+        mock_argv = ['openstackbmc', '--instances-file', instances_file,
+                     '--reload-interval', '5', '--state-file', state_file,
+                     '--state-interval', '0', '--os-cloud', 'bar']
+        with mock.patch.object(sys, 'argv', mock_argv):
+            with mock.patch('openstack_virtual_baremetal.openstackbmc.'
+                            'resolve_instances',
+                            return_value={'foo': ('abc-123', 'foo'),
+                                          'bar': ('def-456', 'bar')}):
+                openstackbmc.main()
+        # Saved while the watcher is part way through stopping a BMC
+        watcher = mock_start.call_args[0][0]
+        del watcher.instances['1.2.3.5']
+        save = mock_atexit.call_args[0][0]
+        save()
+        self.assertEqual({'foo': ['abc-123', 'foo']},
+                         openstackbmc.load_state(state_file)['instances'])
+
+    def test_parse_bmc_arg(self):
+        self.assertEqual(('fd00::1', 'foo=bar'),
+                         openstackbmc._parse_bmc_arg('fd00::1=foo=bar'))
+        self.assertRaises(Exception, openstackbmc._parse_bmc_arg, 'foo')
+
+    @mock.patch('signal.signal')
+    @mock.patch('atexit.register')
+    @mock.patch('os_client_config.make_client')
+    @mock.patch('openstack_virtual_baremetal.openstackbmc.OpenStackBmc')
+    def test_main_state_file(self, mock_bmc, mock_make_client, mock_atexit,
+                             mock_signal):
+        def fake_bmc(*args, **kwargs):
+            bmc = mock.Mock()
+            bmc.instance, bmc.instance_name = (
+                kwargs['instance_map'][kwargs['instance']])
+            bmc.boot_device = None
+            return bmc
+
+        mock_bmc.side_effect = fake_bmc
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        state_file = os.path.join(tempdir, 'state.json')
+        openstackbmc.save_state(state_file,
+                                {'instances': {'foo': ['abc-123', 'foo']}})
+        mock_argv = ['openstackbmc', '--bmc', '1.2.3.4=foo',
+                     '--bmc', '1.2.3.5=bar', '--bmc', '1.2.3.6=baz',
+                     '--state-file', state_file, '--state-interval', '0',
+                     '--os-cloud', 'bar']
+
+        def resolve(novaclient, instances):
+            # foo was loaded from the state file
+            self.assertEqual(set(['bar', 'baz']), instances)
+            return {'bar': ('def-456', 'bar'), 'baz': ('ghi-789', 'baz')}
+
+        with mock.patch.object(sys, 'argv', mock_argv):
+            with mock.patch('openstack_virtual_baremetal.openstackbmc.'
+                            'resolve_instances', side_effect=resolve):
+                openstackbmc.main()
+        state = openstackbmc.load_state(state_file)
+        self.assertEqual({'foo': ['abc-123', 'foo'],
+                          'bar': ['def-456', 'bar'],
+                          'baz': ['ghi-789', 'baz']}, state['instances'])
+        self.assertEqual({}, state['statuses'])
+        # Saved again on exit, including after SIGTERM
+        save = mock_atexit.call_args[0][0]
+        self.assertEqual(signal.SIGTERM, mock_signal.call_args[0][0])
+        self.assertRaises(SystemExit, mock_signal.call_args[0][1],
+                          signal.SIGTERM, None)
+        os.remove(state_file)
+        save()
+        self.assertEqual(state['instances'],
+                         openstackbmc.load_state(state_file)['instances'])
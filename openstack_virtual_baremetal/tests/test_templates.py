@@ -0,0 +1,57 @@
+# Copyright 2016 Red Hat Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import base64
+import os
+import unittest
+
+import yaml
+
+TEMPLATES = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__)))), 'templates')
+
+
+class TestBmcUserData(unittest.TestCase):
+    # Nova rejects user data longer than this once it is base64 encoded
+    MAX_USER_DATA = 65535
+    # Stands in for the value of every parameter and attribute, which is
+    # longer than any of them should be
+    PARAM_VALUE = 'x' * 1024
+
+    def _get_file(self, path):
+        with open(os.path.join(TEMPLATES, path)) as f:
+            return f.read()
+
+    def _render(self, str_replace):
+        rendered = self._get_file(str_replace['template']['get_file'])
+        # Replace the longest keys first so that none is replaced as part of
+        # a longer one
+        for key, value in sorted(str_replace['params'].items(),
+                                 key=lambda param: -len(param[0])):
+            if 'get_file' in value:
+                value = self._get_file(value['get_file'])
+            else:
+                value = self.PARAM_VALUE
+            rendered = rendered.replace(key, value)
+        return rendered
+
+    def test_user_data_size(self):
+        with open(os.path.join(TEMPLATES, 'virtual-baremetal.yaml')) as f:
+            template = yaml.safe_load(f)
+        user_data = template['resources']['bmc_server']['properties'][
+            'user_data']['str_replace']
+        rendered = self._render(user_data)
+        self.assertNotIn('$bm_node_count', rendered)
+        self.assertLess(len(base64.b64encode(rendered.encode('utf-8'))),
+                        self.MAX_USER_DATA)